@@ -8,19 +8,19 @@ from emittance_aggregator.server import Aggregator
 def readargs():
     import sys
 
-    if len(sys.argv) == 2:
-        return sys.argv[1]
+    if len(sys.argv) in (2, 3):
+        return sys.argv[1:]
     else:
-        return input("Please supply the local IP address of this server > ")
+        return [input("Please supply the local IP address of this server > ")]
 
 
 def main():
     """Does the argparse and launches a server"""
-    serverIP = readargs()
+    args = readargs()
 
     # Context manager ensures proper shutdown of threads
     # see FleetHandler.__enter__ and __exit__ methods!
-    with Aggregator(serverIP) as server:
+    with Aggregator(*args) as server:
         server.mainloop()
 
     time.sleep(3)
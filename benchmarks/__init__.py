@@ -0,0 +1,13 @@
+"""
+Offline benchmarks of the hot paths, run on loopback:
+
+    python -m benchmarks [-k codec] [--threshold 0.3] [--save-baseline]
+
+The results are compared against benchmarks/baseline.json, see harness.py.
+The figures depend on the machine, so the baseline isn't committed:
+record one with --save-baseline before a change, then rerun to compare.
+The baseline records its host, on another host or interpreter the
+comparison is only shown, regressions don't fail the run. The threshold
+has to stay above the run-to-run noise of the host, shared or virtual
+machines need a larger one.
+"""
@@ -0,0 +1,58 @@
+import os
+import sys
+import argparse
+
+from . import harness
+from . import (  # noqa: the imports register the benchmarks
+    bench_codecs, bench_framing, bench_messaging, bench_relay, bench_probe, bench_sources
+)
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baseline.json")
+
+
+def readargs():
+    parser = argparse.ArgumentParser(prog="python -m benchmarks",
+                                     description="Runs the benchmarks and compares them to a baseline")
+    parser.add_argument("-k", dest="selected", action="append", metavar="NAME",
+                        help="only run the benchmarks with NAME in their name, eg. codec")
+    parser.add_argument("-o", "--output", help="write the results to this JSON file")
+    parser.add_argument("-b", "--baseline", default=BASELINE, help="the JSON baseline to compare to")
+    parser.add_argument("-t", "--threshold", type=float, default=.3,
+                        help="tolerated relative regression, default: 0.3 (30%%)")
+    parser.add_argument("--save-baseline", action="store_true",
+                        help="store the results as the new baseline instead of comparing")
+    return parser.parse_args()
+
+
+def main():
+    args = readargs()
+    results = harness.run(args.selected)
+    if args.output:
+        harness.save(results, args.output)
+    if args.save_baseline:
+        harness.save(results, args.baseline)
+        print("BENCHMARK: baseline saved to", args.baseline)
+        return 0
+    if not os.path.exists(args.baseline):
+        print("BENCHMARK: no baseline at {}, run with --save-baseline".format(args.baseline))
+        return 0
+    baseline = harness.load(args.baseline)
+    table, regressed = harness.compare(results, baseline["results"], args.threshold)
+    print(table)
+    recorded_on = baseline["meta"].get("machine")
+    if recorded_on != harness.machine():
+        print("BENCHMARK: WARNING: the baseline is of another machine ({}), regressions are "
+              "not checked. Record one here with --save-baseline".format(
+                  "{host}, {arch}, {cpus} CPUs, Python {python}".format(**recorded_on)
+                  if isinstance(recorded_on, dict) else "unknown"))
+        return 0
+    if regressed:
+        print("BENCHMARK: {} regressed by more than {:.0%}:".format(len(regressed), args.threshold))
+        for name in regressed:
+            print("  " + name)
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
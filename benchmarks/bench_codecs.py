@@ -0,0 +1,58 @@
+"""Encoding (TCPStreamer.encode_frames) and decoding throughput per codec and frame size"""
+
+import numpy as np
+
+from emittance_common.const import DTYPE
+from emittance_common.codec import available_codecs, codec_by_id
+from emittance_common.framing import HEADER_SIZE, unpack_header
+from emittance_common.util import CaptureDeviceMocker
+from emittance_emitter.channel import TCPStreamer
+from emittance_emitter.component import CaptureDevice
+
+from .harness import benchmark, median_time, Measurement
+
+SIZES = ((240, 320, 3), (480, 640, 3), (720, 1280, 3))
+
+
+def test_frame(shape, seed=0):
+    """A smooth gradient with some sensor-like noise, compresses like a camera frame"""
+    rng = np.random.default_rng(seed)
+    y, x = np.indices(shape[:2])
+    base = (x * 255 // shape[1] + y * 255 // shape[0]) // 2
+    noise = rng.integers(0, 8, shape)
+    return (base[..., None] + noise).astype(DTYPE)
+
+
+def _cases():
+    streamer = TCPStreamer(keyframe_interval=0, eye=CaptureDevice(CaptureDeviceMocker))
+    for spec in available_codecs():
+        streamer.set_codec(spec)
+        for shape in SIZES:
+            yield streamer, spec, shape, test_frame(shape)
+
+
+def _name(kind, spec, shape):
+    return "codec.{}[{},{}]".format(kind, spec, "x".join(map(str, shape)))
+
+
+@benchmark
+def encode_frames():
+    results = []
+    for streamer, spec, shape, frame in _cases():
+        seconds = median_time(lambda: streamer.encode_frames([frame]))
+        results.append(Measurement(_name("encode", spec, shape), frame.nbytes / seconds / 1e6, "MB/s"))
+    return results
+
+
+@benchmark
+def decode_frames():
+    results = []
+    for streamer, spec, shape, frame in _cases():
+        packed = streamer.encode_frames([frame])
+        header = unpack_header(packed[:HEADER_SIZE])
+        payload = memoryview(packed)[HEADER_SIZE:]
+        codec = codec_by_id(header.codec)
+        out = np.empty(shape, DTYPE)
+        seconds = median_time(lambda: codec.decode_into(payload, out))
+        results.append(Measurement(_name("decode", spec, shape), frame.nbytes / seconds / 1e6, "MB/s"))
+    return results
@@ -0,0 +1,58 @@
+"""Parsing throughput of the frame stream, on the receiving paths of the framestreams"""
+
+import threading as thr
+
+import numpy as np
+
+from emittance_common.const import DTYPE
+from emittance_common.codec import RawCodec
+from emittance_common.framing import pack_frame, read_frame, read_raw_frame, FramePool
+
+from .harness import benchmark, median_time, socketpair, Measurement
+
+# Frames parsed by one timed call: (shape, count)
+CASES = (((48, 64, 3), 256), ((480, 640, 3), 16))
+
+
+def _stream(shape, count):
+    """
+    Starts sending a never-ending stream of raw frames.
+    :return: the receiving socket and the sending one, closing it stops the stream
+    """
+    frame = np.zeros(shape, DTYPE)
+    blob = b"".join(pack_frame(frame.tobytes(), seq, 0., shape, DTYPE, RawCodec.ID)
+                    for seq in range(count))
+    sender, receiver = socketpair()
+
+    def send():
+        try:
+            while 1:
+                sender.sendall(blob)
+        except OSError:
+            pass
+
+    thr.Thread(target=send, name="Bench-Sender", daemon=True).start()
+    return receiver, sender
+
+
+@benchmark
+def framestream():
+    results = []
+    for shape, count in CASES:
+        size = "x".join(map(str, shape))
+        pool = FramePool(shape, DTYPE)
+        readers = {"read_frame": read_frame, "read_raw_frame": read_raw_frame,
+                   "FramePool": pool.read_frame}
+        for name, reader in readers.items():
+            receiver, sender = _stream(shape, count)
+
+            def parse():
+                for _ in range(count):
+                    reader(receiver)
+
+            seconds = median_time(parse)
+            results.append(Measurement("framestream.{}[{}]".format(name, size),
+                                       count / seconds, "frames/s"))
+            sender.close()
+            receiver.close()
+    return results
@@ -0,0 +1,80 @@
+"""Round-trip latency and throughput of Messaging over loopback"""
+
+import time
+import threading as thr
+from statistics import median
+
+from emittance_common.messaging import Messaging
+
+from .harness import benchmark, socketpair, percentile, Measurement, LOWER, ROUNDS
+
+ROUND_TRIPS = 2000
+MESSAGES = 50000
+PIPELINED = 5000
+
+
+def _pair():
+    """:return: a client and a server Messaging, the server answers every request"""
+    client, server = socketpair()
+    for sock in (client, server):
+        sock.settimeout(1)
+    client, server = Messaging(client), Messaging(server)
+    server.on_message = lambda m: server.reply(m, b"pong")
+    return client, server
+
+
+def _round_trips(client):
+    samples = []
+    for _ in range(ROUND_TRIPS):
+        start = time.perf_counter()
+        client.request(b"ping")
+        samples.append(time.perf_counter() - start)
+    return percentile(samples, .5), percentile(samples, .99)
+
+
+def _pipelined(client):
+    start = time.perf_counter()
+    futures = [client.request_async(b"ping") for _ in range(PIPELINED)]
+    for future in futures:
+        future.result(10)
+    return PIPELINED / (time.perf_counter() - start)
+
+
+def _oneway(client, server):
+    received, done = [0], thr.Event()
+
+    def count(m):
+        received[0] += 1
+        if received[0] == MESSAGES:
+            done.set()
+
+    server.on_message = count
+    start = time.perf_counter()
+    for _ in range(MESSAGES):
+        client.send(b"x" * 64)
+    if not done.wait(30):
+        raise RuntimeError("only {} of {} messages arrived".format(received[0], MESSAGES))
+    return MESSAGES / (time.perf_counter() - start)
+
+
+@benchmark
+def messaging():
+    """The median of ROUNDS runs is kept, like in harness.median_time()"""
+    client, server = _pair()
+    try:
+        for _ in range(100):
+            client.request(b"ping")
+        round_trips = [_round_trips(client) for _ in range(ROUNDS)]
+        p50, p99 = (median(r[i] for r in round_trips) for i in (0, 1))
+        pipelined = median([_pipelined(client) for _ in range(ROUNDS)])
+
+        oneway = median([_oneway(client, server) for _ in range(ROUNDS)])
+    finally:
+        for messenger in (client, server):
+            messenger.teardown(0)
+            messenger.job_in.join(2)
+            messenger.job_out.join(2)
+    return [Measurement("messaging.round_trip.p50", p50 * 1e6, "us", LOWER),
+            Measurement("messaging.round_trip.p99", p99 * 1e6, "us", LOWER),
+            Measurement("messaging.requests_pipelined", pipelined, "requests/s"),
+            Measurement("messaging.messages", oneway, "messages/s")]
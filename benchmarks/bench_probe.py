@@ -0,0 +1,74 @@
+"""Sweep time of Probe against local stand-in probe servers"""
+
+import time
+import asyncio
+import ipaddress
+import threading as thr
+from statistics import median
+
+from emittance_common.const import EMITTER_PROBE_PORT
+from emittance_common.probeclient import Probe
+
+from .harness import benchmark, Measurement, LOWER, ROUNDS
+
+# The swept network and the number of its hosts answering like idle emitters
+NETWORK = "127.0.2.0/24"
+LIVE = 32
+
+
+class StandInProbeServers(object):
+
+    """
+    Answers probes like ProbeServer does, on the first <count> hosts
+    of a loopback network. The other hosts refuse the connection.
+    """
+
+    def __init__(self, network=NETWORK, count=LIVE):
+        self.IPs = [str(ip) for ip in list(ipaddress.ip_network(network).hosts())[:count]]
+        self.loop = asyncio.new_event_loop()
+        self.ready = thr.Event()
+        self.worker = thr.Thread(target=self._run, name="Bench-Probe-Servers", daemon=True)
+
+    def _handler(self, index, IP):
+        async def handle(reader, writer):
+            if await reader.read(1024) in (b"probing", b"connect"):
+                writer.write("emitter-B{} @ {}".format(index, IP).encode())
+                await writer.drain()
+            writer.close()
+        return handle
+
+    def _run(self):
+        asyncio.set_event_loop(self.loop)
+        self.servers = [self.loop.run_until_complete(
+            asyncio.start_server(self._handler(i, IP), IP, EMITTER_PROBE_PORT))
+            for i, IP in enumerate(self.IPs)]
+        self.ready.set()
+        self.loop.run_forever()
+        for server in self.servers:
+            server.close()
+
+    def start(self):
+        self.worker.start()
+        self.ready.wait(5)
+        return self
+
+    def teardown(self, sleep=0):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.worker.join(max(sleep, 1))
+
+
+@benchmark
+def probe():
+    servers = StandInProbeServers().start()
+    try:
+        timings = []
+        for _ in range(ROUNDS):
+            start = time.perf_counter()
+            found = [ID for IP, ID in Probe.sweep(NETWORK) if ID is not None]
+            timings.append(time.perf_counter() - start)
+            if len(found) != LIVE:
+                raise RuntimeError("found {} of {} stand-in emitters".format(len(found), LIVE))
+    finally:
+        servers.teardown()
+    return [Measurement("probe.sweep[{},{} live]".format(NETWORK, LIVE),
+                        median(timings) * 1000, "ms", LOWER)]
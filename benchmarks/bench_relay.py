@@ -0,0 +1,52 @@
+"""Relay throughput of the Forwarder, which joins the RC streams of subscribers and emitters"""
+
+import os
+import time
+import socket
+import threading as thr
+from statistics import median
+
+from emittance_common.subsystem import Forwarder
+
+from .harness import benchmark, socketpair, Measurement, ROUNDS
+
+CHUNK = 1 << 20
+TOTAL = 256 * CHUNK
+
+
+def relay(mode):
+    """:return: seconds taken to relay TOTAL bytes"""
+    source, relay_in = socketpair()
+    relay_out, target = socketpair()
+    forwarder = Forwarder(relay_in, relay_out, name="Bench", mode=mode)
+
+    def produce():
+        data = b"x" * CHUNK
+        for _ in range(TOTAL // CHUNK):
+            source.sendall(data)
+        source.shutdown(socket.SHUT_WR)
+
+    producer = thr.Thread(target=produce, name="Bench-Producer")
+    start = time.perf_counter()
+    forwarder.start()
+    producer.start()
+    buffer, got = bytearray(CHUNK), 0
+    while got < TOTAL:
+        n = target.recv_into(buffer)
+        if not n:
+            raise RuntimeError("relay stopped after {} bytes".format(got))
+        got += n
+    elapsed = time.perf_counter() - start
+    producer.join()
+    forwarder.teardown(0)
+    for sock in (source, relay_in, relay_out, target):
+        sock.close()
+    return elapsed
+
+
+@benchmark
+def forwarder():
+    modes = ["splice", "copy"] if hasattr(os, "splice") else ["copy"]
+    return [Measurement("forwarder.{}".format(mode),
+                        TOTAL / median([relay(mode) for _ in range(ROUNDS)]) / 1e9, "GB/s")
+            for mode in modes]
@@ -0,0 +1,26 @@
+"""Frame rate of the synthetic sources, which feed the test emitters"""
+
+from emittance_common.synthetic import SOURCES
+
+from .harness import benchmark, median_time, Measurement
+
+SIZES = ((480, 640, 3), (720, 1280, 3))
+# Number of frames read by one timed call
+FRAMES = 16
+
+
+@benchmark
+def synthetic_sources():
+    results = []
+    for name, cls in sorted(SOURCES.items()):
+        for shape in SIZES:
+            # Scene changes are included at the rate of a busy scene
+            source = cls(shape, scene_change=None if name == "noise" else .05)
+
+            def read():
+                for _ in range(FRAMES):
+                    source.read()
+
+            results.append(Measurement("source.{}[{}]".format(name, "x".join(map(str, shape))),
+                                       FRAMES / median_time(read), "frames/s"))
+    return results
@@ -0,0 +1,171 @@
+"""
+Registry, timing and baseline comparison of the benchmarks.
+
+A benchmark is a function decorated with @benchmark, which returns a
+list of Measurement objects. Results are stored as JSON:
+
+    {"meta": {...}, "results": {name: {"value": v, "unit": u, "better": "higher"}}}
+
+and compared against a baseline of the same format. A measurement
+regresses if it is worse than the baseline by more than the threshold,
+eg. 0.2 for 20%.
+"""
+
+import gc
+import io
+import os
+import sys
+import json
+import time
+import socket
+import platform
+from datetime import datetime
+from statistics import median
+from contextlib import redirect_stdout
+
+from emittance_common.util import Table
+
+BENCHMARKS = []
+
+HIGHER, LOWER = "higher", "lower"
+
+# Every case is run in ROUNDS batches, each at least MIN_TIME / ROUNDS long
+MIN_TIME = 2.
+ROUNDS = 7
+
+
+def benchmark(function):
+    """Decorator, registers a benchmark function"""
+    BENCHMARKS.append(function)
+    return function
+
+
+class Measurement(object):
+
+    def __init__(self, name, value, unit, better=HIGHER):
+        """
+        :param name: unique name, eg. codec.encode[zlib,640x480x3]
+        :param value: the measured value
+        :param unit: eg. MB/s or ms
+        :param better: HIGHER for throughputs, LOWER for latencies
+        """
+        self.name = name
+        self.value = value
+        self.unit = unit
+        self.better = better
+
+    def asdict(self):
+        return {"value": self.value, "unit": self.unit, "better": self.better}
+
+
+def median_time(function, min_time=MIN_TIME, rounds=ROUNDS):
+    """
+    Calls <function> repeatedly in <rounds> batches and returns the
+    seconds per call of the median batch, which depends less on a lucky
+    or a disturbed batch than the fastest one.
+    The garbage collector is disabled while timing.
+    """
+    function()  # Warmup, also calibrates the batch size
+    start = time.perf_counter()
+    function()
+    single = max(time.perf_counter() - start, 1e-9)
+    number = max(1, int(min_time / rounds / single))
+    timings = []
+    gc.collect()
+    gc.disable()
+    try:
+        for _ in range(rounds):
+            start = time.perf_counter()
+            for _ in range(number):
+                function()
+            timings.append((time.perf_counter() - start) / number)
+    finally:
+        gc.enable()
+    return median(timings)
+
+
+def percentile(samples, q):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+def socketpair():
+    """A connected pair of loopback TCP sockets, so the benchmarks exercise the TCP stack"""
+    server = socket.socket()
+    server.bind(("127.0.0.1", 0))
+    server.listen(1)
+    client = socket.create_connection(server.getsockname())
+    accepted, _ = server.accept()
+    server.close()
+    return client, accepted
+
+
+def run(selected=None):
+    """
+    :param selected: substrings of the benchmark names to run, all by default
+    :return: {name: Measurement}
+    """
+    results = {}
+    for function in BENCHMARKS:
+        name = function.__module__.rpartition(".")[2] + "." + function.__name__
+        if selected and not any(s in name for s in selected):
+            continue
+        print("BENCHMARK: running", name)
+        # The printouts of the benchmarked components are discarded
+        with redirect_stdout(io.StringIO()):
+            measurements = function()
+        for measurement in measurements:
+            print("  {:<48} {:>12.4g} {}".format(measurement.name, measurement.value, measurement.unit))
+            results[measurement.name] = measurement
+    return results
+
+
+def machine():
+    """Identifies the host of a run, results are only comparable on the same one"""
+    return {"host": platform.node(), "arch": platform.machine(), "cpus": os.cpu_count(),
+            "python": sys.version.split()[0]}
+
+
+def save(results, path):
+    document = {
+        "meta": {"date": datetime.now().isoformat(timespec="seconds"),
+                 "platform": platform.platform(),
+                 "machine": machine()},
+        "results": {name: m.asdict() for name, m in sorted(results.items())}
+    }
+    with open(path, "w") as handle:
+        json.dump(document, handle, indent=2)
+        handle.write("\n")
+
+
+def load(path):
+    """:return: the document stored by save(), {"meta": ..., "results": ...}"""
+    with open(path) as handle:
+        return json.load(handle)
+
+
+def compare(results, baseline, threshold):
+    """
+    :param results: {name: Measurement} of this run
+    :param baseline: {name: {"value", "unit", "better"}} as stored by save()
+    :param threshold: tolerated relative change for the worse, eg. 0.2
+    :return: tuple of (report table, names of the regressed measurements)
+    """
+    tab = Table(["benchmark", "baseline", "current", "change", "status"], [50, 12, 12, 9, 12])
+    regressed = []
+    for name, measurement in sorted(results.items()):
+        reference = baseline.get(name)
+        if reference is None or not reference["value"]:
+            tab.add(name, "-", "{:.4g}".format(measurement.value), "-", "new")
+            continue
+        change = measurement.value / reference["value"] - 1
+        worse = -change if measurement.better == HIGHER else change
+        status = "ok"
+        if worse > threshold:
+            status = "REGRESSED"
+            regressed.append(name)
+        elif -worse > threshold:
+            status = "improved"
+        tab.add(name, "{:.4g}".format(reference["value"]), "{:.4g}".format(measurement.value),
+                "{:+.1%}".format(change), status)
+    return tab.get(), regressed
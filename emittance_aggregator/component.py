@@ -1,5 +1,7 @@
 import threading as thr
+from concurrent.futures import ThreadPoolExecutor
 
+from emittance_common.const import HANDSHAKE_WORKERS
 from emittance_common.abstract import AbstractListener, AbstractCommander
 from emittance_common.interface import InterfaceFactory
 
@@ -8,12 +10,21 @@ class Listener(AbstractListener):
 
     """
     Listens for incoming emitter connections for the server.
-    Runs in a separate thread.
+    Runs in a separate thread. The handshakes are run concurrently by
+    a pool of threads, so a slow or silent remote doesn't hold up the
+    others. Their data and RC connections are told apart by the token
+    sent in the HELLO response (see emittance_common.handshake).
     """
 
-    def __init__(self, master):
+    def __init__(self, master, workers=HANDSHAKE_WORKERS):
+        """
+        :param master: the Aggregator, its emitters and subscribers dicts are filled
+        :param workers: number of handshakes served at once
+        """
         AbstractListener.__init__(self, master.ip)
         self.master = master
+        self.workers = workers
+        self.handshakes = None  # type: ThreadPoolExecutor
         self.worker = None
 
     def start(self):
@@ -25,30 +36,57 @@ class Listener(AbstractListener):
         if self.worker is not None:
             print("ABS_LISTENER: Attempted start while already running!")
             return
+        self.handshakes = ThreadPoolExecutor(self.workers, thread_name_prefix="Server-Handshake")
         self.worker = thr.Thread(target=self.mainloop, name="Server-Listener")
         self.worker.start()
 
     def teardown(self, sleep=2):
         super(Listener, self).teardown(sleep)
+        if self.handshakes is not None:
+            self.handshakes.shutdown(wait=False)
+            self.handshakes = None
         self.worker = None
 
     def callback(self, msock):
         """
-        Builds an interface and puts it into the server's appropriate
-        container for later usage.
+        Hands the handshake over to the pool and returns at once,
+        so the next connection can be accepted.
         :param msock: connected socket used for message connection
         """
         print("LISTENER: called callback on incoming connection!")
-        ifc = InterfaceFactory(msock, self.dlistener, self.rclistener).get()
+        self.handshakes.submit(self.build_interface, msock)
+
+    def build_interface(self, msock):
+        """
+        Builds an interface and puts it into the server's appropriate
+        container for later usage.
+        """
+        try:
+            ifc = InterfaceFactory(msock, self.matcher, directory=self.master.emitters,
+                                   unregister=self.unregister).get()
+        except Exception as E:
+            # Would be swallowed by the pool otherwise
+            print("LISTENER: handshake failed with exception:", E)
+            msock.close()
+            return
         if not ifc:
             print("LISTENER: no interface received!")
             return
         print("LISTENER: received {} interface: {}".format(ifc.entity_type, ifc))
         if ifc.entity_type == "emitter":
-            self.master.emitters[ifc.ID] = ifc
+            # The stream is read once and shared by the viewers and subscribers
+            ifc.fanout()
+            self.master.register_emitter(ifc)
         else:
             self.master.subscribers[ifc.ID] = ifc
 
+    def unregister(self, ifc):
+        """Removes a torn down interface from the server's container"""
+        registry = {"emitter": self.master.emitters,
+                    "subscriber": self.master.subscribers}[ifc.entity_type]
+        if registry.get(ifc.ID) is ifc:
+            registry.pop(ifc.ID, None)
+
 
 class Console(AbstractCommander):
 
@@ -0,0 +1,676 @@
+"""
+asyncio core of the Aggregator.
+
+A single event loop, running in a background thread, serves the
+messaging, stream and RC ports for every connected entity. Frames
+are forwarded to the subscribers without being decoded. Decoding,
+which is only needed for watching a stream, runs in an executor.
+"""
+
+import time
+import asyncio
+import threading as thr
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from emittance_common.const import (
+    MESSAGE_SERVER_PORT, STREAM_SERVER_PORT, RC_SERVER_PORT, SSEP, RECV_POOL_SIZE,
+    CODEC_PREFERENCE, DECODE_WORKERS, HANDSHAKE_TIMEOUT, LISTEN_BACKLOG, TOKEN_SIZE,
+    HUB_OUTLET_SIZE, SUBSCRIBER_POLICY, SUBSCRIBER_MAX_LAG, RECORDING_DIR
+)
+from emittance_common.abstract import RemoteCommander
+from emittance_common.clock import ClockSync, FrameLatency, clock_reply
+from emittance_common.codec import codec_by_id
+from emittance_common.framing import HEADER_SIZE, unpack_header, DeltaDecoder
+from emittance_common.hub import (
+    DISCONNECT, OUTLET_POLICIES, StreamMetrics, Tier, outlet_metrics, parse_subscriber_options
+)
+from emittance_common.interface import Introduction, observe_handshake, remote_shutdown
+from emittance_common.messaging import MessagingBase
+from emittance_common.queues import FrameQueue, BLOCK, LATEST
+from emittance_common.recording import Recorder
+from emittance_common import metrics
+
+STREAM_ERRORS = (asyncio.IncompleteReadError, asyncio.LimitOverrunError,
+                 ConnectionError, OSError, RuntimeError)
+
+
+class AsyncMessaging(MessagingBase):
+
+    """
+    Messaging over asyncio streams.
+    Reading runs as a task of the engine's loop and writes are
+    scheduled on the loop, so send(), recv() and request() can be
+    called from any thread.
+    """
+
+    def __init__(self, loop, reader, writer, tag=b""):
+        super(AsyncMessaging, self).__init__(tag)
+        self.loop = loop
+        self.reader = reader
+        self.writer = writer
+        self.on_close = None
+        self.task = None
+
+    def start(self):
+        """Starts the reading task. Must be called from the loop."""
+        self.task = self.loop.create_task(self._flow_in())
+
+    async def _flow_in(self):
+        while self.running:
+            try:
+                data = await self.reader.readuntil(SSEP)
+            except asyncio.IncompleteReadError:
+                if self.running:
+                    print("ASYNC_MESSENGER: remote end closed the connection")
+                break
+            except STREAM_ERRORS as E:
+                if self.running:
+                    print("ASYNC_MESSENGER: caught socket exception:", E)
+                break
+            self._deliver([data[:-len(SSEP)].decode("utf8")])
+        self._stop()
+        if self.on_close is not None:
+            self.on_close()
+
+    def _write(self, chunks):
+        if self.running and not self.loop.is_closed():
+            self.loop.call_soon_threadsafe(self.writer.write, b"".join(chunks))
+
+    def teardown(self, sleep=0):
+        """Buffered messages are flushed by the transport before closing"""
+        self._stop()
+        if not self.loop.is_closed():
+            self.loop.call_soon_threadsafe(self.writer.close)
+
+
+class AsyncOutlet(object):
+
+    """
+    Bounded send queue of a subscriber session.
+    Counterpart of hub.SocketOutlet: same policies, same statistics.
+    Frames are written to the subscriber by a separate task, which
+    waits for the transport to drain after each frame, so the frames
+    pile up (and get dropped) here instead of in the transport's buffer.
+    """
+
+    def __init__(self, writer, name, on_evict=None, maxsize=HUB_OUTLET_SIZE,
+                 policy=SUBSCRIBER_POLICY, max_lag=SUBSCRIBER_MAX_LAG, labels=None):
+        if policy not in OUTLET_POLICIES:
+            raise ValueError("Invalid policy: {}. Expected one of: {}"
+                             .format(policy, ", ".join(OUTLET_POLICIES)))
+        self.writer = writer
+        self.name = name
+        self.on_evict = on_evict
+        self.maxsize = max(1, maxsize)
+        self.policy = policy
+        self.max_lag = max_lag
+        self.items = deque()
+        self.ready = asyncio.Event()
+        self.space = asyncio.Event()
+        self.sent = 0
+        self.dropped = 0
+        self.sending_since = None
+        self.evicted = False
+        self.forward_time = None
+        self.evictions = None
+        if labels is not None:
+            self._instrument(labels)
+        self.task = asyncio.get_running_loop().create_task(self._send())
+
+    def _instrument(self, labels):
+        self.forward_time, self.evictions = outlet_metrics(
+            labels, queued=lambda: len(self.items), sent=lambda: self.sent,
+            dropped=lambda: self.dropped)
+
+    def lag(self):
+        now = time.monotonic()
+        stalled = 0. if self.sending_since is None else now - self.sending_since
+        queued = now - self.items[0][0] if self.items else 0.
+        return max(stalled, queued)
+
+    async def put(self, head, payload):
+        """
+        Called by the emitter's ingest task with every frame.
+        A block outlet holds up the ingest until it has room for the frame,
+        but at most for max_lag seconds, then the outlet is evicted.
+        """
+        if self.evicted:
+            return
+        if self.policy == DISCONNECT and self.lag() > self.max_lag:
+            self.evict()
+            return
+        if self.policy == LATEST:
+            self.dropped += len(self.items)
+            self.items.clear()
+        elif len(self.items) >= self.maxsize:
+            if self.policy != BLOCK:
+                self.items.popleft()
+                self.dropped += 1
+            else:
+                self.space.clear()
+                try:
+                    await asyncio.wait_for(self.space.wait(), self.max_lag)
+                except asyncio.TimeoutError:
+                    self.dropped += 1
+                    self.evict()
+                    return
+        self.items.append((time.monotonic(), (head, payload)))
+        self.ready.set()
+
+    async def _send(self):
+        while 1:
+            if not self.items:
+                self.ready.clear()
+                await self.ready.wait()
+                continue
+            stamp, (head, payload) = self.items.popleft()
+            self.space.set()
+            self.sending_since = time.monotonic()
+            try:
+                self.writer.write(head)
+                self.writer.write(payload)
+                await self.writer.drain()
+            except STREAM_ERRORS:
+                break
+            finally:
+                self.sending_since = None
+            self.sent += 1
+            if self.forward_time is not None:
+                self.forward_time.observe(time.monotonic() - stamp)
+
+    def evict(self):
+        print("OUTLET {}: lagging behind by {:.1f} s, disconnecting ({})"
+              .format(self.name, self.lag(), self.stats()))
+        self.evicted = True
+        self.close()
+        if self.evictions is not None:
+            self.evictions.inc()
+        if self.on_evict is not None:
+            self.on_evict()
+
+    def stats(self):
+        return "policy={} sent={} dropped={} queued={} lag={:.2f}".format(
+            self.policy, self.sent, self.dropped, len(self.items), self.lag()
+        )
+
+    def close(self):
+        self.task.cancel()
+        self.items.clear()
+
+
+class _Session(object):
+
+    """
+    Base class of the connections served by the engine.
+    Counterpart of interface._Interface: a messaging channel, plus
+    the data and RC streams, which are matched to the session after
+    the handshake.
+    """
+
+    entity_type = ""
+
+    def __init__(self, engine, intro, messenger, remote_ip):
+        self.engine = engine
+        self.ID = intro.ID
+        self.messenger = messenger
+        self.send = messenger.send
+        self.recv = messenger.recv
+        self.remote_ip = remote_ip
+        self.streams = {}
+        self.connected = asyncio.Event()
+        self.tasks = []
+        messenger.on_close = self.close
+
+    def attach_stream(self, typ, reader, writer):
+        self.out("{} connection from {}:{}".format(typ, *writer.get_extra_info("peername")))
+        self.streams[typ] = reader, writer
+        if len(self.streams) == 2:
+            self.connected.set()
+
+    def activate(self):
+        """Called on the loop, once both streams are connected"""
+
+    def close(self):
+        """Closes the streams. Called on the loop."""
+        for task in self.tasks:
+            task.cancel()
+        self.tasks = []
+        for reader, writer in self.streams.values():
+            writer.close()
+        self.streams = {}
+        self.engine.unregister(self)
+
+    def out(self, *args, **kw):
+        """Wrapper for print(). Appends the remote's ID to every output line"""
+        sep, end = kw.get("sep", " "), kw.get("end", "\n")
+        print("{}SESSION {}: ".format(self.entity_type.upper(), self.ID),
+              *args, sep=sep, end=end)
+
+    def teardown(self, sleep=0):
+        self.messenger.teardown(sleep)
+        self.engine.call(self.close)
+
+
+class EmitterSession(_Session):
+
+    """
+    Counterpart of interface._EmitterInterface.
+    Reads the frames of the emitter once and forwards them,
+    still encoded, to every attached subscriber. Subscribers of
+    a Tier get the frames rendered once per tier instead.
+    """
+
+    entity_type = "emitter"
+
+    def __init__(self, engine, intro, messenger, remote_ip):
+        super(EmitterSession, self).__init__(engine, intro, messenger, remote_ip)
+        self.frameshape = intro.info
+        self.codec = intro.codec
+        self.subscribers = set()
+        self.tiers = {}
+        self.watchers = []
+        self.to_decode = None
+        self.recorder = None  # type: Recorder
+        self.stream_metrics = StreamMetrics(self.ID)
+        # Requests block, so the estimates run in the clock's own thread
+        self.clock = ClockSync(messenger, name=self.ID, labels={"emitter": self.ID})
+        self.latency = FrameLatency(self.clock, emitter=self.ID)
+
+    def activate(self):
+        self.out("Frameshape:", self.frameshape, "codec:", self.codec)
+        self.tasks.append(self.engine.loop.create_task(self._ingest()))
+        self.clock.start()
+
+    async def _ingest(self):
+        reader = self.streams["Data"][0]
+        while 1:
+            try:
+                head = await reader.readexactly(HEADER_SIZE)
+                start = time.perf_counter()
+                header = unpack_header(head)
+                payload = await reader.readexactly(header.length)
+            except STREAM_ERRORS as E:
+                self.out("Stream closed:", E)
+                break
+            self.stream_metrics.recv_time.observe(time.perf_counter() - start)
+            self.latency.arrived(header)
+            self.stream_metrics.mark(HEADER_SIZE + len(payload))
+            for subscriber in list(self.subscribers):
+                await subscriber.forward(head, payload)
+            recorder = self.recorder
+            if recorder is not None and not recorder.put((header, (head, payload))):
+                # The recorder stopped on a write error
+                self.recorder = None
+            if self.to_decode is not None and (self.watchers or self.tiers):
+                try:
+                    self.to_decode.put_nowait((header, payload))
+                except asyncio.QueueFull:
+                    pass  # The delta decoder notices the gap and asks for a keyframe
+
+    def _decode_one(self, delta, header, payload):
+        with self.stream_metrics.decode_time.time():
+            frame = codec_by_id(header.codec).decode(payload, header.shape, header.dtype)
+            return delta.apply(header, frame)
+
+    def _render_one(self, tier, header, frame):
+        with self.stream_metrics.render_time.time():
+            return tier.render(header, frame)
+
+    async def _decode(self):
+        delta = DeltaDecoder(on_missing_keyframe=self.request_keyframe)
+        while 1:
+            header, payload = await self.to_decode.get()
+            frame = await self.engine.loop.run_in_executor(
+                self.engine.executor, self._decode_one, delta, header, payload
+            )
+            if frame is None:
+                continue
+            if self.watchers:
+                self.latency.displayed(header)
+            for queue in self.watchers:
+                queue.put(frame)
+            for tier in list(self.tiers.values()):
+                if not tier.take(header):
+                    continue
+                _, packed = await self.engine.loop.run_in_executor(
+                    self.engine.executor, self._render_one, tier, header, frame
+                )
+                head, payload = packed[:HEADER_SIZE], memoryview(packed)[HEADER_SIZE:]
+                for subscriber in list(tier.consumers):
+                    await subscriber.forward(head, payload)
+
+    def _start_decoding(self):
+        if self.to_decode is None:
+            self.to_decode = asyncio.Queue(maxsize=2)
+            self.tasks.append(self.engine.loop.create_task(self._decode()))
+
+    def _add_watcher(self, queue):
+        self.watchers.append(queue)
+        self._start_decoding()
+
+    def join_tier(self, subscriber, key):
+        if key not in self.tiers:
+            self.tiers[key] = Tier(*key)
+        self.tiers[key].consumers.append(subscriber)
+        self._start_decoding()
+
+    def leave_tier(self, subscriber):
+        for key, tier in list(self.tiers.items()):
+            if subscriber in tier.consumers:
+                tier.consumers.remove(subscriber)
+            if not tier.consumers:
+                del self.tiers[key]
+
+    def _remove_watcher(self, queue):
+        if queue in self.watchers:
+            self.watchers.remove(queue)
+
+    def framestream(self, pooled=False, pool_size=RECV_POOL_SIZE):
+        """
+        Generator function that yields the received video frames.
+        Frames are decoded in the engine's executor, the arguments
+        are accepted for compatibility with _EmitterInterface.
+        """
+        queue = FrameQueue(pool_size)
+        self.engine.call(self._add_watcher, queue)
+        try:
+            while self.messenger.running and not queue.closed:
+                frame = queue.get(timeout=1)
+                if frame is not None:
+                    yield frame
+        finally:
+            self.engine.call(self._remove_watcher, queue)
+
+    def record(self, directory=RECORDING_DIR, **kw):
+        """
+        Starts recording the stream, see emittance_common.recording.
+        The recorder writes in its own thread, the ingest only queues the frames.
+        :param kw: see recording.Recorder
+        """
+        if self.recorder is None:
+            self.recorder = Recorder(self.ID, directory, request_keyframe=self.request_keyframe, **kw)
+        return self.recorder
+
+    def stop_recording(self):
+        recorder, self.recorder = self.recorder, None
+        if recorder is not None:
+            recorder.teardown()
+
+    def request_keyframe(self):
+        self.send(b"keyframe")
+
+    def close(self):
+        self.clock.teardown()
+        self.stop_recording()
+        for queue in self.watchers:
+            queue.close()
+        for subscriber in list(self.subscribers):
+            subscriber.detach()
+        for tier in list(self.tiers.values()):
+            for subscriber in list(tier.consumers):
+                subscriber.detach()
+        super(EmitterSession, self).close()
+
+    def teardown(self, sleep=3):
+        success = remote_shutdown(self, await_remote=2)
+        super(EmitterSession, self).teardown(max(0, sleep - 2))
+        self.out("Teardown finished!")
+        return success
+
+
+class SubscriberSession(_Session):
+
+    """
+    Counterpart of interface._SubscriberInterface.
+    Commands are executed on the loop as soon as they arrive.
+    """
+
+    entity_type = "subscriber"
+
+    def __init__(self, engine, intro, messenger, remote_ip):
+        super(SubscriberSession, self).__init__(engine, intro, messenger, remote_ip)
+        self.emitter = None  # type: EmitterSession
+        self.outlet = None  # type: AsyncOutlet
+        self.rc_task = None
+        self.commander = RemoteCommander(
+            messenger, master_name="SubSession-{}".format(self.ID),
+            tag="{}-{}:".format(self.entity_type, self.ID),
+            shutdown=self.teardown,
+            cars=lambda: ", ".join(self.engine.master.emitters),
+            connect=self.attach,
+            disconnect=self.detach,
+            stats=self.stats,
+            keyframe=lambda: self.emitter and self.emitter.request_keyframe(),
+            clock=lambda ID=None: clock_reply(getattr(self.engine.master.emitters.get(ID), "clock", None))
+        )
+
+    def activate(self):
+        self.messenger.on_message = self.commander.dispatch
+        # Commands, which arrived during the handshake
+        while self.messenger.recvbuffer:
+            self.commander.dispatch(self.messenger.recvbuffer.popleft())
+
+    async def forward(self, head, payload):
+        """Queues an encoded frame for the subscriber, see AsyncOutlet"""
+        if self.outlet is not None:
+            await self.outlet.put(head, payload)
+
+    async def _relay_rc(self, reader, writer):
+        while 1:
+            data = await reader.read(1 << 16)
+            if not data:
+                break
+            writer.write(data)
+
+    def attach(self, ID, *options):
+        """
+        :param options: key=value settings, eg. "fps=2 scale=4 policy=latest",
+         see hub.parse_subscriber_options
+        """
+        emitter = self.engine.master.emitters.get(ID)
+        if emitter is None:
+            return "no such emitter: {}".format(ID)
+        options, tier = parse_subscriber_options(*options)
+        if self.emitter is not None:
+            self.detach()
+        self.emitter = emitter
+        self.outlet = AsyncOutlet(self.streams["Data"][1], name="SubSession-{}".format(self.ID),
+                                  on_evict=self._evicted,
+                                  labels={"subscriber": self.ID, "emitter": ID}, **options)
+        key = Tier.key(**tier)
+        if key is None:
+            emitter.subscribers.add(self)
+            emitter.request_keyframe()
+        else:
+            emitter.join_tier(self, key)
+        self.rc_task = self.engine.loop.create_task(
+            self._relay_rc(self.streams["RC"][0], emitter.streams["RC"][1])
+        )
+        return "x".join(str(d) for d in Tier(**tier).shape(emitter.frameshape))
+
+    def detach(self):
+        if self.emitter is None:
+            return
+        self.emitter.subscribers.discard(self)
+        self.emitter.leave_tier(self)
+        self.outlet.close()
+        self.rc_task.cancel()
+        self.emitter = None
+        self.outlet = None
+        self.rc_task = None
+
+    def stats(self):
+        """The send queue statistics of the subscriber"""
+        if self.outlet is None:
+            return "not connected"
+        return "{} {}".format(self.emitter.ID, self.outlet.stats())
+
+    def _evicted(self):
+        # Ingest is iterating over a copy of the emitter's subscribers
+        self.messenger.teardown(0)
+        self.close()
+
+    def close(self):
+        self.detach()
+        metrics.REGISTRY.remove(subscriber=self.ID)
+        super(SubscriberSession, self).close()
+
+
+class AsyncEngine(object):
+
+    """
+    Drop-in replacement of the Aggregator's Listener.
+    Accepts and serves every connection on one asyncio loop, run in
+    a separate thread. The handshakes run concurrently. The data and
+    RC connections are matched to the pending handshake by the token
+    sent in the HELLO response (see emittance_common.handshake).
+    """
+
+    def __init__(self, master, codecs=CODEC_PREFERENCE, workers=DECODE_WORKERS,
+                 handshake_timeout=HANDSHAKE_TIMEOUT):
+        """
+        :param master: the Aggregator, its emitters and subscribers dicts are filled
+        :param codecs: codec specs in order of preference
+        :param workers: number of decoder threads
+        :param handshake_timeout: seconds allowed for completing a handshake
+        """
+        self.master = master
+        self.codecs = codecs
+        self.handshake_timeout = handshake_timeout
+        self.executor = ThreadPoolExecutor(workers, thread_name_prefix="Engine-Decoder")
+        self.pending = {}
+        self.loop = None
+        self.stopped = None
+        self.worker = None
+        self.error = None
+
+    def start(self):
+        """Returns once the engine listens, raises like Listener if it can't"""
+        if self.worker is not None:
+            print("ASYNC_ENGINE: Attempted start while already running!")
+            return
+        ready = thr.Event()
+        self.error = None
+        self.worker = thr.Thread(target=self._run, args=(ready,), name="Aggregator-Engine")
+        self.worker.start()
+        ready.wait()
+        if self.error is not None:
+            self.worker.join()
+            self.worker = None
+            raise self.error
+
+    def call(self, fn, *args):
+        """Schedules a callable on the loop, safe to use from any thread"""
+        if not self.loop.is_closed():
+            self.loop.call_soon_threadsafe(fn, *args)
+
+    def _run(self, ready):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        try:
+            self.loop.run_until_complete(self._serve(ready))
+        except Exception as E:
+            if ready.is_set():
+                raise
+            # Eg. the address can't be bound, start() raises it in the caller
+            self.error = E
+        finally:
+            ready.set()
+            self.loop.close()
+        print("ASYNC_ENGINE: Exiting...")
+
+    async def _serve(self, ready):
+        self.stopped = asyncio.Event()
+        handlers = ((MESSAGE_SERVER_PORT, self._on_messaging),
+                    (STREAM_SERVER_PORT, self._stream_handler("Data")),
+                    (RC_SERVER_PORT, self._stream_handler("RC")))
+        servers = []
+        try:
+            for port, handler in handlers:
+                servers.append(await asyncio.start_server(handler, self.master.ip, port,
+                                                          backlog=LISTEN_BACKLOG,
+                                                          reuse_address=True))
+            print("ASYNC_ENGINE: online")
+            ready.set()
+            await self.stopped.wait()
+        finally:
+            for server in servers:
+                server.close()
+        tasks = [t for t in asyncio.all_tasks() if t is not asyncio.current_task()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def _on_messaging(self, reader, writer):
+        started = time.perf_counter()
+        session = await self._handshake(reader, writer)
+        observe_handshake(started, session.entity_type if session is not None else None)
+
+    async def _handshake(self, reader, writer):
+        """:return: the registered session, None if the handshake failed"""
+        peer = writer.get_extra_info("peername")
+        print("ASYNC_ENGINE: received connection from {}:{}".format(*peer))
+        try:
+            raw = await asyncio.wait_for(reader.readuntil(SSEP), self.handshake_timeout)
+        except (asyncio.TimeoutError,) + STREAM_ERRORS:
+            print("ASYNC_ENGINE: didn't receive an introduction from", peer[0])
+            writer.close()
+            return
+        intro = Introduction(raw[:-len(SSEP)].decode("utf8"), self.codecs)
+        if not intro.valid() or not intro.parse():
+            print("ASYNC_ENGINE: invalid introduction:", intro.string)
+            writer.close()
+            return
+        messenger = AsyncMessaging(self.loop, reader, writer)
+        messenger.send(intro.response.encode())
+        session = {"emitter": EmitterSession,
+                   "subscriber": SubscriberSession
+                   }[intro.etype](self, intro, messenger, peer[0])
+        self.pending[intro.token] = session
+        messenger.start()
+        try:
+            await asyncio.wait_for(session.connected.wait(), self.handshake_timeout)
+        except asyncio.TimeoutError:
+            session.out("Data and RC connections didn't arrive in time!")
+            messenger.teardown()
+            session.close()
+            return
+        finally:
+            del self.pending[intro.token]
+        session.activate()
+        if intro.etype == "emitter":
+            self.master.register_emitter(session)
+        else:
+            self.master.subscribers[session.ID] = session
+        print("ASYNC_ENGINE: registered {} {}".format(intro.etype, session.ID))
+        return session
+
+    def _stream_handler(self, typ):
+        async def handler(reader, writer):
+            peer = writer.get_extra_info("peername")
+            try:
+                token = await asyncio.wait_for(reader.readexactly(TOKEN_SIZE), 1)
+            except (asyncio.TimeoutError,) + STREAM_ERRORS:
+                token = b""
+            session = self.pending.get(token.decode("ascii", "replace"))
+            if session is None or typ in session.streams:
+                print("ASYNC_ENGINE: rejected {} connection from {}:{}".format(typ, *peer))
+                writer.close()
+                return
+            session.attach_stream(typ, reader, writer)
+        return handler
+
+    def unregister(self, session):
+        registry = {"emitter": self.master.emitters,
+                    "subscriber": self.master.subscribers}[session.entity_type]
+        if registry.get(session.ID) is session:
+            del registry[session.ID]
+
+    def teardown(self, sleep=2):
+        if self.worker is None:
+            return
+        self.call(self.stopped.set)
+        self.worker.join(sleep or None)
+        self.executor.shutdown(wait=False)
+        self.worker = None
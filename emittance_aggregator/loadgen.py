@@ -0,0 +1,306 @@
+"""
+Load generator, used for capacity planning of the Aggregator.
+
+A fleet of emitters and subscribers is simulated on one host:
+- the emitters are TCPEntity instances, run by a separate process.
+  Every emitter binds EMITTER_PROBE_PORT on its own IP, so they listen
+  on loopback aliases following LOADGEN_NETWORK (127.0.1.1, 127.0.1.2...).
+  Linux routes the whole 127.0.0.0/8 to the loopback interface, on other
+  systems the aliases have to be configured first.
+- the subscribers are ServerConnections, run by another process and
+  attached to the emitters round-robin.
+- the Aggregator runs in this process, so its figures aren't skewed by
+  the fleet competing for the same interpreter lock.
+
+The fleet streams for a warmup period first, then the counters and the
+latency histograms are compared at the start and the end of the
+measurement window.
+"""
+
+import os
+import sys
+import time
+import ipaddress
+import multiprocessing
+import threading as thr
+
+from emittance_common.const import AGGREGATOR_ENGINE, LOADGEN_NETWORK, REPLAY_MODE
+from emittance_common.probeclient import Probe
+from emittance_common.synthetic import synthetic_source
+from emittance_common.util import Table
+from emittance_common import metrics
+
+# Time allowed for the emitters to connect and for the processes to report
+CONNECT_TIMEOUT = 30.
+REPORT_TIMEOUT = 10.
+
+
+def emitter_address(index, network=LOADGEN_NETWORK):
+    """The loopback alias of the <index>-th emitter, counting from 0"""
+    return str(ipaddress.IPv4Address(network) + index + 1)
+
+
+def latency_summary(histogram):
+    """Percentiles of a latency histogram in seconds, see metrics.Histogram"""
+    return {"count": histogram.count, "mean": histogram.mean,
+            "p50": histogram.quantile(.5), "p90": histogram.quantile(.9),
+            "p99": histogram.quantile(.99)}
+
+
+def _since(start, end, *histograms):
+    """The counters and the histograms of the <end> snapshot relative to <start>"""
+    delta = {k: v - start[k] for k, v in end.items() if k not in histograms}
+    for name in histograms:
+        end[name].add(start[name], sign=-1)
+        delta[name] = latency_summary(end[name])
+    return delta
+
+
+def _silence(quiet):
+    # The emitters print a line for every frame sent
+    if quiet:
+        sys.stdout = open(os.devnull, "w")
+
+
+def _capture_device(source, synthetic, seed, replay):
+    from emittance_emitter.component import CaptureDevice
+    if source is None:
+        return CaptureDevice(lambda: synthetic_source(synthetic, seed))
+    return CaptureDevice(dummyfile=source, mode=replay, loop=True)
+
+
+def _run_emitters(IDs, IPs, source, synthetic, replay, measure, stop, results, quiet):
+    """Target of the emitters' process"""
+    from emittance_emitter.entity import TCPEntity
+
+    _silence(quiet)
+    total = metrics.REGISTRY.total
+
+    def snapshot():
+        return {"frames": total("frames_sent"), "bytes": total("bytes_sent"),
+                "dropped": total("capture_dropped")}
+
+    workers = []
+    for seed, (ID, IP) in enumerate(zip(IDs, IPs)):
+        entity = TCPEntity(myID=ID, myIP=IP, eye=_capture_device(source, synthetic, seed, replay))
+        workers.append(thr.Thread(target=entity.mainloop, name="Emitter-" + ID, daemon=True))
+    for worker in workers:
+        worker.start()
+    measure.wait()
+    start = snapshot()
+    stop.wait()
+    results.put(("emitters", _since(start, snapshot())))
+    # The emitters exit when the Aggregator shuts them down
+    deadline = time.monotonic() + CONNECT_TIMEOUT
+    for worker in workers:
+        worker.join(max(0, deadline - time.monotonic()))
+
+
+def _run_subscribers(IDs, targets, serverIP, options, measure, stop, results, quiet):
+    """Target of the subscribers' process"""
+    from emittance_subscriber.indirect import ServerConnection
+
+    _silence(quiet)
+    consumed = metrics.counter("frames_consumed", "Frames yielded to the simulated subscribers")
+
+    def consume(connection):
+        for _ in connection.framestream():
+            consumed.inc()
+
+    def snapshot():
+        return {"frames": consumed.value,
+                "latency": metrics.REGISTRY.merged("capture_latency_seconds"),
+                "glass_to_glass": metrics.REGISTRY.merged("glass_to_glass_seconds")}
+
+    connections, workers = [], []
+    for ID, target in zip(IDs, targets):
+        connection = ServerConnection(serverIP, ID)
+        connection.request_car_connection(target, **options)
+        connections.append(connection)
+        workers.append(thr.Thread(target=consume, args=(connection,), name="Subscriber-" + ID))
+    for worker in workers:
+        worker.start()
+    results.put(("ready", len(connections)))
+    measure.wait()
+    start = snapshot()
+    stop.wait()
+    results.put(("subscribers", _since(start, snapshot(), "latency", "glass_to_glass")))
+    for connection in connections:
+        connection.teardown()
+    for worker in workers:
+        worker.join(1)
+
+
+class LoadGenerator(object):
+
+    """
+    Runs an Aggregator against a simulated fleet, see the module docstring.
+    """
+
+    def __init__(self, emitters=4, subscribers=4, engine=AGGREGATOR_ENGINE, source=None,
+                 synthetic="noise", replay=REPLAY_MODE, fps=None, options=None,
+                 serverIP="127.0.0.1", network=LOADGEN_NETWORK, quiet=True):
+        """
+        :param emitters: number of simulated emitters
+        :param subscribers: number of simulated subscribers
+        :param engine: engine of the Aggregator, "thread" or "async"
+        :param source: video file, image sequence (eg. frames/%04d.png) or image
+         directory replayed in a loop by every emitter, if not given, the frames
+         are synthetic
+        :param synthetic: spec of the synthetic source, eg. "pattern:1280x720:0.05",
+         see emittance_common.synthetic. Every emitter gets another seed.
+        :param replay: timing of the replayed source, eg. realtime, 4x, 30 or asap,
+         see emittance_emitter.replay. The emitters are still capped at <fps>.
+        :param fps: target frame rate of the emitters, defaults to FPS
+        :param options: settings of the subscriptions, eg. {"policy": "latest", "fps": 5},
+         see hub.parse_subscriber_options
+        :param serverIP: the address of the Aggregator
+        :param network: the emitters listen on the addresses following this one
+        :param quiet: if set, the output of the fleet is discarded
+        """
+        from emittance_emitter.replay import parse_mode
+
+        self.emitterIDs = ["E{}".format(i) for i in range(emitters)]
+        self.emitterIPs = [emitter_address(i, network) for i in range(emitters)]
+        self.subscriberIDs = ["S{}".format(i) for i in range(subscribers)]
+        self.engine = engine
+        self.source = source
+        self.synthetic = synthetic
+        self.replay = replay
+        # Fail early on an invalid spec
+        synthetic_source(synthetic)
+        parse_mode(replay)
+        self.fps = fps
+        self.options = dict(options or {})
+        self.serverIP = serverIP
+        self.quiet = quiet
+
+    def _snapshot(self):
+        registry = metrics.REGISTRY
+        return {"frames": registry.total("frames_received"),
+                "bytes": registry.total("bytes_received"),
+                "sent": registry.total("subscriber_frames_sent"),
+                "dropped": registry.total("subscriber_frames_dropped"),
+                "evicted": registry.total("subscribers_evicted"),
+                "latency": registry.merged("capture_latency_seconds"),
+                "forward": registry.merged("forward_seconds")}
+
+    def _connect_emitters(self, server):
+        deadline = time.monotonic() + CONNECT_TIMEOUT
+        while 1:
+            missing = [IP for ID, IP in zip(self.emitterIDs, self.emitterIPs)
+                       if ID not in server.emitters]
+            if not missing:
+                return
+            if time.monotonic() > deadline:
+                raise RuntimeError("{} of {} emitters didn't connect"
+                                   .format(len(missing), len(self.emitterIDs)))
+            list(Probe.sweep(*missing, msg=b"connect"))
+            time.sleep(1)
+
+    @staticmethod
+    def _receive(results, expected):
+        received = {}
+        deadline = time.monotonic() + REPORT_TIMEOUT
+        while expected - set(received):
+            kind, data = results.get(timeout=max(0, deadline - time.monotonic()))
+            received[kind] = data
+        return received
+
+    def run(self, duration=10., warmup=2.):
+        """
+        :param duration: length of the measurement window in seconds
+        :param warmup: seconds of streaming before the measurement
+        :return: the results, see report()
+        """
+        from emittance_aggregator.server import Aggregator
+
+        context = multiprocessing.get_context("spawn")
+        measure, stop, results = context.Event(), context.Event(), context.Queue()
+        targets = [self.emitterIDs[i % len(self.emitterIDs)] for i in range(len(self.subscriberIDs))]
+        fleet = [context.Process(target=_run_emitters, name="Loadgen-Emitters",
+                                 args=(self.emitterIDs, self.emitterIPs, self.source,
+                                       self.synthetic, self.replay, measure, stop, results,
+                                       self.quiet))]
+        fleet[0].start()
+        server = Aggregator(self.serverIP, engine=self.engine, registry=None)
+        try:
+            self._connect_emitters(server)
+            for ifc in server.emitters.values():
+                if self.fps is not None:
+                    ifc.send("fps {}".format(self.fps).encode())
+                ifc.send(b"stream on")
+            if self.subscriberIDs:
+                fleet.append(context.Process(
+                    target=_run_subscribers, name="Loadgen-Subscribers",
+                    args=(self.subscriberIDs, targets, self.serverIP, self.options,
+                          measure, stop, results, self.quiet)
+                ))
+                fleet[1].start()
+                results.get(timeout=CONNECT_TIMEOUT)
+            time.sleep(warmup)
+            start = self._snapshot()
+            measure.set()
+            started = time.perf_counter()
+            time.sleep(duration)
+            end = self._snapshot()
+            window = time.perf_counter() - started
+            stop.set()
+            received = self._receive(results, {"emitters", "subscribers"} if self.subscriberIDs
+                                     else {"emitters"})
+        finally:
+            measure.set()
+            stop.set()
+            server.shutdown()
+            for process in fleet:
+                process.join(REPORT_TIMEOUT)
+                if process.is_alive():
+                    process.terminate()
+        return {
+            "config": {"emitters": len(self.emitterIDs), "subscribers": len(self.subscriberIDs),
+                       "engine": self.engine,
+                       "source": "{} ({})".format(self.source, self.replay) if self.source
+                       else self.synthetic,
+                       "fps": self.fps, "options": self.options},
+            "window": window,
+            "emitters": received["emitters"],
+            "aggregator": _since(start, end, "latency", "forward"),
+            "subscribers": received.get("subscribers"),
+        }
+
+    @staticmethod
+    def report(results):
+        """
+        Human-readable summary of the results of run(): frame rates and
+        bitrates summed over the fleet, latency percentiles and drops.
+        """
+        window = results["window"]
+        rate = lambda stage: "{:.1f}".format(stage["frames"] / window)
+        mbit = lambda stage: "{:.2f}".format(stage["bytes"] * 8 / window / 1e6)
+        ms = lambda latency, q: "{:.1f}".format(latency[q] * 1000) if latency["count"] else "-"
+        emitters, aggregator, subscribers = (results[k] for k in ("emitters", "aggregator", "subscribers"))
+
+        tab = Table(["stage", "FPS", "Mbit/s", "p50 ms", "p90 ms", "p99 ms", "dropped"],
+                    [28, 9, 9, 8, 8, 8, 9])
+        tab.add("emitters sent", rate(emitters), mbit(emitters), "-", "-", "-", emitters["dropped"])
+        latency = aggregator["latency"]
+        tab.add("aggregator received", rate(aggregator), mbit(aggregator),
+                ms(latency, "p50"), ms(latency, "p90"), ms(latency, "p99"), "-")
+        forward = aggregator["forward"]
+        tab.add("aggregator forwarded", "{:.1f}".format(aggregator["sent"] / window), "-",
+                ms(forward, "p50"), ms(forward, "p90"), ms(forward, "p99"), aggregator["dropped"])
+        if subscribers is not None:
+            for name, key, fps in (("subscribers received", "latency", rate(subscribers)),
+                                   ("subscribers glass-to-glass", "glass_to_glass", "-")):
+                latency = subscribers[key]
+                tab.add(name, fps, "-", ms(latency, "p50"), ms(latency, "p90"), ms(latency, "p99"), "-")
+
+        config = results["config"]
+        header = ("Load test: {emitters} emitters, {subscribers} subscribers, {engine} engine, "
+                  "{source}".format(**config))
+        lines = [header, "Measured for {:.1f} s".format(window), tab.get(),
+                 "Latencies are measured from the capture of the frames, "
+                 "forwarding from their arrival on the Aggregator."]
+        if aggregator["evicted"]:
+            lines.append("Subscribers evicted: {}".format(aggregator["evicted"]))
+        return "\n".join(lines)
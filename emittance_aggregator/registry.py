@@ -0,0 +1,92 @@
+import os
+import json
+import threading as thr
+from datetime import datetime
+
+from emittance_common.const import EMITTER_REGISTRY
+
+
+class EmitterRegistry(object):
+
+    """
+    On-disk record of the emitters known to the Aggregator, so they
+    can be reconnected after a restart without sweeping the network.
+    Stored as JSON:
+    {"emitters": {ID: {"ip", "frameshape", "codec", "last_seen"}}}
+    The file is rewritten atomically on every change.
+    """
+
+    def __init__(self, path=EMITTER_REGISTRY):
+        """
+        :param path: location of the registry file, None keeps it in memory only
+        """
+        self.path = os.path.expanduser(path) if path else None
+        self.lock = thr.Lock()
+        self.emitters = {}
+        self.load()
+
+    def load(self):
+        if self.path is None or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path) as handle:
+                self.emitters = json.load(handle)["emitters"]
+        except (OSError, ValueError, KeyError) as E:
+            print("REGISTRY: unable to read {}: {}".format(self.path, E))
+            return
+        print("REGISTRY: loaded {} known emitters".format(len(self.emitters)))
+
+    def save(self):
+        if self.path is None:
+            return
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        temp = self.path + ".tmp"
+        try:
+            with open(temp, "w") as handle:
+                json.dump({"emitters": self.emitters}, handle, indent=1, sort_keys=True)
+            os.replace(temp, self.path)
+        except OSError as E:
+            print("REGISTRY: unable to write {}: {}".format(self.path, E))
+
+    def record(self, ifc):
+        """Stores the details of a freshly connected emitter interface"""
+        with self.lock:
+            self.emitters[ifc.ID] = {
+                "ip": ifc.remote_ip,
+                "frameshape": list(ifc.frameshape),
+                "codec": ifc.codec,
+                "last_seen": datetime.now().isoformat(timespec="seconds")
+            }
+            self.save()
+
+    def touch(self, *IDs):
+        """Updates the last-seen time of connected emitters"""
+        now = datetime.now().isoformat(timespec="seconds")
+        with self.lock:
+            for ID in IDs:
+                if ID in self.emitters:
+                    self.emitters[ID]["last_seen"] = now
+            self.save()
+
+    def forget(self, ID):
+        with self.lock:
+            if self.emitters.pop(ID, None) is None:
+                return False
+            self.save()
+            return True
+
+    def addresses(self, *IDs):
+        """
+        :return: {ID: last known IP} of the supplied or of all known emitters
+        """
+        with self.lock:
+            return {ID: entry["ip"] for ID, entry in self.emitters.items()
+                    if not IDs or ID in IDs}
+
+    def __contains__(self, ID):
+        return ID in self.emitters
+
+    def __len__(self):
+        return len(self.emitters)
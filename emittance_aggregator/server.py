@@ -1,9 +1,15 @@
 # stdlib imports
 import time
+import threading as thr
 from datetime import datetime
 
 # project imports
 from .component import Listener, Console
+from .engine import AsyncEngine
+from .registry import EmitterRegistry
+
+from emittance_common.const import AGGREGATOR_ENGINE, EMITTER_REGISTRY, METRICS_PORT
+from emittance_common import metrics
 
 from emittance_common.subsystem import StreamDisplayer
 from emittance_common.util import Table
@@ -19,17 +25,29 @@ class Aggregator(object):
     - Console is run in the main thread, waiting for and parsing input commands.
     - Listener is listening for incomming emitter connections in a separate thread.
     It also coordinates the creation and validation of new emitter interfaces.
+    Alternatively AsyncEngine serves every connection on a single asyncio loop.
     - EmitterInterface instances are stored in the .emitters dictionary.
+    - EmitterRegistry remembers the emitters across restarts. The known
+    emitters are asked to reconnect when the server starts.
     - StreamDisplayer objects can be attached to EmitterInterface objects and
     are run in a separate thread each.
     - Aggregator itself is responsible for sending commands to EmitterInterfaces
     and to coordinate the shutdown of the emitters on this side, etc.
     """
 
-    def __init__(self, myIP):
+    def __init__(self, myIP, engine=AGGREGATOR_ENGINE, registry=EMITTER_REGISTRY,
+                 metrics_port=METRICS_PORT):
+        """
+        :param myIP: the local IP address to listen on
+        :param engine: "thread" for the Listener, "async" for AsyncEngine
+        :param registry: path of the known emitters' registry, None disables persistence
+        :param metrics_port: port of the metrics endpoint (see metrics.MetricsServer),
+         None disables it
+        """
         self.ip = myIP
-        self.clients = {}
+        self.subscribers = {}
         self.emitters = {}
+        self.registry = EmitterRegistry(registry)
         self.watchers = {}
         self.since = datetime.now()
 
@@ -39,21 +57,40 @@ class Aggregator(object):
             status_tag=self.status,
             commands_dict={
                 "emitters": self.printout_emitters,
+                "subscribers": self.printout_subscribers,
                 "kill": self.kill_emitter,
                 "watch": self.watch_emitter,
                 "unwatch": self.stop_watch,
+                "record": self.record,
+                "stoprecord": self.stop_record,
                 "shutdown": self.shutdown,
                 "status": self.report,
+                "stats": self.stats,
                 "message": self.message,
                 "probe": self.probe,
                 "connect": Probe.initiate,
-                "sweep": self.sweep
+                "sweep": self.sweep,
+                "discover": self.discover,
+                "known": self.printout_known,
+                "forget": self.forget_emitter,
+                "reconnect": self.start_reconnect
             }
         )
 
-        self.listener = Listener(self)
+        metrics.gauge("emitters_connected", "Number of connected emitters",
+                      function=lambda: len(self.emitters))
+        metrics.gauge("subscribers_connected", "Number of connected subscribers",
+                      function=lambda: len(self.subscribers))
+        self.metrics_server = None
+        if metrics_port is not None:
+            self.metrics_server = metrics.MetricsServer(metrics_port).start()
+
+        self.listener = {"thread": Listener,
+                         "async": AsyncEngine}[engine](self)
         self.listener.start()
         print("AGGREGATOR: online")
+        if len(self.registry):
+            self.start_reconnect()
 
     def mainloop(self):
         self.console.mainloop()
@@ -62,11 +99,71 @@ class Aggregator(object):
         """List the current emitter-connections"""
         print("Emitters online:\n{}\n".format("\n".join(self.emitters)))
 
+    def printout_subscribers(self, *args):
+        """List the subscribers with the statistics of their send queues"""
+        print("Subscribers online:\n{}\n".format("\n".join(
+            "{}: {}".format(ID, ifc.stats()) for ID, ifc in list(self.subscribers.items())
+        )))
+
+    def register_emitter(self, ifc):
+        """Called by the listener with every new emitter interface"""
+        self.emitters[ifc.ID] = ifc
+        self.registry.record(ifc)
+
+    def printout_known(self, *args):
+        """List the emitters in the registry"""
+        if not len(self.registry):
+            print("[known]: the registry is empty")
+            return
+        entries = self.registry.emitters
+        tab = Table(["ID", "last IP", "frameshape", "codec", "last seen", "status"],
+                    [max(len(ID) for ID in entries) + 2, 3*5, 13, 10, 21, 9])
+        for ID in sorted(entries):
+            entry = entries[ID]
+            tab.add(ID, entry["ip"], "x".join(map(str, entry["frameshape"])), entry["codec"],
+                    entry["last_seen"], "online" if ID in self.emitters else "-")
+        print(tab.get())
+
+    def forget_emitter(self, ID, *args):
+        """Removes an emitter from the registry"""
+        if not self.registry.forget(ID):
+            print("SERVER: {} is not in the registry".format(ID))
+
+    def reconnect(self, *IDs):
+        """
+        Asks the known (or the supplied) emitters to connect, all at once.
+        Emitters not found at their last address are looked for with discovery.
+        """
+        known = {ID: IP for ID, IP in self.registry.addresses(*IDs).items()
+                 if ID not in self.emitters}
+        if not known:
+            return
+        print("SERVER: reconnecting {} known emitters...".format(len(known)))
+        reached = {ID for IP, ID in Probe.sweep(*set(known.values()), msg=b"connect")
+                   if ID is not None}
+        missing = set(known) - reached
+        if missing:
+            moved = [IP for IP, ID, _, _ in Probe.discover(self.ip) if ID in missing]
+            reached |= {ID for IP, ID in Probe.sweep(*moved, msg=b"connect")
+                        if ID is not None}
+        missing = set(known) - reached
+        print("SERVER: {}/{} known emitters answered{}".format(
+            len(known) - len(missing), len(known),
+            "" if not missing else ", missing: " + ", ".join(sorted(missing))
+        ))
+
+    def start_reconnect(self, *IDs):
+        """
+        Asks the known (or the supplied) emitters to connect in the background,
+        the sweep and the discovery take a while. See reconnect().
+        """
+        thr.Thread(target=self.reconnect, args=IDs, name="Aggregator-Reconnect",
+                   daemon=True).start()
+
     @staticmethod
     def probe(*ips):
         """Probe the supplied ip address(es)"""
-        IDs = dict(Probe.probe(*ips))
-        for ID, IP in IDs.items():
+        for IP, ID in Probe.probe(*ips):
             print("{:<15}: {}".format(IP, ID if ID else "-"))
 
     def message(self, ID, *msgs):
@@ -75,25 +172,40 @@ class Aggregator(object):
 
     @staticmethod
     def sweep(*ips):
-        """Probe the supplied ip addresses and print the formatted results"""
-
-        def get_status(dID):
-            status = ""
-            if dID is None:
-                status = "offline"
-            else:
-                status = "available"
-            return status
-
+        """
+        Probe the supplied ip addresses, ranges (192.168.1.*) or
+        networks (192.168.0.0/16) and print the emitters found
+        """
         if not ips:
             print("[sweep]: please specify an IP address range!")
             return
-        IDs = dict(Probe.probe(*ips))
+        found, probed = {}, 0
+        for IP, ID in Probe.sweep(*ips):
+            probed += 1
+            if ID is not None:
+                print("[sweep]: {} @ {}".format(ID, IP))
+                found[IP] = ID
+        print("[sweep]: {} of {} addresses answered".format(len(found), probed))
+        if not found:
+            return
         tab = Table(["IP", "ID", "status"],
-                    [3*5, max(len(v) for v in IDs.values()), 11])
-        for IP, ID in IDs.items():
-            tab.add(IP, ID, get_status(ID))
+                    [3*5, max(len(ID) for ID in found.values()) + 2, 11])
+        for IP in sorted(found, key=lambda ip: tuple(map(int, ip.split(".")))):
+            tab.add(IP, found[IP], "available")
+        print(tab.get())
 
+    def discover(self, *args):
+        """Find the idle emitters with a single multicast (or broadcast, if supplied) datagram"""
+        kw = {"address": args[0]} if args else {}
+        found = Probe.discover(self.ip, **kw)
+        if not found:
+            print("[discover]: no emitters answered")
+            return
+        tab = Table(["IP", "ID", "frameshape", "codecs"],
+                    [3*5, max(len(f[1]) for f in found) + 2, 13,
+                     max(len(",".join(f[3])) for f in found) + 2])
+        for IP, ID, frameshape, codecs in sorted(found):
+            tab.add(IP, ID, frameshape, ",".join(codecs))
         print(tab.get())
 
     def kill_emitter(self, ID, *args):
@@ -105,7 +217,8 @@ class Aggregator(object):
             self.stop_watch(ID)
         success = self.emitters[ID].teardown(sleep=1)
         if success:
-            del self.emitters[ID]
+            # The async engine unregisters closed sessions itself
+            self.emitters.pop(ID, None)
 
     def watch_emitter(self, ID, *args):
         """Launches the stream display in a separate thread"""
@@ -128,15 +241,43 @@ class Aggregator(object):
         self.watchers[ID].teardown(sleep=1)
         del self.watchers[ID]
 
+    def record(self, ID, *args):
+        """
+        Records the stream of an emitter to segmented files, as received.
+        See emittance_common.recording
+        """
+        if ID not in self.emitters:
+            print("SERVER: no such emitter:", ID)
+            return
+        ifc = self.emitters[ID]
+        if ifc.recorder is not None:
+            print("SERVER: already recording {}: {}".format(ID, ifc.recorder.stats()))
+            return
+        ifc.record()
+        ifc.send(b"stream on")
+
+    def stop_record(self, ID, *args):
+        """Stops recording the stream of an emitter, the stream itself goes on"""
+        ifc = self.emitters.get(ID)
+        if ifc is None or ifc.recorder is None:
+            print("SERVER: {} is not being recorded!".format(ID))
+            return
+        stats = ifc.recorder.stats()
+        ifc.stop_recording()
+        print("SERVER: stopped recording {}: {}".format(ID, stats))
+
     def shutdown(self, *args):
         """Shuts the server down, terminating all threads nicely"""
 
-        self.listener.teardown(1)
+        self.registry.touch(*self.emitters)
+
+        for ID in list(self.subscribers):
+            self.subscribers.pop(ID).teardown(0)
 
         rounds = 0
         while self.emitters:
             print("SERVER: Emitter corpse collection round {}/{}".format(rounds+1, 4))
-            for ID in self.emitters:
+            for ID in list(self.emitters):
                 if ID in self.watchers:
                     self.stop_watch(ID)
                 self.kill_emitter(ID)
@@ -149,6 +290,10 @@ class Aggregator(object):
         else:
             print("SERVER: All emitters shut down correctly!")
 
+        # The async engine serves the emitters' connections, so it goes last
+        self.listener.teardown(1)
+        if self.metrics_server is not None:
+            self.metrics_server.teardown()
         print("SERVER: Exiting...")
 
     def report(self, *args):
@@ -158,9 +303,36 @@ class Aggregator(object):
         repchain = "FIPER Server @ {}\n".format(self.ip)
         repchain += "-" * (len(repchain) - 1) + "\n"
         repchain += "Up since " + self.since.strftime("%Y.%m.%d %H:%M:%S") + "\n"
-        repchain += "Emitters online: {}\n".format(len(self.emitters))
+        value = metrics.REGISTRY.value
+        repchain += "Emitters online: {}\n".format(value("emitters_connected"))
+        repchain += "Subscribers online: {}\n".format(value("subscribers_connected"))
+        repchain += "Threads running: {}\n".format(value("threads"))
+        recorded = sorted(ID for ID, ifc in list(self.emitters.items()) if ifc.recorder is not None)
+        repchain += "Recording: {}\n".format(", ".join(recorded) or "-")
+        if self.emitters:
+            tab = Table(["ID", "FPS", "Mbit/s", "frames", "subscribers", "dropped"],
+                        [max(len(ID) for ID in self.emitters) + 2, 7, 8, 9, 13, 9])
+            for ID in sorted(self.emitters):
+                subscribed = [m for m in metrics.REGISTRY.collect(ID)
+                              if m.name == "subscriber_frames_dropped"]
+                tab.add(ID, "{:.1f}".format(value("fps", emitter=ID)),
+                        "{:.1f}".format(value("bits_per_second", emitter=ID) / 1e6),
+                        value("frames_received", emitter=ID), len(subscribed),
+                        sum(m.value for m in subscribed))
+            repchain += tab.get() + "\n"
         print("\n" + repchain + "\n")
 
+    def stats(self, ID=None, *args):
+        """
+        Prints the metrics of the server, or the ones of an emitter or
+        subscriber. The metrics recorded by an emitter are requested from it.
+        """
+        print(metrics.REGISTRY.report(ID))
+        if ID in self.emitters:
+            remote = self.emitters[ID].messenger.request(b"stats", timeout=2) or "no response"
+            tag = "emitter-{}:".format(ID)
+            print("Reported by {}:\n{}".format(ID, remote[len(tag):] if remote.startswith(tag) else remote))
+
     def __enter__(self):
         """Context enter method"""
         return self
@@ -4,6 +4,7 @@ import socket
 import subprocess
 
 from .routine import srvsock
+from .handshake import StreamMatcher
 
 
 class AbstractCommander(object):
@@ -36,7 +37,7 @@ class AbstractCommander(object):
         self.master_name = master_name
         self.status_tag = status_tag
         self.commands = {}
-        self.commands.update(commands_dict)
+        self.commands.update(commands_dict or {})
         self.commands.update(commands)
 
         if "help" not in self.commands:
@@ -89,9 +90,13 @@ class AbstractCommander(object):
                 print("CONSOLE: command [{}] raised: {}"
                       .format(cmd, str(E)))
         self.running = False
-        self.commands["shutdown"](*args)
+        self.finish(*args)
         print("ABS_COMMANDER Exiting...")
 
+    def finish(self, *args):
+        """Called when the main loop ends, runs the shutdown command by default"""
+        self.commands["shutdown"](*args)
+
     @abc.abstractmethod
     def read_cmd(self):
         raise NotImplementedError
@@ -111,6 +116,69 @@ class AbstractCommander(object):
             self.teardown()
 
 
+class RemoteCommander(AbstractCommander):
+
+    """
+    A console, which reads its commands from a Messaging channel.
+    Commands sent as requests (see Messaging.request) are answered
+    with the return value of the command, or "ok" if it returned None.
+    """
+
+    def __init__(self, messenger, master_name, tag="", **kw):
+        """
+        :param messenger: the Messaging instance to read the commands from
+        :param tag: the remote's message tag, stripped from the commands
+        """
+        AbstractCommander.__init__(self, master_name, **kw)
+        self.messenger = messenger
+        self.tag = tag
+        self.current = None
+
+    def parse(self, m):
+        """Splits a message into the command and its arguments"""
+        if self.tag and m.startswith(self.tag):
+            m = m[len(self.tag):]
+        m = m.split(" ")
+        return m[0].lower(), m[1:]
+
+    def read_cmd(self):
+        m = self.messenger.recv(timeout=1)
+        self.current = m
+        if m is None:
+            return None, ()
+        return self.parse(m)
+
+    def dispatch(self, m):
+        """
+        Executes a single message as a command, without the mainloop.
+        Used when the messages are pushed to the commander (e.g. by an event loop).
+        """
+        self.current = m
+        cmd, args = self.parse(m)
+        try:
+            self.cmd_parser(cmd, *args)
+        except Exception as E:
+            print("CONSOLE: command [{}] raised: {}".format(cmd, str(E)))
+
+    def respond(self, *msgs):
+        """Answers the command being executed, see Messaging.reply()"""
+        self.messenger.reply(self.current, *msgs)
+
+    def cmd_parser(self, cmd, *args):
+        if getattr(self.current, "rid", None) is None:
+            return super(RemoteCommander, self).cmd_parser(cmd, *args)
+        if cmd not in self.commands:
+            print("CONSOLE: Unknown command:", cmd)
+            self.respond("unknown command: {}".format(cmd).encode())
+            return
+        try:
+            result = self.commands[cmd](*args)
+        except Exception as E:
+            self.respond("error: {}".format(E).encode())
+            raise
+        self.respond(b"ok" if result is None else str(result).encode())
+
+
 class AbstractListener(object):
 
     """
@@ -124,6 +192,7 @@ class AbstractListener(object):
         self.mlistener = srvsock(myIP, "messaging", timeout=3)
         self.dlistener = srvsock(myIP, "stream")
         self.rclistener = srvsock(myIP, "rc", timeout=1)
+        self.matcher = StreamMatcher(self.dlistener, self.rclistener)
         self.running = False
 
     @abc.abstractmethod
@@ -141,6 +210,11 @@ class AbstractListener(object):
                 conn, addr = self.mlistener.accept()
             except socket.timeout:
                 pass
+            except OSError:
+                # teardown() closed the socket under accept()
+                if self.running:
+                    raise
+                break
             else:
                 print("ABS_LISTENER: received connection from {}:{}"
                       .format(*addr))
@@ -0,0 +1,164 @@
+"""
+Clock offset estimation between two entities, NTP-style.
+
+Frames are stamped with the capture time (time.time()) on the emitter.
+To tell how old a frame is on another host, the receiver estimates the
+offset of the remote clock by sending "clock" requests over Messaging:
+
+    t0: request sent (local clock)
+    t:  the remote's time in the reply (remote clock)
+    t1: reply received (local clock)
+
+Assuming the reply spent half of the round trip on the way back,
+offset = t - (t0 + t1) / 2. Of several exchanges the one with the
+shortest round trip is kept, since it was delayed the least by
+queueing on either side.
+
+Offsets are chained across the Aggregator: its reply to "clock {ID}"
+also carries the offset of the emitter <ID>, so a subscriber can convert
+the capture timestamps of the forwarded frames to its own clock.
+"""
+
+import time
+import threading as thr
+
+from .const import CLOCK_SAMPLES, CLOCK_SYNC_INTERVAL
+from . import metrics
+
+
+def clock_reply(source=None):
+    """
+    Answer of the clock command: the local time, followed by
+    the offset of the <source> ClockSync, if it is known.
+    """
+    now = "{:.6f}".format(time.time())
+    if source is None or not source.synced:
+        return now
+    return "{} {:.6f}".format(now, source.offset + source.source_offset)
+
+
+class ClockSync(thr.Thread):
+
+    """
+    Keeps estimating the offset of the remote clock (remote - local)
+    in the background, every <interval> seconds.
+    """
+
+    def __init__(self, messenger, name, request=b"clock", samples=CLOCK_SAMPLES,
+                 interval=CLOCK_SYNC_INTERVAL, labels=None):
+        """
+        :param messenger: Messaging channel of the remote, which answers the request
+        :param name: used in the thread's name and the printouts
+        :param request: the clock command, see clock_reply()
+        :param samples: number of ping exchanges per estimate
+        :param interval: seconds between the estimates, the clocks drift
+        :param labels: labels of the offset metrics, eg. {"emitter": "E0"}
+        """
+        super(ClockSync, self).__init__(name="Clock-of-{}".format(name), daemon=True)
+        self.messenger = messenger
+        self.request = request
+        self.samples = samples
+        self.interval = interval
+        self.offset = 0.
+        self.source_offset = 0.
+        self.rtt = None
+        self.synced = False
+        self.stopped = thr.Event()
+        self.wakeup = thr.Event()
+        self.peer = name
+        if labels is not None:
+            metrics.gauge("clock_offset_seconds", "Estimated offset of the remote clock",
+                          function=lambda: self.offset, **labels)
+            metrics.gauge("clock_rtt_seconds", "Round trip of the clock estimate",
+                          function=lambda: self.rtt or 0., **labels)
+
+    def sync(self, timeout=1.):
+        """
+        Estimates the offset with <samples> exchanges.
+        :return: whether the estimate was updated
+        """
+        best = None
+        request = self.request
+        for _ in range(self.samples):
+            if not self.messenger.running:
+                break
+            sent = time.time()
+            reply = self.messenger.request(request, timeout)
+            received = time.time()
+            if reply is None:
+                continue
+            try:
+                fields = [float(f) for f in reply.rpartition(":")[2].split()]
+            except ValueError:
+                print("CLOCK: invalid reply from {}: {}".format(self.peer, reply))
+                return False
+            rtt = received - sent
+            if best is None or rtt < best[0]:
+                best = rtt, fields[0] - (sent + received) / 2, sum(fields[1:2])
+        if best is None or request != self.request:
+            # The estimate belongs to the source before a resync()
+            return False
+        self.rtt, self.offset, self.source_offset = best
+        self.synced = True
+        return True
+
+    def to_local(self, timestamp):
+        """Converts a capture timestamp of the source to the local clock"""
+        return timestamp - self.offset - self.source_offset
+
+    def age(self, timestamp):
+        """Seconds since the capture of a frame, by the local clock"""
+        return time.time() - self.to_local(timestamp)
+
+    def run(self):
+        while self.messenger.running and not self.stopped.is_set():
+            first = not self.synced
+            if self.sync() and first:
+                print("CLOCK: {} offset {:+.2f} ms, round trip {:.2f} ms".format(
+                    self.peer, (self.offset + self.source_offset) * 1000, self.rtt * 1000))
+            self.wakeup.wait(self.interval)
+            self.wakeup.clear()
+
+    def resync(self, request=None):
+        """
+        Starts a new estimate without waiting for the interval,
+        eg. after the source behind the remote changed.
+        :param request: the new clock command, if it changed
+        """
+        if request is not None:
+            self.request = request
+            self.synced = False
+        self.wakeup.set()
+
+    def teardown(self, sleep=0):
+        self.stopped.set()
+        self.wakeup.set()
+        time.sleep(sleep)
+
+
+class FrameLatency(object):
+
+    """
+    The age of the frames of a stream by the local clock, recorded on
+    their arrival (capture_latency_seconds) and once they are decoded
+    (glass_to_glass_seconds). Nothing is recorded until <clock> is synced.
+    """
+
+    def __init__(self, clock, **labels):
+        """
+        :param clock: ClockSync of the remote, which converts the capture timestamps
+        :param labels: labels of the histograms, eg. emitter="E0"
+        """
+        self.clock = clock
+        self.arrival = metrics.histogram(
+            "capture_latency_seconds", "Time from the capture of a frame to its arrival", **labels)
+        self.display = metrics.histogram(
+            "glass_to_glass_seconds", "Time from the capture of a frame to its decoding", **labels)
+
+    def arrived(self, header):
+        if self.clock.synced:
+            self.arrival.observe(self.clock.age(header.timestamp))
+
+    def displayed(self, header):
+        if self.clock.synced:
+            self.display.observe(self.clock.age(header.timestamp))
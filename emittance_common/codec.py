@@ -0,0 +1,249 @@
+"""
+Registry of the frame codecs.
+
+Every codec has a unique numeric ID, which is transmitted in the frame
+header, so the receiver can always decode a frame, regardless of what
+was negotiated in the handshake. Codecs are referred to by name in the
+handshake. A codec spec may carry a compression level: "zlib:6".
+"""
+
+import bz2
+import lzma
+import zlib
+
+import numpy as np
+
+from .const import CODEC_LEVELS, CODEC_PREFERENCE
+
+try:
+    import cv2
+except ImportError:
+    cv2 = None
+
+# Output chunk size used when inflating into a preallocated buffer
+INFLATE_CHUNK = 1 << 16
+
+CODECS = {}
+_BY_ID = {}
+_DECODERS = {}
+
+
+def register(cls):
+    """Class decorator, adds a codec class to the registry"""
+    if cls.ID in _BY_ID:
+        raise RuntimeError("Codec ID {} is already taken by {}"
+                           .format(cls.ID, _BY_ID[cls.ID].name))
+    CODECS[cls.name] = cls
+    _BY_ID[cls.ID] = cls
+    return cls
+
+
+class Codec(object):
+
+    """
+    Base class of the frame codecs.
+    Subclasses implement encode() and either decode_into() or
+    _decompressor(), which returns an incremental decompressor object.
+    """
+
+    ID = None
+    name = ""
+    lossless = True
+
+    def __init__(self, level=None):
+        self.level = CODEC_LEVELS.get(self.name) if level is None else level
+
+    @staticmethod
+    def available():
+        return True
+
+    @property
+    def spec(self):
+        return self.name if self.level is None else "{}:{}".format(self.name, self.level)
+
+    def encode(self, frame):
+        raise NotImplementedError
+
+    def decode(self, payload, shape, dtype):
+        out = np.empty(shape, dtype=dtype)
+        self.decode_into(payload, out)
+        return out
+
+    def decode_into(self, payload, out):
+        """
+        Decompresses the payload straight into the preallocated output buffer,
+        in bounded chunks, so no frame-sized temporary is created.
+        :param payload: bytes-like object holding the compressed frame
+        :param out: C-contiguous numpy array or bytearray to fill
+        """
+        view = memoryview(out).cast("B")
+        decompressor = self._decompressor()
+        pos, data = 0, payload
+        while pos < len(view):
+            chunk = decompressor.decompress(data, min(INFLATE_CHUNK, len(view) - pos))
+            if not chunk:
+                break
+            view[pos:pos + len(chunk)] = chunk
+            pos += len(chunk)
+            data = getattr(decompressor, "unconsumed_tail", b"")
+        if pos != len(view):
+            raise RuntimeError("{}: payload decompressed to {} bytes instead of {}"
+                               .format(self.name, pos, len(view)))
+
+    def _decompressor(self):
+        raise NotImplementedError
+
+
+@register
+class RawCodec(Codec):
+
+    ID = 0
+    name = "raw"
+
+    def encode(self, frame):
+        return frame.tobytes()
+
+    def decode_into(self, payload, out):
+        memoryview(out).cast("B")[:] = payload
+
+
+@register
+class GzipCodec(Codec):
+
+    """The original codec of the stream. Gzip framing around zlib."""
+
+    ID = 1
+    name = "gzip"
+
+    def encode(self, frame):
+        compressor = zlib.compressobj(self.level, zlib.DEFLATED, zlib.MAX_WBITS | 16)
+        return compressor.compress(frame) + compressor.flush()
+
+    def _decompressor(self):
+        return zlib.decompressobj(zlib.MAX_WBITS | 16)
+
+
+@register
+class ZlibCodec(Codec):
+
+    ID = 2
+    name = "zlib"
+
+    def encode(self, frame):
+        return zlib.compress(frame, self.level)
+
+    def _decompressor(self):
+        return zlib.decompressobj()
+
+
+@register
+class LzmaCodec(Codec):
+
+    ID = 3
+    name = "lzma"
+
+    def encode(self, frame):
+        return lzma.compress(frame, preset=self.level)
+
+    def _decompressor(self):
+        return lzma.LZMADecompressor()
+
+
+@register
+class Bz2Codec(Codec):
+
+    ID = 4
+    name = "bz2"
+
+    def encode(self, frame):
+        return bz2.compress(frame, self.level)
+
+    def _decompressor(self):
+        return bz2.BZ2Decompressor()
+
+
+class _ImageCodec(Codec):
+
+    """Image codecs through OpenCV, only usable if cv2 is importable"""
+
+    extension = ""
+    flag = None
+
+    @staticmethod
+    def available():
+        return cv2 is not None
+
+    def encode(self, frame):
+        params = [] if self.flag is None else [getattr(cv2, self.flag), self.level]
+        success, encoded = cv2.imencode(self.extension, frame, params)
+        if not success:
+            raise RuntimeError("{}: unable to encode frame of shape {}"
+                               .format(self.name, frame.shape))
+        return encoded.tobytes()
+
+    def decode_into(self, payload, out):
+        decoded = cv2.imdecode(np.frombuffer(payload, dtype=np.uint8), cv2.IMREAD_UNCHANGED)
+        if decoded is None:
+            raise RuntimeError("{}: unable to decode frame".format(self.name))
+        out[...] = decoded.reshape(out.shape)
+
+
+@register
+class JpegCodec(_ImageCodec):
+
+    ID = 5
+    name = "jpeg"
+    lossless = False
+    extension = ".jpg"
+    flag = "IMWRITE_JPEG_QUALITY"
+
+
+@register
+class PngCodec(_ImageCodec):
+
+    ID = 6
+    name = "png"
+    extension = ".png"
+    flag = "IMWRITE_PNG_COMPRESSION"
+
+
+def available_codecs():
+    """Names of the codecs usable in this environment"""
+    return [name for name, cls in sorted(CODECS.items(), key=lambda it: it[1].ID)
+            if cls.available()]
+
+
+def get_codec(spec, level=None):
+    """
+    Instantiates a codec from its spec, e.g. "zlib" or "zlib:6".
+    """
+    name, _, speclevel = spec.partition(":")
+    if name not in CODECS or not CODECS[name].available():
+        raise RuntimeError("Unavailable codec: {}".format(name))
+    if speclevel:
+        level = int(speclevel)
+    return CODECS[name](level)
+
+
+def codec_by_id(ID):
+    """Returns a shared, default-configured codec instance for decoding"""
+    if ID not in _DECODERS:
+        if ID not in _BY_ID:
+            raise RuntimeError("Unknown codec ID: {}".format(ID))
+        _DECODERS[ID] = _BY_ID[ID]()
+    return _DECODERS[ID]
+
+
+def negotiate(offered, preference=CODEC_PREFERENCE):
+    """
+    Picks the first codec of the local preference list, which is
+    also offered by the remote end.
+    :param offered: codec names advertised by the remote
+    :param preference: codec specs in order of preference
+    :return: the chosen codec spec, or None if there is no common codec
+    """
+    for spec in preference:
+        name = spec.partition(":")[0]
+        if name in offered and name in CODECS and CODECS[name].available():
+            return spec
+    return None
@@ -11,6 +11,95 @@ PORTS = {"m": 1234, "d": 1235, "rc": 1232}
 # Stream's tick time:
 FPS = 15
 
+# Emitter pipeline: number of encoder threads, size of the queues
+# between the capture, encode and send stages and what to do with
+# frames when a queue is full (see emittance_common.queues)
+ENCODER_WORKERS = 2
+PIPELINE_QUEUE_SIZE = 4
+DROP_POLICY = "drop-oldest"
+
+# Number of preallocated frame buffers on the receiving side
+RECV_POOL_SIZE = 4
+
+# Codecs, in order of the receiver's preference. See emittance_common.codec
+# A spec may contain the compression level, e.g. "zlib:6"
+CODEC_PREFERENCE = ("zlib", "gzip", "raw")
+# Default compression levels (JPEG quality for jpeg)
+CODEC_LEVELS = {"gzip": 9, "zlib": 1, "lzma": 1, "bz2": 9, "jpeg": 90, "png": 3}
+
+# Delta coding: a keyframe is sent every KEYFRAME_INTERVAL frames,
+# XOR deltas in between. 0 turns delta coding off.
+KEYFRAME_INTERVAL = 0
+
+# Aggregator core: "thread" (a thread per connection) or "async" (one asyncio loop)
+AGGREGATOR_ENGINE = "thread"
+# Threads decoding frames for the async engine
+DECODE_WORKERS = 2
+# Seconds allowed for an entity to finish the handshake
+HANDSHAKE_TIMEOUT = 10
+# Handshakes served concurrently by the threaded Listener
+HANDSHAKE_WORKERS = 16
+# Length of the connection backlog of the listening sockets
+LISTEN_BACKLOG = 64
+# Length of the token, which matches the data and RC connections to their handshake
+TOKEN_SIZE = 16
+
+# Network sweep: number of probes in flight and the deadline of one probe in seconds
+PROBE_CONCURRENCY = 256
+PROBE_TIMEOUT = 0.5
+
+# UDP discovery: idle emitters answer "discover" datagrams sent to the
+# multicast group (or to a broadcast address) on DISCOVERY_PORT.
+# Replies are collected for DISCOVERY_TIMEOUT seconds.
+DISCOVERY_PORT = 1236
+DISCOVERY_GROUP = "239.255.12.36"
+DISCOVERY_TIMEOUT = 1.
+
+# Known emitters are stored here and reconnected when the Aggregator starts
+EMITTER_REGISTRY = "~/.emittance/emitters.json"
+# Fan-out hub of the threaded Aggregator: number of recent encoded frames
+# kept for joining subscribers and the queue size of every subscriber
+HUB_RING_SIZE = 16
+HUB_OUTLET_SIZE = 8
+# Slow-consumer policy of the subscribers, one of:
+# block, drop-oldest, latest, disconnect (see emittance_common.hub).
+# A subscriber lagging SUBSCRIBER_MAX_LAG seconds behind is disconnected
+# under the block and disconnect policies.
+SUBSCRIBER_POLICY = "drop-oldest"
+SUBSCRIBER_MAX_LAG = 5.
+# Forwarder: bytes moved by one relay step (the kernel pipe is grown to
+# this size if allowed) and "splice", "copy" or None to choose by platform
+RELAY_CHUNK = 1 << 20
+RELAY_MODE = None
+# Prometheus-style metrics endpoint: None disables it. The emitter's
+# port is separate, so both may run on the same host.
+METRICS_HOST = "127.0.0.1"
+METRICS_PORT = None
+EMITTER_METRICS_PORT = None
+METRICS_PREFIX = "emittance_"
+# Clock offset estimation (see emittance_common.clock): ping exchanges
+# per estimate and the seconds between the estimates
+CLOCK_SAMPLES = 8
+CLOCK_SYNC_INTERVAL = 30.
+# Load generator: the simulated emitters listen on the addresses following
+# this one (127.0.1.1, 127.0.1.2, ...), see emittance_aggregator.loadgen
+LOADGEN_NETWORK = "127.0.1.0"
+# Synthetic frame sources (see emittance_common.synthetic): default frame
+# shape and the number of precomputed frames of the noise source
+DUMMY_FRAMESIZE = (480, 640, 3)  # = 921,600 B in uint8
+NOISE_BANK_SIZE = 8
+# Replay of video files and image directories by the emitters (see
+# emittance_emitter.replay): "realtime", "<speed>x", "<fps>" or "asap",
+# and whether the replay restarts at the end of the file
+REPLAY_MODE = "realtime"
+REPLAY_LOOP = True
+# Stream recording on the Aggregator (see emittance_common.recording): the
+# directory of the recordings, segment length in seconds and the number of
+# frames queued for writing, before the oldest ones are dropped
+RECORDING_DIR = "~/.emittance/recordings"
+RECORDING_SEGMENT = 60.
+RECORDING_QUEUE = 64
+
 # Standard RGB data type, 0-255 unsigned int
 DTYPE = np.uint8
 SSEP = b"ROGER"
@@ -0,0 +1,277 @@
+"""
+Binary framing of the video stream.
+
+Every frame travels as a fixed-size header followed by the payload:
+
+    magic | version | codec | flags | dtype | length | seq | timestamp | shape
+
+The receiver reads exactly one header, then exactly <length> bytes,
+so parsing is linear in the stream size and the payload may contain
+arbitrary bytes.
+"""
+
+import socket
+import struct
+from collections import namedtuple
+
+import numpy as np
+
+from .const import KEYFRAME_INTERVAL
+from .codec import RawCodec, codec_by_id
+
+FRAME_MAGIC = b"EMTF"
+FRAME_VERSION = 1
+
+# magic, version, codec, flags, dtype, payload length, sequence number,
+# capture timestamp, shape (3 dimensions, unused ones are zero)
+HEADER = struct.Struct("!4sBBBBIId3I")
+HEADER_SIZE = HEADER.size
+
+# Header flags. Frames without FLAG_DELTA are self-contained.
+FLAG_KEYFRAME = 1  # reference frame of a delta-coded sequence
+FLAG_DELTA = 2  # XOR against the previous frame of the sequence
+
+SEQ_MASK = 0xFFFFFFFF
+
+# Dtypes are transmitted as an index into this tuple
+DTYPES = ("uint8", "uint16", "int16", "float32", "float64")
+
+FrameHeader = namedtuple(
+    "FrameHeader", ["version", "codec", "flags", "dtype", "length", "seq", "timestamp", "shape"]
+)
+
+
+def pack_header(length, seq, timestamp, shape, dtype, codec, flags=0):
+    """
+    :param length: size of the payload following the header in bytes
+    :param seq: sequence number of the frame
+    :param timestamp: capture time of the frame (time.time())
+    :param shape: shape of the decoded frame, 2 or 3 dimensions
+    :param dtype: data type of the decoded frame
+    :param codec: ID of the codec used to compress the payload (see codec.py)
+    :param flags: bit flags describing the payload
+    """
+    dims = tuple(shape) + (0,) * (3 - len(shape))
+    return HEADER.pack(FRAME_MAGIC, FRAME_VERSION, codec, flags,
+                       DTYPES.index(np.dtype(dtype).name), length,
+                       seq & SEQ_MASK, timestamp, *dims)
+
+
+def unpack_header(buffer):
+    magic, version, codec, flags, dtype, length, seq, timestamp, *dims = HEADER.unpack(buffer)
+    if magic != FRAME_MAGIC:
+        raise RuntimeError("Invalid frame magic: {}".format(bytes(magic)))
+    if version != FRAME_VERSION:
+        raise RuntimeError("Unsupported frame version: {}".format(version))
+    shape = tuple(d for d in dims if d)
+    return FrameHeader(version, codec, flags, np.dtype(DTYPES[dtype]),
+                       length, seq, timestamp, shape)
+
+
+def pack_frame(payload, seq, timestamp, shape, dtype, codec, flags=0):
+    return pack_header(len(payload), seq, timestamp, shape, dtype, codec, flags) + payload
+
+
+def recv_into_exactly(sock, view):
+    """
+    Fills the supplied memoryview (or bytearray) from the socket.
+    Partial reads are continued, so the stream never loses sync.
+    """
+    view = memoryview(view)
+    got, size = 0, len(view)
+    while got < size:
+        try:
+            n = sock.recv_into(view[got:])
+        except socket.timeout:
+            continue
+        if not n:
+            raise ConnectionError("remote end closed the stream")
+        got += n
+
+
+def recv_exactly(sock, size):
+    buffer = bytearray(size)
+    recv_into_exactly(sock, buffer)
+    return buffer
+
+
+def read_frame(sock):
+    """
+    Reads exactly one frame from the socket.
+    :return: tuple of (FrameHeader, payload bytearray)
+    """
+    header = unpack_header(recv_exactly(sock, HEADER_SIZE))
+    return header, recv_exactly(sock, header.length)
+
+
+def read_raw_frame(sock, head=None):
+    """
+    Reads exactly one frame without taking it apart, e.g. for forwarding.
+    :param head: the header of the frame, if it was already read
+    :return: tuple of (FrameHeader, bytearray holding the header and the payload)
+    """
+    if head is None:
+        head = recv_exactly(sock, HEADER_SIZE)
+    header = unpack_header(head)
+    frame = bytearray(HEADER_SIZE + header.length)
+    frame[:HEADER_SIZE] = head
+    recv_into_exactly(sock, memoryview(frame)[HEADER_SIZE:])
+    return header, frame
+
+
+class FramePool(object):
+
+    """
+    Ring of preallocated frame buffers for the receiving side.
+    Headers and payloads are read into reused buffers with recv_into,
+    then decompressed straight into the next frame buffer of the ring,
+    so steady-state reception allocates no frame-sized objects.
+
+    A frame obtained from the pool is only valid until the ring wraps
+    around, consumers have to copy frames they want to keep.
+    """
+
+    def __init__(self, shape, dtype, size=4):
+        """
+        :param shape: frame shape announced in the handshake
+        :param dtype: frame data type
+        :param size: number of frame buffers in the ring
+        """
+        self.frames = [np.empty(shape, dtype=dtype) for _ in range(size)]
+        self.header = bytearray(HEADER_SIZE)
+        self.payload = bytearray(self.frames[0].nbytes)
+        self.index = 0
+
+    def _next_frame(self, header):
+        frame = self.frames[self.index]
+        if frame.shape != header.shape or frame.dtype != header.dtype:
+            # The remote changed resolution, reallocate this slot once
+            frame = np.empty(header.shape, dtype=header.dtype)
+            self.frames[self.index] = frame
+        self.index = (self.index + 1) % len(self.frames)
+        return frame
+
+    def read_frame(self, sock):
+        """
+        Reads exactly one frame from the socket into the pool.
+        :return: tuple of (FrameHeader, numpy array owned by the pool)
+        """
+        recv_into_exactly(sock, self.header)
+        header = unpack_header(self.header)
+        frame = self._next_frame(header)
+        if header.codec == RawCodec.ID and header.length == frame.nbytes:
+            recv_into_exactly(sock, memoryview(frame).cast("B"))
+            return header, frame
+        if len(self.payload) < header.length:
+            self.payload = bytearray(header.length)
+        payload = memoryview(self.payload)[:header.length]
+        recv_into_exactly(sock, payload)
+        codec_by_id(header.codec).decode_into(payload, frame)
+        return header, frame
+
+
+class DeltaEncoder(object):
+
+    """
+    Inter-frame delta coding on the sending side.
+    Every <interval>-th frame is sent as a keyframe, the ones
+    in between as the XOR against the previous frame, which
+    compresses well for mostly static scenes.
+    """
+
+    def __init__(self, interval=KEYFRAME_INTERVAL):
+        """
+        :param interval: keyframe interval in frames, 0 turns delta coding off
+        """
+        self.interval = interval
+        self.reference = None
+        self.delta = None
+        self.since_keyframe = 0
+        self.keyframe_requested = False
+
+    def request_keyframe(self):
+        """The next frame will be a keyframe. Safe to call from any thread."""
+        self.keyframe_requested = True
+
+    def reset(self):
+        self.reference = None
+
+    def _keyframe_due(self, frame):
+        return (self.keyframe_requested or
+                self.reference is None or
+                self.reference.shape != frame.shape or
+                self.since_keyframe >= self.interval)
+
+    def apply(self, frame, lossless=True, out=None):
+        """
+        :param frame: the next frame of the sequence
+        :param lossless: delta coding is only done for lossless codecs,
+         otherwise the coding errors would accumulate on the receiver
+        :param out: array to write the delta into. Defaults to an
+         internal buffer, which is reused on the next call.
+        :return: tuple of (array to encode, header flags)
+        """
+        if self.interval <= 0 or not lossless:
+            self.reference = None
+            return frame, 0
+        if self._keyframe_due(frame):
+            self.keyframe_requested = False
+            self.since_keyframe = 1
+            if self.reference is None or self.reference.shape != frame.shape:
+                self.reference = np.empty_like(frame)
+                self.delta = np.empty_like(frame)
+            np.copyto(self.reference, frame)
+            return frame, FLAG_KEYFRAME
+        if out is None or out.shape != frame.shape:
+            out = self.delta
+        np.bitwise_xor(frame, self.reference, out=out)
+        np.copyto(self.reference, frame)
+        self.since_keyframe += 1
+        return out, FLAG_DELTA
+
+
+class DeltaDecoder(object):
+
+    """
+    Rebuilds delta-coded frames on the receiving side.
+    Delta frames are XOR-ed into the previous frame in place.
+    If the chain is broken (late join, lost frame), delta frames
+    are dropped and <on_missing_keyframe> is called once, until the
+    next keyframe arrives.
+    """
+
+    def __init__(self, on_missing_keyframe=None):
+        self.reference = None
+        self.last_seq = None
+        self.on_missing_keyframe = on_missing_keyframe
+        self.awaiting_keyframe = False
+
+    def _chain_broken(self, header, frame):
+        return (self.reference is None or
+                self.reference.shape != frame.shape or
+                header.seq != (self.last_seq + 1) & SEQ_MASK)
+
+    def apply(self, header, frame):
+        """
+        :param header: FrameHeader of the frame
+        :param frame: decoded frame, modified in place if it is a delta
+        :return: the reconstructed frame, or None if it can't be rebuilt
+        """
+        if not header.flags & (FLAG_KEYFRAME | FLAG_DELTA):
+            self.reference = None
+            return frame
+        if header.flags & FLAG_DELTA:
+            if self._chain_broken(header, frame):
+                self.reference = None
+                if not self.awaiting_keyframe and self.on_missing_keyframe is not None:
+                    self.on_missing_keyframe()
+                self.awaiting_keyframe = True
+                return None
+            np.bitwise_xor(frame, self.reference, out=frame)
+        else:
+            self.awaiting_keyframe = False
+        if self.reference is None or self.reference.shape != frame.shape:
+            self.reference = np.empty_like(frame)
+        np.copyto(self.reference, frame)
+        self.last_seq = header.seq
+        return frame
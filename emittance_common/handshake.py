@@ -0,0 +1,115 @@
+import time
+import socket
+import secrets
+import threading as thr
+
+from .const import TOKEN_SIZE, HANDSHAKE_TIMEOUT
+
+
+def new_token():
+    """A random token of TOKEN_SIZE hexadecimal characters"""
+    return secrets.token_hex(TOKEN_SIZE // 2)
+
+
+def send_token(sock, token):
+    """Identifies a freshly connected data or RC socket to the listener"""
+    sock.sendall(token.encode())
+
+
+def read_token(sock, timeout=1.):
+    """
+    Reads the token, which a data or RC connection starts with.
+    :return: the token, or None if it didn't arrive in time
+    """
+    sock.settimeout(timeout)
+    data = b""
+    try:
+        while len(data) < TOKEN_SIZE:
+            chunk = sock.recv(TOKEN_SIZE - len(data))
+            if not chunk:
+                return None
+            data += chunk
+    except (socket.timeout, OSError):
+        return None
+    return data.decode("ascii", "replace")
+
+
+class StreamMatcher(object):
+
+    """
+    Matches the inbound data and RC connections to the pending
+    handshakes. Every handshake gets a token in the HELLO response,
+    which the remote sends first on its data and RC connections.
+
+    There is no accepting thread: the handshakes waiting for their
+    streams take turns in accepting. A connection belonging to another
+    handshake is parked for it, so the order of arrival doesn't matter.
+    """
+
+    def __init__(self, dlistener, rclistener):
+        """
+        :param dlistener: server socket awaiting data connections
+        :param rclistener: server socket awaiting RC connections
+        """
+        self.listeners = {"Data": dlistener, "RC": rclistener}
+        self.accepting = {"Data": thr.Lock(), "RC": thr.Lock()}
+        self.expected = set()
+        self.arrived = {}
+        self.lock = thr.Condition()
+        for listener in self.listeners.values():
+            # Bounds the turn of a handshake in accepting
+            listener.settimeout(0.5)
+
+    def expect(self, token):
+        """Registers a token. Must be called before the token is sent to the remote."""
+        with self.lock:
+            self.expected.add(token)
+
+    def discard(self, token):
+        """Forgets a token and closes the connections parked for it"""
+        with self.lock:
+            self.expected.discard(token)
+            for typ in self.listeners:
+                parked = self.arrived.pop((token, typ), None)
+                if parked is not None:
+                    parked[0].close()
+
+    def _accept_one(self, typ):
+        try:
+            conn, addr = self.listeners[typ].accept()
+        except socket.timeout:
+            return
+        token = read_token(conn)
+        with self.lock:
+            if token not in self.expected or (token, typ) in self.arrived:
+                print("STREAM_MATCHER: rejected {} connection from {}:{}, token: {}"
+                      .format(typ, addr[0], addr[1], token))
+                conn.close()
+                return
+            conn.settimeout(None)
+            self.arrived[token, typ] = conn, addr
+            self.lock.notify_all()
+
+    def wait(self, token, typ, timeout=HANDSHAKE_TIMEOUT):
+        """
+        Blocks until the connection of type <typ> identified by <token> arrives.
+        :return: the connected socket and the remote address
+        :raise: socket.timeout if it didn't arrive in <timeout> seconds
+        """
+        deadline = time.monotonic() + timeout
+        while 1:
+            with self.lock:
+                parked = self.arrived.pop((token, typ), None)
+            if parked is not None:
+                return parked
+            if time.monotonic() > deadline:
+                raise socket.timeout("no {} connection with token {}".format(typ, token))
+            if self.accepting[typ].acquire(blocking=False):
+                try:
+                    self._accept_one(typ)
+                finally:
+                    self.accepting[typ].release()
+            else:
+                # Another handshake is accepting, it will park our connection
+                with self.lock:
+                    self.lock.wait_for(lambda: (token, typ) in self.arrived, 0.1)
@@ -0,0 +1,467 @@
+import time
+import socket
+import threading as thr
+from collections import deque
+
+import numpy as np
+
+from .const import HUB_RING_SIZE, HUB_OUTLET_SIZE, SUBSCRIBER_POLICY, SUBSCRIBER_MAX_LAG
+from .codec import codec_by_id
+from .framing import (
+    HEADER_SIZE, FLAG_KEYFRAME, FLAG_DELTA, DeltaDecoder, pack_frame, unpack_header
+)
+from .queues import FrameQueue, DROP_OLDEST, LATEST, POLICIES
+from . import metrics
+
+# Slow-consumer policy of outlets on top of the FrameQueue policies:
+# frames are dropped like with drop-oldest, but the outlet is
+# disconnected once it lags max_lag seconds behind the stream.
+DISCONNECT = "disconnect"
+OUTLET_POLICIES = POLICIES + (DISCONNECT,)
+
+
+def parse_subscriber_options(*args):
+    """
+    Parses the key=value options of a subscriber's connect command.
+    Recognized keys: policy, lag (seconds), queue (frames) of the send
+    queue, fps and scale of the tier (see Tier).
+    :return: tuple of (Outlet keyword arguments, Tier keyword arguments)
+    """
+    options, tier = {}, {}
+    for arg in filter(None, args):
+        key, sep, value = arg.partition("=")
+        if not sep:
+            raise ValueError("Invalid option: {}. Expected key=value".format(arg))
+        if key == "policy":
+            if value not in OUTLET_POLICIES:
+                raise ValueError("Invalid policy: {}. Expected one of: {}"
+                                 .format(value, ", ".join(OUTLET_POLICIES)))
+            options["policy"] = value
+        elif key == "lag":
+            options["max_lag"] = float(value)
+        elif key == "queue":
+            options["maxsize"] = int(value)
+        elif key == "fps":
+            tier["fps"] = float(value)
+            if tier["fps"] <= 0:
+                raise ValueError("Invalid fps: {}".format(value))
+        elif key == "scale":
+            tier["scale"] = int(value)
+            if tier["scale"] < 1:
+                raise ValueError("Invalid scale: {}".format(value))
+        else:
+            raise ValueError("Unknown option: {}".format(key))
+    return options, tier
+
+
+def outlet_metrics(labels, queued, sent, dropped):
+    """
+    Declares the metrics of a subscriber's send queue, shared by
+    Outlet and the async engine's AsyncOutlet.
+    :param labels: labels of the metrics, eg. {"subscriber": "S0", "emitter": "E0"}
+    :param queued, sent, dropped: functions returning the current figures
+    :return: the forward_seconds histogram and the subscribers_evicted counter,
+     which is kept per emitter, so it outlives the subscribers
+    """
+    metrics.gauge("subscriber_queue_depth", "Frames queued for the subscriber",
+                  function=queued, **labels)
+    metrics.gauge("subscriber_frames_sent", "Frames sent to the subscriber",
+                  function=sent, **labels)
+    metrics.gauge("subscriber_frames_dropped", "Frames dropped for the subscriber",
+                  function=dropped, **labels)
+    forward_time = metrics.histogram(
+        "forward_seconds", "Time from the arrival of a frame to its sending", **labels)
+    evictions = metrics.counter(
+        "subscribers_evicted", "Subscribers disconnected for lagging behind",
+        **{k: v for k, v in labels.items() if k != "subscriber"})
+    return forward_time, evictions
+
+
+class StreamMetrics(object):
+
+    """
+    Metrics of an emitter's stream on the Aggregator, shared by both
+    engines. Instances of the same emitter share the metrics.
+    """
+
+    def __init__(self, ID):
+        label = {"emitter": ID}
+        self.frames = metrics.counter("frames_received", "Frames received from the emitter", **label)
+        self.received = metrics.counter("bytes_received", "Bytes received from the emitter", **label)
+        self.recv_time = metrics.histogram(
+            "recv_seconds", "Time from the arrival of a header to the end of its payload", **label)
+        self.fps = metrics.meter("fps", "Frames received per second", **label)
+        self.bitrate = metrics.meter("bits_per_second", "Bitrate of the received stream", **label)
+        self.decode_time = metrics.histogram("decode_seconds", "Time spent decoding a frame", **label)
+        self.render_time = metrics.histogram(
+            "render_seconds", "Time spent rendering a frame of a tier", **label)
+
+    def mark(self, size):
+        """Counts a received frame of <size> bytes, header included"""
+        self.frames.inc()
+        self.received.inc(size)
+        self.fps.mark()
+        self.bitrate.mark(8 * size)
+
+
+class Tier(object):
+
+    """
+    A reduced version of a stream, shared by the subscribers asking for it:
+    at most fps frames per second (decimated by capture time) and every
+    scale-th pixel in both directions (stride slicing).
+    The frames of a tier are re-encoded with the stream's codec as
+    keyframes, so a subscriber can start and drop frames anywhere.
+    """
+
+    def __init__(self, fps=None, scale=1):
+        """
+        :param fps: maximal frame rate, None keeps every frame
+        :param scale: downscale factor
+        """
+        self.fps = fps
+        self.scale = scale
+        self.interval = 1. / fps if fps else 0.
+        self.due = 0.
+        self.consumers = []
+
+    @staticmethod
+    def key(fps=None, scale=1):
+        """Tiers are identified by their settings, None for the full stream"""
+        if fps is None and scale == 1:
+            return None
+        return fps, scale
+
+    def shape(self, frameshape):
+        s = self.scale
+        return tuple(-(-d // s) for d in frameshape[:2]) + tuple(frameshape[2:])
+
+    def take(self, header):
+        """Decides whether the frame is forwarded in this tier"""
+        if header.timestamp < self.due:
+            return False
+        # Half an interval of slack, so a late frame doesn't make the next one skipped
+        self.due = max(self.due + self.interval, header.timestamp + self.interval / 2)
+        return True
+
+    def render(self, header, frame):
+        """
+        :return: (FrameHeader, bytes) of the reduced and re-encoded frame
+        """
+        s = self.scale
+        small = np.ascontiguousarray(frame[::s, ::s]) if s > 1 else frame
+        payload = codec_by_id(header.codec).encode(small)
+        packed = pack_frame(payload, header.seq, header.timestamp, small.shape,
+                            small.dtype, header.codec, FLAG_KEYFRAME)
+        return unpack_header(packed[:HEADER_SIZE]), packed
+
+    def __str__(self):
+        return "fps={} scale={}".format(self.fps or "full", self.scale)
+
+
+class Outlet(object):
+
+    """
+    A consumer of a FanoutHub.
+    The hub queues every frame as a (FrameHeader, buffer) tuple, where
+    buffer holds the encoded frame with its header, exactly as it was
+    received. The same buffer is shared by every outlet, read-only.
+    Each outlet has its own bounded queue and slow-consumer policy, so
+    a lagging outlet only loses its own frames.
+    """
+
+    def __init__(self, name, maxsize=HUB_OUTLET_SIZE, policy=SUBSCRIBER_POLICY,
+                 max_lag=SUBSCRIBER_MAX_LAG, labels=None):
+        """
+        :param name: used in the printouts
+        :param maxsize: number of frames queued for the outlet
+        :param policy: one of OUTLET_POLICIES
+        :param max_lag: seconds of lag, after which a block or disconnect
+         outlet is evicted from the hub
+        :param labels: labels of the outlet's metrics, None disables them
+        """
+        if policy not in OUTLET_POLICIES:
+            raise ValueError("Invalid policy: {}. Expected one of: {}"
+                             .format(policy, ", ".join(OUTLET_POLICIES)))
+        self.name = name
+        self.policy = policy
+        self.max_lag = max_lag
+        self.queue = FrameQueue(maxsize, DROP_OLDEST if policy == DISCONNECT else policy)
+        self.sent = 0
+        self.evicted = False
+        self.forward_time = None
+        self.evictions = None
+        if labels is not None:
+            self._instrument(labels)
+
+    def _instrument(self, labels):
+        self.forward_time, self.evictions = outlet_metrics(
+            labels, queued=lambda: len(self.queue), sent=lambda: self.sent,
+            dropped=lambda: self.dropped)
+
+    @property
+    def dropped(self):
+        return self.queue.dropped
+
+    def lag(self):
+        """Seconds the outlet is behind the stream"""
+        return self.queue.lag()
+
+    def put(self, entry):
+        """
+        Called by the hub with every frame.
+        A block outlet holds up the hub until it has room for the frame,
+        but at most for max_lag seconds.
+        :return: False if the outlet should be evicted
+        """
+        if self.policy == DISCONNECT and self.lag() > self.max_lag:
+            return False
+        return self.queue.put(entry, timeout=self.max_lag)
+
+    def evict(self):
+        self.evicted = True
+        self.queue.close()
+        if self.evictions is not None:
+            self.evictions.inc()
+
+    def stats(self):
+        return "policy={} sent={} dropped={} queued={} lag={:.2f}".format(
+            self.policy, self.sent, self.dropped, len(self.queue), self.lag()
+        )
+
+    def teardown(self, sleep=0):
+        self.queue.close()
+
+
+class SocketOutlet(Outlet):
+
+    """
+    Sends the frames of a FanoutHub to a socket in a separate thread.
+    The shared buffers are handed to sendall() as memoryviews, so
+    forwarding makes no copies.
+    """
+
+    def __init__(self, sock, name, on_evict=None, **kw):
+        """
+        :param sock: connected socket of the consumer
+        :param on_evict: called (in the hub's thread) if the outlet is evicted
+        :param kw: see Outlet
+        """
+        super(SocketOutlet, self).__init__(name, **kw)
+        self.sock = sock
+        self.on_evict = on_evict
+        self.sending_since = None
+        self.worker = thr.Thread(target=self.run, name=name + "-Outlet")
+        self.worker.start()
+
+    def run(self):
+        while 1:
+            item = self.queue.get(stamped=True)
+            if item is None:
+                break
+            stamp, (header, buffer) = item
+            self.sending_since = time.monotonic()
+            try:
+                self.sock.sendall(memoryview(buffer))
+            except OSError as E:
+                if not self.evicted:
+                    print("OUTLET {}: send failed: {}".format(self.name, E))
+                break
+            finally:
+                self.sending_since = None
+            self.sent += 1
+            if self.forward_time is not None:
+                self.forward_time.observe(time.monotonic() - stamp)
+        # The hub removes closed outlets
+        self.queue.close()
+
+    def lag(self):
+        """A consumer, which stopped reading, blocks sendall() while the queue is refreshed"""
+        since = self.sending_since
+        stalled = 0. if since is None else time.monotonic() - since
+        return max(stalled, super(SocketOutlet, self).lag())
+
+    def evict(self):
+        print("OUTLET {}: lagging behind by {:.1f} s, disconnecting ({})"
+              .format(self.name, self.lag(), self.stats()))
+        super(SocketOutlet, self).evict()
+        try:
+            # Unblocks the sender
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        if self.on_evict is not None:
+            self.on_evict()
+
+    def teardown(self, sleep=0):
+        super(SocketOutlet, self).teardown(sleep)
+        self.worker.join(max(sleep, 1))
+
+
+class FanoutHub(thr.Thread):
+
+    """
+    Reads the stream of an emitter once and distributes the encoded
+    frames to any number of outlets (subscriber sockets, local viewers).
+    Outlets may join and leave while the stream runs. The most recent
+    frames are kept in a ring, so a joining outlet starts at the last
+    keyframe instead of waiting for the next one.
+    Outlets may also join a Tier of the stream. Tiers are rendered by
+    a separate thread, which decodes the stream once for all of them.
+    """
+
+    def __init__(self, emi_ifc, ring_size=HUB_RING_SIZE):
+        """
+        :param emi_ifc: EmitterInterface instance, its data socket is read by the hub
+        :param ring_size: number of recent frames kept for joining outlets
+        """
+        super(FanoutHub, self).__init__(name="Hub-of-{}".format(emi_ifc.ID))
+        self.interface = emi_ifc
+        self.ring = deque(maxlen=ring_size)
+        self.outlets = []
+        self.tiers = {}
+        self.tier_worker = None
+        self.lock = thr.Lock()
+        self.received = 0
+        self.stream_metrics = StreamMetrics(emi_ifc.ID)
+
+    def run(self):
+        for entry in self.interface.rawstream():
+            self.received += 1
+            with self.lock:
+                self.ring.append(entry)
+                outlets = list(self.outlets)
+            self._distribute(outlets, entry)
+        with self.lock:
+            outlets, self.outlets = self.outlets, []
+            for tier in self.tiers.values():
+                outlets.extend(tier.consumers)
+            self.tiers = {}
+        for outlet in outlets:
+            outlet.queue.close()
+        self.interface.out("Hub exiting...")
+
+    def _distribute(self, outlets, entry):
+        for outlet in outlets:
+            if not outlet.put(entry):
+                self.remove(outlet)
+                if not outlet.queue.closed:
+                    # Timed out blocking or lagged too much, not torn down
+                    outlet.evict()
+
+    def _render(self, outlet):
+        """Thread of the tiers. Exits when the last tier is left."""
+        for header, frame in self._decoded(outlet):
+            with self.lock:
+                if not self.tiers:
+                    self.tier_worker = None
+                    break
+                tiers = [(tier, list(tier.consumers)) for tier in self.tiers.values()]
+            for tier, consumers in tiers:
+                if tier.take(header):
+                    with self.stream_metrics.render_time.time():
+                        entry = tier.render(header, frame)
+                    self._distribute(consumers, entry)
+        self.remove(outlet)
+        outlet.teardown()
+
+    def _backlog(self):
+        """The frames from the last keyframe on, or the last frame if it is self-contained"""
+        for i in range(len(self.ring) - 1, -1, -1):
+            if not self.ring[i][0].flags & FLAG_DELTA:
+                return list(self.ring)[i:]
+        return None
+
+    def add(self, outlet, fps=None, scale=1):
+        """
+        Joins an outlet to the stream or to one of its tiers.
+        :param fps, scale: settings of the tier, see Tier
+        :return: the outlet
+        """
+        key = Tier.key(fps, scale)
+        if key is not None:
+            return self._add_to_tier(outlet, key)
+        with self.lock:
+            backlog = self._backlog() if self.ring else []
+            # A latest outlet would only keep the last frame of the backlog
+            room = 1 if outlet.queue.policy == LATEST else outlet.queue.maxsize
+            if backlog is not None and len(backlog) <= room:
+                for entry in backlog:
+                    outlet.queue.put(entry)
+            else:
+                backlog = None
+            self.outlets.append(outlet)
+        if backlog is None:
+            # The joining outlet couldn't decode the deltas in the ring
+            self.interface.request_keyframe()
+        return outlet
+
+    def _add_to_tier(self, outlet, key):
+        with self.lock:
+            if key not in self.tiers:
+                self.tiers[key] = Tier(*key)
+            self.tiers[key].consumers.append(outlet)
+            start = self.tier_worker is None
+            if start:
+                self.tier_worker = thr.Thread(
+                    target=self._render, args=(self._join_decoder(),),
+                    name="Hub-of-{}-Tiers".format(self.interface.ID)
+                )
+        if start:
+            self.tier_worker.start()
+        return outlet
+
+    def _join_decoder(self):
+        # Called with the lock held
+        outlet = Outlet("Decoder", policy=DROP_OLDEST)
+        self.outlets.append(outlet)
+        return outlet
+
+    def remove(self, outlet):
+        with self.lock:
+            if outlet in self.outlets:
+                self.outlets.remove(outlet)
+            for key, tier in list(self.tiers.items()):
+                if outlet in tier.consumers:
+                    tier.consumers.remove(outlet)
+                if not tier.consumers:
+                    del self.tiers[key]
+
+    def _decoded(self, outlet):
+        """Generator of the (FrameHeader, decoded frame) tuples queued for an outlet"""
+        delta = DeltaDecoder(on_missing_keyframe=self.interface.request_keyframe)
+        while 1:
+            item = outlet.queue.get()
+            if item is None:
+                return
+            header, buffer = item
+            payload = memoryview(buffer)[HEADER_SIZE:]
+            with self.stream_metrics.decode_time.time():
+                frame = codec_by_id(header.codec).decode(payload, header.shape, header.dtype)
+                frame = delta.apply(header, frame)
+            if frame is not None:
+                yield header, frame
+
+    def framestream(self, maxsize=HUB_OUTLET_SIZE):
+        """
+        Generator function that yields the decoded frames of the stream,
+        used to watch an emitter, which is also forwarded to subscribers.
+        """
+        outlet = self.add(Outlet("Viewer", maxsize, policy=DROP_OLDEST))
+        try:
+            for header, frame in self._decoded(outlet):
+                self.interface.latency.displayed(header)
+                yield frame
+        finally:
+            self.remove(outlet)
+            outlet.teardown()
+
+    def teardown(self, sleep=0):
+        """The hub exits when the emitter's data socket is closed"""
+        with self.lock:
+            outlets = list(self.outlets)
+            for tier in self.tiers.values():
+                outlets.extend(tier.consumers)
+        for outlet in outlets:
+            outlet.teardown(sleep)
+        self.join(max(sleep, 1))
@@ -1,15 +1,129 @@
 import abc
 import time
-import gzip
 import socket
 from threading import Thread
 
-import numpy as np
-
-from .const import DTYPE, SSEP
-from .abstract import AbstractCommander
+from .const import DTYPE, RECV_POOL_SIZE, CODEC_PREFERENCE, RECORDING_DIR
+from .codec import codec_by_id, negotiate
+from .framing import read_frame, read_raw_frame, recv_exactly, FramePool, DeltaDecoder, HEADER_SIZE
+from .hub import FanoutHub, SocketOutlet, StreamMetrics, Tier, parse_subscriber_options
+from .abstract import RemoteCommander
+from .handshake import new_token
 from .messaging import Messaging
 from .subsystem import Forwarder
+from .clock import ClockSync, FrameLatency, clock_reply
+from .recording import Recorder
+from . import metrics
+
+
+def observe_handshake(started, entity_type=None):
+    """
+    Records a handshake, shared by InterfaceFactory and the asyncio engine.
+    :param started: time.perf_counter() at the connection
+    :param entity_type: type of the connected entity, None if the handshake failed
+    """
+    if entity_type is None:
+        metrics.counter("handshake_failures", "Handshakes, which didn't complete").inc()
+        return
+    metrics.histogram("handshake_seconds", "Time from connecting to a working interface",
+                      entity=entity_type).observe(time.perf_counter() - started)
+
+
+def remote_shutdown(ifc, await_remote=2):
+    """
+    Asks an emitter to shut down, shared by _EmitterInterface and the asyncio engine.
+    :param ifc: interface of the emitter, with its messenger
+    :param await_remote: seconds to wait for the emitter's answer
+    :return: True if it went offline, False on another answer, None without an answer
+    """
+    status = ifc.messenger.request("shutdown".encode(), timeout=await_remote)
+    errcode = status if status is None else (status == "emitter-{}:offline".format(ifc.ID))
+    msgs = {None: "no corpse response",
+            True: "shut down as expected",
+            False: "unknown status"}
+    ifc.out(msgs[errcode])
+    return errcode
+
+
+class Introduction(object):
+
+    """
+    Parses and validates the introductory string, which a remote
+    entity sends at the beginning of the handshake, and builds the
+    response to it. Shared by InterfaceFactory and the asyncio engine
+    of the Aggregator (see emittance_aggregator/engine.py).
+    """
+
+    def __init__(self, string, codecs=CODEC_PREFERENCE):
+        """
+        :param string: the received introduction
+        :param codecs: codec specs in order of preference (see codec.py)
+        """
+        self.string = string
+        self.codecs = codecs
+        self.etype = None
+        self.ID = None
+        self.info = None
+        self.codec = None
+        self.token = new_token()
+
+    def valid(self):
+        if ":HELLO;" in self.string:
+            return True
+        return False
+
+    @property
+    def response(self):
+        """
+        Response looks like this: HELLO;codec={codec spec};token={token}
+        The codec field is only sent to emitters.
+        """
+        fields = ["HELLO"]
+        if self.codec is not None:
+            fields.append("codec=" + self.codec)
+        fields.append("token=" + self.token)
+        return ";".join(fields)
+
+    def _valid_frame_shape(self, framestring):
+        try:
+            frameshape = [int(sp) for sp in framestring.split("x")]
+        except (TypeError, ValueError):
+            return False
+        if len(frameshape) not in (2, 3):
+            return False
+        self.info = frameshape
+        return True
+
+    def _choose_codec(self, fields):
+        params = dict(field.partition("=")[::2] for field in fields)
+        offered = params.get("codecs", "gzip").split(",")
+        self.codec = negotiate(offered, self.codecs)
+        if self.codec is None:
+            print("IFC_BUILDER: no common codec! Offered:", ", ".join(offered))
+            return False
+        return True
+
+    def parse(self):
+        """
+        Introduction looks like this:
+        {entity_type}-{ID}:HELLO;{frY}x{frX}x{frC};codecs={codec1},{codec2}
+        """
+
+        handshake, info = self.string.split(":HELLO;", 1)
+        try:
+            self.etype, self.ID = handshake.split("-")
+        except ValueError:
+            return False
+        if self.etype not in ("emitter", "subscriber"):
+            return False
+        fields = info.split(";")
+
+        if self.etype == "emitter":
+            if not self._valid_frame_shape(fields[0]):
+                return False
+            if not self._choose_codec(fields[1:]):
+                return False
+        return True
 
 
 class InterfaceFactory(object):
@@ -23,39 +137,63 @@ class InterfaceFactory(object):
     has to be able to connect to a remote emitter on the network.
     """
 
-    def __init__(self, msock, dlistener, rclistener, recv_retries=10):
+    def __init__(self, msock, matcher, recv_retries=10, codecs=CODEC_PREFERENCE, directory=None,
+                 unregister=None):
         """
         :param msock: connected socket, connected to a remote emitter
-        :param dlistener: unconnected server socket awaiting data connections
-        :param rclistener: unconnected server socket awaiting RC connections
+        :param matcher: StreamMatcher, which accepts the data and RC connections
+        :param codecs: codec specs in order of preference (see codec.py)
+        :param directory: {ID: EmitterInterface} dict, which subscribers may attach to
+        :param unregister: called with a subscriber interface, when it is torn down
         """
 
         self.messenger = Messaging(msock)
-        self.dlistener = dlistener
-        self.rclistener = rclistener
+        self.matcher = matcher
+        self.directory = directory
+        self.unregister = unregister
         self.introduction = None
-        self.parsed = None
-        self.etype = None
-        self.ID = None
-        self.info = None
+        self.parsed = None  # type: Introduction
+        self.codecs = codecs
         self.retries = recv_retries
+        self.started = time.perf_counter()
 
     def get(self):
+        ifc = self._handshake()
+        observe_handshake(self.started, ifc.entity_type if ifc else None)
+        return ifc
+
+    def _handshake(self):
         if not self._read_introduction():
-            return
-        if not self._valid_introduction():
+            return self._abort()
+        self.parsed = Introduction(self.introduction, self.codecs)
+        if not self.parsed.valid():
             print("IFC_BUILDER: invalid introduction @ validation:", self.introduction)
-            return
-        self.messenger.send("HELLO".encode())
-        if not self._parse_introductory_string():
+            return self._abort()
+        if not self.parsed.parse():
             print("IFC_BUILDER: invalid introduction @ parsing:", self.introduction)
-            return
+            return self._abort()
+        # The token is registered before the remote learns it
+        self.matcher.expect(self.parsed.token)
+        self.messenger.send(self.parsed.response.encode())
         print("IFC_BUILDER: valid introduction!")
-        return self._instantiate_interface()
+        try:
+            ifc = self._instantiate_interface()
+        finally:
+            self.matcher.discard(self.parsed.token)
+        if not ifc.initiated:
+            print("IFC_BUILDER: {}-{} didn't connect its streams!"
+                  .format(self.parsed.etype, self.parsed.ID))
+            ifc.teardown(0)
+            return
+        return ifc
+
+    def _abort(self):
+        """Closes the messaging channel of a failed handshake"""
+        self.messenger.teardown(0)
 
     @property
     def _args(self):
-        return self.ID, self.dlistener, self.rclistener, self.messenger, self.info
+        return self.parsed.ID, self.matcher, self.parsed.token, self.messenger, self.parsed.info
 
     def _read_introduction(self):
         tries = 0
@@ -67,38 +205,13 @@ class InterfaceFactory(object):
                 return False
         return True
 
-    def _valid_introduction(self):
-        if ":HELLO;" in self.introduction:
-            return True
-        return False
-
-    def _valid_frame_shape(self, framestring):
-        try:
-            frameshape = [int(sp) for sp in framestring.split("x")]
-        except TypeError:
-            return False
-        if len(frameshape) not in (2, 3):
-            return False
-        self.info = frameshape
-        return True
-
-    def _parse_introductory_string(self):
-        """
-        Introduction looks like this:
-        {entity_type}-{ID}:HELLO;{frY}x{frX}x{frC}
-        """
-
-        handshake, info = self.introduction.split(":HELLO;")
-        self.etype, self.ID = handshake.split("-")
-
-        if self.etype == "emitter" and not self._valid_frame_shape(info):
-            return False
-        return True
-
     def _instantiate_interface(self):
+        etype = self.parsed.etype
+        kw = ({"codec": self.parsed.codec} if etype == "emitter" else
+              {"directory": self.directory, "unregister": self.unregister})
         ifc = {"emitter": _EmitterInterface,
                "subscriber": _SubscriberInterface
-               }[self.etype](*self._args)
+               }[etype](*self._args, **kw)
         return ifc
 
 
@@ -118,24 +231,26 @@ class _Interface(object):
 
     entity_type = ""
 
-    def __init__(self, ID, dlistener, rclistener, messenger):
+    def __init__(self, ID, matcher, token, messenger):
         self.ID = ID
         self.messenger = messenger
         self.send = messenger.send
         self.recv = messenger.recv
         self.remote_ip = None
+        self.dsocket = None
+        self.rcsocket = None
         self.initiated = False
         try:
-            self._accept_connection_and_validate_ip_addresses(dlistener, "Data")
-            self._accept_connection_and_validate_ip_addresses(rclistener, "RC")
+            self._accept_connection_and_validate_ip_addresses(matcher, token, "Data")
+            self._accept_connection_and_validate_ip_addresses(matcher, token, "RC")
         except socket.timeout:
             self.initiated = False
         else:
             self.initiated = True
 
-    def _accept_connection_and_validate_ip_addresses(self, sock, typ):
+    def _accept_connection_and_validate_ip_addresses(self, matcher, token, typ):
         self.out("Awaiting {} connection...".format(typ))
-        conn, addr = sock.accept()
+        conn, addr = matcher.wait(token, typ)
         self.out("{} connection from {}:{}".format(typ, *addr))
         if self.remote_ip:
             if self.remote_ip != addr[0]:
@@ -159,8 +274,15 @@ class _Interface(object):
 
     def teardown(self, sleep):
         self.messenger.teardown(sleep)
-        self.dsocket.close()
-        self.rcsocket.close()
+        for sock in (self.dsocket, self.rcsocket):
+            if sock is None:
+                continue
+            try:
+                # Wakes up the threads blocked in recv() on the socket
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            sock.close()
 
 
 class _EmitterInterface(_Interface):
@@ -174,49 +296,139 @@ class _EmitterInterface(_Interface):
 
     entity_type = "emitter"
 
-    def __init__(self, ID, dlistener, rclistener, messenger, frameshape):
+    def __init__(self, ID, matcher, token, messenger, frameshape, codec="gzip"):
         """
         :param ID: the ID of the remote emitter 
-        :param dlistener: serving TCP socket on STREAM_SERVER_PORT
+        :param matcher: StreamMatcher, see emittance_common.handshake
+        :param token: the token of the handshake, identifying the streams
         :param messenger: a Messaging instance (see generic.messaging)
         :param frameshape: string descriping the video frame shape: {}x{}x{}
+        :param codec: the codec spec negotiated in the handshake
         """
 
-        super(_EmitterInterface, self).__init__(ID, dlistener, rclistener, messenger)
-        self.out("Frameshape:", frameshape)
+        super(_EmitterInterface, self).__init__(ID, matcher, token, messenger)
+        self.out("Frameshape:", frameshape, "codec:", codec)
         self.frameshape = frameshape
+        self.codec = codec
+        self.hub = None  # type: FanoutHub
+        self.recorder = None  # type: Recorder
+        self.clock = ClockSync(messenger, name=ID, labels={"emitter": ID})
+        self.latency = FrameLatency(self.clock, emitter=ID)
+        if self.initiated:
+            self.clock.start()
+
+    @staticmethod
+    def decode_frame(header, payload):
+        return codec_by_id(header.codec).decode(payload, header.shape, header.dtype)
+
+    def bytestream(self):
+        """
+        Generator function that yields the received frames undecoded,
+        as (FrameHeader, payload) tuples
+        """
+        while 1:
+            try:
+                header, payload = read_frame(self.dsocket)
+            except (ConnectionError, OSError) as E:
+                self.out("Stream closed:", E)
+                return
+            self.latency.arrived(header)
+            yield header, payload
+
+    def rawstream(self):
+        """
+        Generator function that yields the received frames as they
+        arrived, as (FrameHeader, header + payload bytearray) tuples
+        """
+        stream_metrics = StreamMetrics(self.ID)
+        while 1:
+            try:
+                head = recv_exactly(self.dsocket, HEADER_SIZE)
+                with stream_metrics.recv_time.time():
+                    entry = read_raw_frame(self.dsocket, head)
+            except (ConnectionError, OSError) as E:
+                self.out("Stream closed:", E)
+                return
+            self.latency.arrived(entry[0])
+            stream_metrics.mark(len(entry[1]))
+            yield entry
+
+    def fanout(self):
+        """
+        Starts reading the stream with a FanoutHub, so it can be shared
+        by several subscribers and viewers. From then on the data socket
+        must only be read by the hub.
+        """
+        if self.hub is None:
+            self.hub = FanoutHub(self)
+            self.hub.start()
+        return self.hub
 
-    def decode_frames(self, messages):
-        binaries = map(gzip.decompress, messages)
-        return [np.frombuffer(binary, dtype=DTYPE).reshape(*self.frameshape) for binary in binaries]
-
-    def framestream(self):
+    def framestream(self, pooled=False, pool_size=RECV_POOL_SIZE):
         """
         Generator function that yields the received video frames
+
+        :param pooled: if set, frames are received into a ring of
+         preallocated buffers (see framing.FramePool). The yielded arrays
+         are then only valid until <pool_size> more frames are received.
+         Not applicable if the stream is read by a FanoutHub.
+        :param pool_size: number of buffers in the ring
         """
-        datalen = np.prod(self.frameshape)
-        data = b""
+        if self.hub is not None:
+            for frame in self.hub.framestream():
+                yield frame
+            return
+        delta = DeltaDecoder(on_missing_keyframe=self.request_keyframe)
+        if not pooled:
+            for header, payload in self.bytestream():
+                frame = delta.apply(header, self.decode_frame(header, payload))
+                if frame is not None:
+                    self.latency.displayed(header)
+                    yield frame
+            return
+        pool = FramePool(self.frameshape, DTYPE, pool_size)
         while 1:
-            while len(data) < datalen:
-                data += self.dsocket.recv(1024)
-                if SSEP in data:
-                    *catches, data = data.split(SSEP)
-                    yield self.decode_frames(catches)
-
-    def perform_remote_shutdown(self, await_remote=2):
-        self.send("shutdown".encode())
-        time.sleep(await_remote)
-        status = self.recv()
-        errcode = status if status is None else (status == "emitter-{}:offline".format(self.ID))
-        msgs = {None: "no corpse response",
-                True: "shut down as expected",
-                False: "unknown status"}
-        print("CARIFC-{}: {}".format(self.ID, msgs[errcode]))
-        return errcode
+            try:
+                header, frame = pool.read_frame(self.dsocket)
+            except (ConnectionError, OSError) as E:
+                self.out("Stream closed:", E)
+                return
+            self.latency.arrived(header)
+            frame = delta.apply(header, frame)
+            if frame is not None:
+                self.latency.displayed(header)
+                yield frame
+
+    def record(self, directory=RECORDING_DIR, **kw):
+        """
+        Starts recording the stream, see emittance_common.recording.
+        The recorder joins the FanoutHub like a subscriber.
+        :param kw: see recording.Recorder
+        """
+        if self.recorder is None:
+            self.recorder = Recorder(self.ID, directory, request_keyframe=self.request_keyframe, **kw)
+            self.fanout().add(self.recorder)
+        return self.recorder
+
+    def stop_recording(self):
+        if self.recorder is None:
+            return
+        self.hub.remove(self.recorder)
+        self.recorder.teardown()
+        self.recorder = None
+
+    def request_keyframe(self):
+        """Asks the emitter to send a keyframe, e.g. after a broken delta chain"""
+        self.out("Requesting keyframe")
+        self.send(b"keyframe")
 
     def teardown(self, sleep=3):
-        success = self.perform_remote_shutdown(await_remote=2)
+        self.clock.teardown()
+        self.stop_recording()
+        success = remote_shutdown(self, await_remote=2)
         super(_EmitterInterface, self).teardown(max(0, sleep - 2))
+        if self.hub is not None:
+            self.hub.teardown()
         self.out("Teardown finished!")
         return success
 
@@ -235,82 +447,115 @@ class _SubscriberInterface(_Interface):
 
     entity_type = "subscriber"
 
-    def __init__(self, ID, dlistener, rclistener, messenger, state):
+    def __init__(self, ID, matcher, token, messenger, state, directory=None, unregister=None):
         """
         :param ID: the subscriber's unique ID
-        :param dlistener: serving TCP socket on STREAM_SERVER_PORT
+        :param matcher: StreamMatcher, see emittance_common.handshake
+        :param token: the token of the handshake, identifying the streams
         :param messenger: Messaging object
+        :param directory: {ID: EmitterInterface} dict of the attachable emitters
+        :param unregister: called with the interface, when it is torn down
         """
-        super(_SubscriberInterface, self).__init__(ID, dlistener, rclistener, messenger)
-        self.stream_worker = None
+        super(_SubscriberInterface, self).__init__(ID, matcher, token, messenger)
+        self.outlet = None  # type: SocketOutlet
         self.rc_worker = None
         self.emi_ifc = None
         self.state = state
+        self.directory = {} if directory is None else directory
+        self.unregister = unregister
         self.commander = self.__class__.Commander(
             messenger, master_name="EmiIfc-{}".format(ID),
+            tag="{}-{}:".format(self.entity_type, ID),
             shutdown=self.teardown,
-            cars=lambda: "Lightning McQueen",
+            cars=lambda: ", ".join(self.directory),
             connect=self.attach,
-            disconnect=self.detach
+            disconnect=self.detach,
+            stats=self.stats,
+            keyframe=lambda: self.emi_ifc and self.emi_ifc.request_keyframe(),
+            clock=lambda ID=None: clock_reply(getattr(self.directory.get(ID), "clock", None))
         )
         self.commander.start()
 
-    def attach(self, carifc):
+    def attach(self, ID, *options):
+        """
+        Joins the stream of an emitter. The stream is shared with every
+        other subscriber of the emitter through its FanoutHub.
+        :param options: key=value settings, eg. "fps=2 scale=4 policy=latest",
+         see hub.parse_subscriber_options
+        :return: the frameshape of the (reduced) stream
+        """
+        carifc = self.directory.get(ID)
+        if carifc is None:
+            return "no such emitter: {}".format(ID)
+        options, tier = parse_subscriber_options(*options)
         if self.emi_ifc is not None:
-            print("ClientInterface already connected to", self.emi_ifc.ID)
-            return
+            self.detach()
         self.emi_ifc = carifc
-        self.stream_worker = Forwarder(carifc.dsocket, self.dsocket, name="CliFace-Stream")
-        self.rc_worker = Forwarder(carifc.rcsocket, self.rcsocket, name="CliFace-RC")
-        self.send("x".join(str(d) for d in carifc.frameshape).encode())
-
-    def forward(self):
-        if self.emi_ifc is None:
-            print("No Emitter connected!")
-            return
-        self.stream_worker.start()
+        self.outlet = carifc.fanout().add(
+            SocketOutlet(self.dsocket, name="CliFace-{}".format(self.ID), on_evict=self._evicted,
+                         labels={"subscriber": self.ID, "emitter": ID}, **options),
+            **tier
+        )
+        self.rc_worker = Forwarder(self.rcsocket, carifc.rcsocket, name="CliFace-RC")
         if self.state == "active":
             self.rc_worker.start()
+        return "x".join(str(d) for d in Tier(**tier).shape(carifc.frameshape))
 
     def detach(self):
         if self.emi_ifc is None:
             return
-        self.stream_worker.teardown(0)
-        self.rc_worker.teardown(1)
+        self.emi_ifc.hub.remove(self.outlet)
+        self.outlet.teardown()
+        self.rc_worker.teardown(0)
         self.emi_ifc = None
+        self.outlet = None
+
+    def stats(self):
+        """The send queue statistics of the subscriber"""
+        if self.outlet is None:
+            return "not connected"
+        return "{} {}".format(self.emi_ifc.ID, self.outlet.stats())
+
+    def _evicted(self):
+        # The data socket is already shut down. Called from the hub's
+        # thread, which mustn't wait for the teardown.
+        Thread(target=self.teardown, name="CliFace-Evict").start()
 
     def teardown(self, sleep=1):
         if self.emi_ifc:
             self.detach()
+        if self.unregister is not None:
+            self.unregister(self)
+        metrics.REGISTRY.remove(subscriber=self.ID)
         self.commander.teardown()
         super(_SubscriberInterface, self).teardown(sleep)
 
     def __del__(self):
         self.teardown()
 
-    class Commander(Thread, AbstractCommander):
+    class Commander(Thread, RemoteCommander):
 
         """
         Nested class, which defines the command parser.
         Commands are received from the subscriber's messaging channel.
         """
 
-        def __init__(self, messenger, master_name, **commands):
+        def __init__(self, messenger, master_name, tag="", **commands):
             Thread.__init__(self, name=master_name + "-Commander")
-            AbstractCommander.__init__(self, master_name, **commands)
-            self.messenger = messenger  # type: Messaging
+            RemoteCommander.__init__(self, messenger, master_name, tag=tag, **commands)
 
         def read_cmd(self):
-            found = self.messenger.recv(1, timeout=1)
-            if found is None:
-                return "idle", ""
-            found = found.split(" ")
-            cmd = found[0].lower()
-            args = found[1:] if len(found) > 1 else ""
+            cmd, args = RemoteCommander.read_cmd(self)
+            if cmd is None and not self.messenger.running and self.running:
+                # The subscriber is gone (or was disconnected), tear down the interface
+                return "shutdown", ()
             return cmd, args
 
+        def run(self):
+            self.mainloop()
+
 
 class AggregatorInterface(_Interface):
 
-    def __init__(self, ID, dlistener, rclistener, messenger):
-        super().__init__(ID, dlistener, rclistener, messenger)
\ No newline at end of file
+    def __init__(self, ID, matcher, token, messenger):
+        super().__init__(ID, matcher, token, messenger)
\ No newline at end of file
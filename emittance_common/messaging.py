@@ -3,43 +3,207 @@ from __future__ import print_function, absolute_import, unicode_literals
 import socket
 import threading as thr
 import time
+import itertools
+from collections import deque
+from concurrent.futures import Future, TimeoutError
 
-from .const import MESSAGE_SERVER_PORT
+from .const import MESSAGE_SERVER_PORT, SSEP
+from . import metrics
 
+# Envelopes of correlated messages: ?{rid}|{message} and !{rid}|{reply}
+REQUEST = "?"
+REPLY = "!"
 
-class Messaging(object):
+ROUND_TRIP = metrics.histogram("request_seconds", "Round trip time of the answered requests")
+
+
+class Message(str):
+
+    """A received request. Carries the request ID needed to reply to it."""
+
+    rid = None
+
+
+class MessagingBase(object):
+
+    """
+    The transport-independent part of the messaging protocol:
+    message envelopes, request/reply correlation and the receive buffer.
+    Subclasses implement the transport in _write() and feed the
+    received messages into _deliver().
+
+    request() sends a message with a request ID. The remote answers it
+    with reply(), and the answer resolves the matching request directly,
+    so it never ends up in the receive buffer or in another request.
+    """
+
+    def __init__(self, tag=b""):
+        """
+        :param tag: optional tag, concatenated to the beginning of every message
+        """
+        self.tag = tag
+        self.recvbuffer = deque()
+        self.pending = {}
+        self.rids = itertools.count(1)
+        self.incoming = thr.Condition()
+        # If set, received messages are passed to this callable instead of being buffered
+        self.on_message = None
+        self.running = True
+
+    def _unwrap(self, msg):
+        """
+        Resolves replies and marks requests with their ID.
+        :return: the message to store in the receive buffer or None
+        """
+        envelope, sep, rest = msg[1:].partition("|")
+        if msg[:1] not in (REQUEST, REPLY) or not sep or not envelope.isdigit():
+            return msg
+        rid = int(envelope)
+        if msg[0] == REQUEST:
+            msg = Message(rest)
+            msg.rid = rid
+            return msg
+        future = self.pending.pop(rid, None)
+        if future is None:
+            print("MESSENGER: dropping late reply to request {}: {}".format(rid, rest))
+        else:
+            ROUND_TRIP.observe(time.perf_counter() - future.sent)
+            future.set_result(rest)
+        return None
+
+    def _deliver(self, msgs):
+        msgs = [m for m in map(self._unwrap, msgs) if m is not None]
+        if not msgs:
+            return
+        if self.on_message is not None:
+            for m in msgs:
+                self.on_message(m)
+            return
+        with self.incoming:
+            self.recvbuffer.extend(msgs)
+            self.incoming.notify_all()
+
+    def _enqueue(self, prefix, msgs):
+        assert all(isinstance(m, bytes) for m in msgs)
+        self._write([prefix + self.tag + m + SSEP for m in msgs])
+
+    def _write(self, chunks):
+        raise NotImplementedError
+
+    def send(self, *msgs):
+        """
+        This method prepares the messages and hands them to the transport.
+
+        :param msgs: the actual messages to send
+        """
+        self._enqueue(b"", msgs)
+
+    def request_async(self, msg):
+        """
+        Sends a message as a request.
+        :return: a concurrent.futures.Future, resolved with the reply
+        """
+        future = Future()
+        rid = next(self.rids)
+        self.pending[rid] = future
+        future.rid = rid
+        future.sent = time.perf_counter()
+        self._enqueue("{}{}|".format(REQUEST, rid).encode(), [msg])
+        return future
+
+    def request(self, msg, timeout=3):
+        """
+        Sends a message as a request and blocks until the matching reply arrives.
+        :return: the decoded reply, or None on timeout
+        """
+        future = self.request_async(msg)
+        try:
+            return future.result(timeout)
+        except TimeoutError:
+            self.pending.pop(future.rid, None)
+            return None
+
+    def reply(self, request, *msgs):
+        """
+        Answers a request obtained from recv(). If <request> was
+        not sent as a request, msgs are sent as plain messages.
+        """
+        rid = getattr(request, "rid", None)
+        self._enqueue(b"" if rid is None else "{}{}|".format(REPLY, rid).encode(), msgs)
+
+    def recv(self, n=1, timeout=0):
+        """
+        This method, when called, returns messages available in
+        the receive buffer. The messages are returned in a
+        First-In-First-Out (queue-like) order.
+
+        :param n: the number of messages to retreive at once
+        :param timeout: seconds to wait for the messages to arrive.
+         Returns as soon as they are available.
+        :return: returns the decoded (UTF-8) message or a list of messages
+        """
+        deadline = time.monotonic() + (timeout or 0)
+        msgs = []
+        with self.incoming:
+            for i in range(n):
+                if not self.incoming.wait_for(lambda: self.recvbuffer,
+                                              max(0., deadline - time.monotonic())):
+                    msgs.append(None)
+                    break
+                msgs.append(self.recvbuffer.popleft())
+        return msgs if len(msgs) > 1 else msgs[0]
+
+    def _stop(self):
+        self.running = False
+        for rid in list(self.pending):
+            future = self.pending.pop(rid, None)
+            if future is not None:
+                future.set_result(None)
+        with self.incoming:
+            self.incoming.notify_all()
+
+
+class Messaging(MessagingBase):
 
     """
     Wraps a TCP socket, which will be used for two-way
     message-passing between the emitter and the server.
+
+    Both directions are event driven: send() wakes the sender thread,
+    which flushes every queued message with a single sendall(), and
+    recv() blocks on a condition variable, which is notified as soon
+    as the receiver thread has chopped up a complete message.
     """
 
-    def __init__(self, conn, tag=b"", sendtick=0.5):
+    def __init__(self, conn, tag=b""):
         """
         :param conn: socket, around which the Messenger is wrapped
         :param tag: optional tag, concatenated to the beginning of every message
         """
-        self.tag = tag
-        self.sendtick = sendtick
-        self.recvbuffer = []
-        self.sendbuffer = []
+        super(Messaging, self).__init__(tag)
+        self.sendbuffer = deque()
+        self.sending = False
+        self.outgoing = thr.Condition()
         self.sock = conn
-        self.job_in = thr.Thread(target=self._flow_in)
-        self.job_out = thr.Thread(target=self._flow_out)
+        self.job_in = thr.Thread(target=self._flow_in, name="Messaging-in")
+        self.job_out = thr.Thread(target=self._flow_out, name="Messaging-out")
         timeout = self.sock.gettimeout()
         if timeout is None or timeout <= 0:
             print("MESSENGER: socket received has timeout:", self.sock.gettimeout())
             print("MESSENGER: setting it to 1")
             self.sock.settimeout(1)
 
-        self.running = True
         self.job_in.start()
         self.job_out.start()
 
     @classmethod
-    def connect_to(cls, IP, tag=b"", timeout=1):
+    def connect_to(cls, IP, tag=b"", timeout=1, source=None):
+        """
+        :param source: local IP address to connect from
+        """
         addr = (IP, MESSAGE_SERVER_PORT)
-        conn = socket.create_connection(addr, timeout=timeout)
+        conn = socket.create_connection(addr, timeout=timeout,
+                                        source_address=(source, 0) if source else None)
         return cls(conn, tag)
 
     def _flow_out(self):
@@ -49,12 +213,25 @@ class Messaging(object):
         This is intended to run in a separate thread.
         """
         print("MESSENGER: flow_out online!")
-        while self.running:
-            if self.sendbuffer:
-                msg = self.sendbuffer.pop(0)
-                for slc in (msg[i:i+1024] for i in range(0, len(msg), 1024)):
-                    self.sock.send(slc)
-            time.sleep(self.sendtick)
+        while 1:
+            with self.outgoing:
+                self.outgoing.wait_for(lambda: self.sendbuffer or not self.running)
+                if not self.sendbuffer:
+                    break
+                burst = b"".join(self.sendbuffer)
+                self.sendbuffer.clear()
+                self.sending = True
+            try:
+                self.sock.sendall(burst)
+            except Exception as E:
+                print("MESSENGER: caught exception while sending:", E)
+                self._stop()
+                break
+            finally:
+                with self.outgoing:
+                    # Wakes up flush(), which may be waiting for this burst
+                    self.sending = False
+                    self.outgoing.notify_all()
         print("MESSENGER: flow_out exiting...")
 
     def _flow_in(self):
@@ -64,70 +241,66 @@ class Messaging(object):
         buffer.
         """
         print("MESSENGER: flow_in online!")
+        data = bytearray()
         while self.running:
-            data = b""
-            while data[-5:] != b"ROGER" and self.running:
-                try:
-                    slc = self.sock.recv(1024)
-                except socket.timeout:
-                    time.sleep(0.1)
-                except socket.error as E:
+            try:
+                slc = self.sock.recv(65536)
+            except socket.timeout:
+                continue
+            except Exception as E:
+                if self.running:
                     print("MESSENGER: caught socket exception:", E)
-                    self.teardown(1)
-                except Exception as E:
-                    print("MESSENGER: generic exception:", E)
-                    self.teardown(1)
-                else:
-                    data += slc
-            if not self.running:
-                if data:
-                    print("MESSENGER: data left hanging:" + data[:-5].decode("utf8"))
-                    return
-            data = data[:-5].decode("utf8")
-            self.recvbuffer.extend(data.split("ROGER"))
+                self._stop()
+                break
+            if not slc:
+                print("MESSENGER: remote end closed the connection")
+                self._stop()
+                break
+            # Only the new bytes (and a possibly split separator) are scanned
+            start = max(0, len(data) - len(SSEP) + 1)
+            data += slc
+            msgs, consumed = [], 0
+            end = data.find(SSEP, start)
+            while end >= 0:
+                msgs.append(data[consumed:end].decode("utf8"))
+                consumed = end + len(SSEP)
+                end = data.find(SSEP, consumed)
+            if msgs:
+                del data[:consumed]
+                self._deliver(msgs)
+        if data:
+            print("MESSENGER: data left hanging:" + data.decode("utf8", "replace"))
         print("MESSENGER: flow_in exiting...")
 
-    def send(self, *msgs):
-        """
-        This method prepares and stores the messages in the
-        send buffer for sending.
-        
-        :param msgs: the actual messages to send
-        """
-        assert all(isinstance(m, bytes) for m in msgs)
-        self.sendbuffer.extend([self.tag + m + b"ROGER" for m in msgs])
+    def _write(self, chunks):
+        with self.outgoing:
+            self.sendbuffer.extend(chunks)
+            self.outgoing.notify_all()
 
-    def recv(self, n=1, timeout=0):
-        """
-        This method, when called, returns messages available in
-        the receive buffer. The messages are returned in a
-        Last-In-First-Out (queue-like) order.
-        
-        :param n: the number of messages to retreive at once 
-        :param timeout: set timeout if no messages are available
-        :return: returns the decoded (UTF-8) message or a list of messages
-        """
-        msgs = []
-        for i in range(n):
-            try:
-                m = self.recvbuffer.pop(0)
-            except IndexError:
-                if timeout:
-                    time.sleep(timeout)
-                    try:
-                        m = self.recvbuffer.pop(0)
-                    except IndexError:
-                        msgs.append(None)
-                        break
-                else:
-                    msgs.append(None)
-                    break
-            msgs.append(m)
-        return msgs if len(msgs) > 1 else msgs[0]
+    def flush(self, timeout=1):
+        """Waits until every queued message is handed to the socket"""
+        with self.outgoing:
+            return self.outgoing.wait_for(
+                lambda: not (self.sendbuffer or self.sending) or not self.running, timeout
+            )
+
+    def _stop(self):
+        super(Messaging, self)._stop()
+        with self.outgoing:
+            self.outgoing.notify_all()
 
     def teardown(self, sleep=0):
-        self.running = False
-        time.sleep(sleep)
+        """
+        Flushes the pending messages, then closes the connection.
+        :param sleep: the time allowed for flushing, at least 1 second
+        """
+        if self.running:
+            self.flush(timeout=max(sleep, 1))
+        self._stop()
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
         self.sock.close()
 
     def __del__(self):
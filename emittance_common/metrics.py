@@ -0,0 +1,436 @@
+"""
+Lightweight, thread-safe instrumentation.
+
+Metrics are identified by their name and labels, eg.
+frames_received{emitter="E0"}, and are kept in a MetricsRegistry.
+The instrumented modules record into the shared REGISTRY through
+counter(), gauge(), meter() and histogram(), which return the existing
+metric if it was already created.
+
+MetricsServer serves a registry over HTTP in the Prometheus text
+exposition format, from a background thread.
+"""
+
+import time
+import bisect
+import threading as thr
+from collections import deque
+from contextlib import contextmanager
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from .const import METRICS_HOST, METRICS_PREFIX
+
+# Upper bounds of the histogram buckets: durations in seconds, ratios
+LATENCY_BUCKETS = (.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1., 2.5, 5.)
+RATIO_BUCKETS = (.9, 1., 1.5, 2., 3., 5., 10., 20., 50., 100.)
+
+
+class _Metric(object):
+
+    kind = ""
+
+    def __init__(self, name, doc="", labels=None):
+        """
+        :param name: name of the metric, durations should end with _seconds
+        :param doc: one-line description
+        :param labels: {label: value} dict, eg. {"emitter": "E0"}
+        """
+        self.name = name
+        self.doc = doc
+        self.labels = dict(labels or {})
+        self.lock = thr.Lock()
+
+    @property
+    def key(self):
+        return self.name, tuple(sorted(self.labels.items()))
+
+    @property
+    def fullname(self):
+        if not self.labels:
+            return self.name
+        return "{}{{{}}}".format(self.name, ",".join(
+            '{}="{}"'.format(k, v) for k, v in sorted(self.labels.items())
+        ))
+
+    def summary(self):
+        raise NotImplementedError
+
+    def __str__(self):
+        return "{} {}".format(self.fullname, self.summary())
+
+
+class Counter(_Metric):
+
+    """Monotonically increasing count, eg. of frames or bytes"""
+
+    kind = "counter"
+
+    def __init__(self, name, doc="", labels=None):
+        super(Counter, self).__init__(name, doc, labels)
+        self.value = 0
+
+    def inc(self, n=1):
+        with self.lock:
+            self.value += n
+
+    def summary(self):
+        return str(self.value)
+
+
+class Gauge(_Metric):
+
+    """
+    A value which goes up and down, eg. a queue depth.
+    Either set explicitly, or read from a function when collected.
+    """
+
+    kind = "gauge"
+
+    def __init__(self, name, doc="", labels=None, function=None):
+        """
+        :param function: called without arguments to obtain the value
+        """
+        super(Gauge, self).__init__(name, doc, labels)
+        self.function = function
+        self._value = 0
+
+    @property
+    def value(self):
+        if self.function is not None:
+            return self.function()
+        return self._value
+
+    def set(self, value):
+        self._value = value
+
+    def inc(self, n=1):
+        with self.lock:
+            self._value += n
+
+    def dec(self, n=1):
+        self.inc(-n)
+
+    def summary(self):
+        return "{:.4g}".format(self.value)
+
+
+class Meter(Gauge):
+
+    """
+    Rate of events per second over a sliding window, eg. frames per second.
+    Exposed as a gauge.
+    """
+
+    def __init__(self, name, doc="", labels=None, window=2.):
+        """
+        :param window: length of the window in seconds
+        """
+        super(Meter, self).__init__(name, doc, labels)
+        self.window = window
+        self.events = deque()
+        self.total = 0
+
+    def _purge(self, now):
+        while self.events and self.events[0][0] < now - self.window:
+            self.total -= self.events.popleft()[1]
+
+    def mark(self, n=1):
+        now = time.monotonic()
+        with self.lock:
+            self.events.append((now, n))
+            self.total += n
+            self._purge(now)
+
+    @property
+    def value(self):
+        with self.lock:
+            self._purge(time.monotonic())
+            return self.total / self.window
+
+
+class Histogram(_Metric):
+
+    """
+    Distribution of observed values in fixed buckets.
+    Quantiles are estimated by interpolating inside the buckets.
+    """
+
+    kind = "histogram"
+
+    def __init__(self, name, doc="", labels=None, buckets=LATENCY_BUCKETS):
+        """
+        :param buckets: increasing upper bounds of the buckets,
+         an overflow bucket is added for the larger values
+        """
+        super(Histogram, self).__init__(name, doc, labels)
+        self.buckets = tuple(sorted(buckets))
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.
+        self.count = 0
+
+    def observe(self, value):
+        i = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[i] += 1
+            self.sum += value
+            self.count += 1
+
+    def add(self, other, sign=1):
+        """
+        Adds the observations of a histogram with the same buckets.
+        :param sign: -1 subtracts them, eg. to get the observations
+         recorded since an earlier copy was taken
+        """
+        if other.buckets != self.buckets:
+            raise ValueError("Buckets of {} and {} differ".format(self.fullname, other.fullname))
+        with other.lock:
+            counts, total, count = list(other.counts), other.sum, other.count
+        with self.lock:
+            self.counts = [a + sign * b for a, b in zip(self.counts, counts)]
+            self.sum += sign * total
+            self.count += sign * count
+
+    @contextmanager
+    def time(self):
+        """Observes the duration of the with-block"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start)
+
+    def snapshot(self):
+        """
+        :return: tuple of (upper bounds, cumulative counts, sum, count),
+         the last bound is float("inf")
+        """
+        with self.lock:
+            counts, total, count = list(self.counts), self.sum, self.count
+        cumulative, running = [], 0
+        for n in counts:
+            running += n
+            cumulative.append(running)
+        return self.buckets + (float("inf"),), cumulative, total, count
+
+    def quantile(self, q):
+        bounds, cumulative, total, count = self.snapshot()
+        if not count:
+            return 0.
+        rank = q * count
+        lower, below = 0., 0
+        for bound, reached in zip(bounds, cumulative):
+            if reached >= rank:
+                if bound == float("inf"):
+                    # Nothing is known above the last bucket
+                    return lower
+                inside = reached - below
+                return lower + (bound - lower) * (rank - below) / inside
+            lower, below = bound, reached
+        return lower
+
+    @property
+    def mean(self):
+        return self.sum / self.count if self.count else 0.
+
+    def summary(self):
+        if self.name.endswith("_seconds"):
+            fmt = lambda v: "{:.2f}ms".format(v * 1000)
+        else:
+            fmt = lambda v: "{:.3g}".format(v)
+        return "count={} mean={} p50={} p90={} p99={}".format(
+            self.count, fmt(self.mean),
+            *(fmt(self.quantile(q)) for q in (.5, .9, .99))
+        )
+
+
+class MetricsRegistry(object):
+
+    def __init__(self):
+        self.lock = thr.Lock()
+        self.metrics = {}
+
+    def _get(self, cls, name, doc, labels, **kw):
+        metric = cls(name, doc, labels, **kw)
+        with self.lock:
+            existing = self.metrics.setdefault(metric.key, metric)
+        if not isinstance(existing, cls):
+            raise ValueError("Metric {} is already registered as a {}"
+                             .format(existing.fullname, existing.kind))
+        if kw.get("function") is not None:
+            # A gauge re-registered by a new owner, eg. a reconnected emitter
+            existing.function = kw["function"]
+        return existing
+
+    def counter(self, name, doc="", **labels):
+        return self._get(Counter, name, doc, labels)
+
+    def gauge(self, name, doc="", function=None, **labels):
+        return self._get(Gauge, name, doc, labels, function=function)
+
+    def meter(self, name, doc="", window=2., **labels):
+        return self._get(Meter, name, doc, labels, window=window)
+
+    def histogram(self, name, doc="", buckets=LATENCY_BUCKETS, **labels):
+        return self._get(Histogram, name, doc, labels, buckets=buckets)
+
+    def value(self, name, default=0, **labels):
+        """:return: the current value of a counter, gauge or meter"""
+        with self.lock:
+            metric = self.metrics.get((name, tuple(sorted(labels.items()))))
+        return default if metric is None else metric.value
+
+    def total(self, name, **labels):
+        """:return: the sum of the counters or gauges called <name>, having the supplied labels"""
+        return sum(m.value for m in self._named(name, labels))
+
+    def merged(self, name, **labels):
+        """
+        :return: a new Histogram holding the observations of every histogram
+         called <name>, which has the supplied labels, eg. of all the emitters
+        """
+        metrics = [m for m in self._named(name, labels) if m.kind == "histogram"]
+        buckets = metrics[0].buckets if metrics else LATENCY_BUCKETS
+        merged = Histogram(name, labels=labels, buckets=buckets)
+        for metric in metrics:
+            merged.add(metric)
+        return merged
+
+    def _named(self, name, labels):
+        return [m for m in self.collect() if m.name == name and
+                all(m.labels.get(k) == v for k, v in labels.items())]
+
+    def collect(self, value=None):
+        """
+        :param value: if given, only the metrics having a label with this value
+        :return: the metrics sorted by name and labels
+        """
+        with self.lock:
+            metrics = list(self.metrics.values())
+        if value is not None:
+            metrics = [m for m in metrics if value in m.labels.values()]
+        return sorted(metrics, key=lambda m: m.key)
+
+    def remove(self, **labels):
+        """Forgets the metrics having all the supplied labels"""
+        with self.lock:
+            for key, metric in list(self.metrics.items()):
+                if all(metric.labels.get(k) == v for k, v in labels.items()):
+                    del self.metrics[key]
+
+    def report(self, value=None):
+        """Human-readable listing of the metrics, see collect()"""
+        metrics = self.collect(value)
+        if not metrics:
+            return "no metrics recorded"
+        width = max(len(m.fullname) for m in metrics)
+        return "\n".join("{:<{}} {}".format(m.fullname, width, m.summary()) for m in metrics)
+
+    def exposition(self, prefix=METRICS_PREFIX):
+        """
+        The metrics in the Prometheus text exposition format (version 0.0.4).
+        Names are prefixed, counters get the _total suffix.
+        """
+        lines, described = [], set()
+        for metric in self.collect():
+            name = prefix + metric.name + ("_total" if metric.kind == "counter" else "")
+            if name not in described:
+                described.add(name)
+                if metric.doc:
+                    lines.append("# HELP {} {}".format(name, _escape(metric.doc, help=True)))
+                lines.append("# TYPE {} {}".format(name, metric.kind))
+            try:
+                lines.extend(_samples(name, metric))
+            except Exception as E:
+                # A gauge function failing shouldn't break the whole scrape
+                lines.append("# {} failed: {}".format(name, _escape(str(E), help=True)))
+        return "\n".join(lines) + "\n"
+
+
+def _escape(value, help=False):
+    value = str(value).replace("\\", "\\\\").replace("\n", "\\n")
+    return value if help else value.replace('"', '\\"')
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    return "{{{}}}".format(",".join(
+        '{}="{}"'.format(k, _escape(v)) for k, v in sorted(labels.items())
+    ))
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def _samples(name, metric):
+    if metric.kind != "histogram":
+        return ["{}{} {}".format(name, _format_labels(metric.labels), _format_value(metric.value))]
+    bounds, cumulative, total, count = metric.snapshot()
+    samples = []
+    for bound, reached in zip(bounds, cumulative):
+        labels = dict(metric.labels, le=_format_value(bound))
+        samples.append("{}_bucket{} {}".format(name, _format_labels(labels), reached))
+    samples.append("{}_sum{} {}".format(name, _format_labels(metric.labels), _format_value(total)))
+    samples.append("{}_count{} {}".format(name, _format_labels(metric.labels), count))
+    return samples
+
+
+class MetricsServer(object):
+
+    """
+    Serves the metrics at http://host:port/metrics for scraping.
+    Requests are answered by threads of an HTTP server running in the
+    background, so a scrape never blocks the stream handling.
+    """
+
+    def __init__(self, port, host=METRICS_HOST, registry=None):
+        """
+        :param port: TCP port to listen on, 0 picks a free one
+        :param host: address to listen on
+        :param registry: MetricsRegistry to serve, defaults to REGISTRY
+        """
+        registry = REGISTRY if registry is None else registry
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                if self.path.split("?")[0] not in ("/", "/metrics"):
+                    self.send_error(404)
+                    return
+                body = registry.exposition().encode("utf8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, fmt, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        self.address = self.server.server_address
+        self.worker = thr.Thread(target=self.server.serve_forever, name="Metrics-Server", daemon=True)
+
+    def start(self):
+        self.worker.start()
+        print("METRICS: serving on http://{}:{}/metrics".format(*self.address))
+        return self
+
+    def teardown(self, sleep=0):
+        self.server.shutdown()
+        self.server.server_close()
+        self.worker.join(max(sleep, 1))
+
+
+REGISTRY = MetricsRegistry()
+counter = REGISTRY.counter
+gauge = REGISTRY.gauge
+meter = REGISTRY.meter
+histogram = REGISTRY.histogram
+
+# Process-wide metrics
+gauge("threads", "Number of running threads", function=thr.active_count)
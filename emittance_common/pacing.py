@@ -0,0 +1,88 @@
+import time
+import threading as thr
+from collections import deque
+
+from .const import FPS
+
+
+class Pacer(object):
+
+    """
+    Paces a loop to a target rate with monotonic deadlines.
+    The n-th tick is due at start + n / fps, independent of how long
+    the loop body took, so the rate doesn't drift with load.
+    If the loop falls behind by whole periods, those deadlines are
+    skipped and counted as missed, instead of bursting to catch up.
+    """
+
+    def __init__(self, fps=FPS, window=2.):
+        """
+        :param fps: target rate in ticks per second
+        :param window: length of the window for measuring the achieved rate, in seconds
+        """
+        self.lock = thr.Lock()
+        self._fps = float(fps)
+        self.window = window
+        self.deadline = None
+        self.missed = 0
+        self.ticks = deque()
+
+    @property
+    def fps(self):
+        return self._fps
+
+    @fps.setter
+    def fps(self, value):
+        value = float(value)
+        if value <= 0:
+            raise ValueError("FPS has to be positive, got {}".format(value))
+        with self.lock:
+            self._fps = value
+            # Re-anchor, so the new period starts from the next tick
+            self.deadline = None
+
+    @property
+    def period(self):
+        return 1. / self._fps
+
+    @property
+    def achieved(self):
+        """The rate measured over the last <window> seconds"""
+        with self.lock:
+            if len(self.ticks) < 2:
+                return 0.
+            return (len(self.ticks) - 1) / (self.ticks[-1] - self.ticks[0])
+
+    def reset(self):
+        with self.lock:
+            self.deadline = None
+            self.missed = 0
+            self.ticks.clear()
+
+    def wait(self):
+        """
+        Sleeps until the next deadline.
+        :return: the number of deadlines skipped because the loop was behind
+        """
+        with self.lock:
+            now = time.monotonic()
+            if self.deadline is None:
+                self.deadline = now
+            self.deadline += self.period
+            # Late by less than a period: go on immediately and stay on the grid.
+            # Late by more: drop the whole periods missed, don't try to catch up.
+            skipped = max(0, int((now - self.deadline) / self.period))
+            self.deadline += skipped * self.period
+            self.missed += skipped
+            delay = self.deadline - now
+        if delay > 0:
+            time.sleep(delay)
+        self._tick()
+        return skipped
+
+    def _tick(self):
+        with self.lock:
+            now = time.monotonic()
+            self.ticks.append(now)
+            while self.ticks and now - self.ticks[0] > self.window:
+                self.ticks.popleft()
@@ -1,7 +1,15 @@
 import abc
+import time
+import queue
 import socket
+import asyncio
+import ipaddress
+import threading as thr
 
-from emittance_common.const import EMITTER_PROBE_PORT
+from emittance_common.const import (
+    EMITTER_PROBE_PORT, PROBE_CONCURRENCY, PROBE_TIMEOUT,
+    DISCOVERY_PORT, DISCOVERY_GROUP, DISCOVERY_TIMEOUT
+)
 
 
 class Probe(object):
@@ -12,64 +20,139 @@ class Probe(object):
     __metaclass__ = abc.ABCMeta
 
     @staticmethod
-    def probe(*ips):
+    def probe(*ips, **kw):
         """
         Send a <probing> message to the specified IP addresses.
         If the target is a emitter, it will return its ID, or None otherwise.
+        Accepts the keyword arguments of sweep().
         """
-        return Probe._probe_all(b"probing", *ips)
+        return Probe._probe_all(b"probing", *ips, **kw)
 
     @staticmethod
-    def initiate(*ips):
+    def initiate(*ips, **kw):
         """
         Send a <connect> message to the specified IP addresses.
         The target emitter will initiate connection to this server/subscriber.
         """
-        got = Probe._probe_all(b"connect", *ips)
+        got = Probe._probe_all(b"connect", *ips, **kw)
         return got if len(got) > 1 else got[0]
 
     @staticmethod
-    def _validate_car_tag(tag, address=None):
+    def sweep(*ips, msg=b"probing", concurrency=PROBE_CONCURRENCY, timeout=PROBE_TIMEOUT):
+        """
+        Probes the addresses concurrently and yields the (IP, ID) tuples
+        as the responses arrive, in no particular order.
+        Addresses may be given as single IPs, ranges (192.168.1.1-100,
+        192.168.1.*) or in CIDR notation (192.168.0.0/16).
 
-        def missing_ampersand():
-            if " @ " not in tag:
-                return 1
+        :param msg: probing or connect
+        :param concurrency: number of probes in flight at once
+        :param timeout: deadline of a single probe in seconds
+        """
+        addresses = []
+        for ip in ips:
+            addresses += Probe._reparse_and_validate_ip(ip)
+        addresses = [ip for ip in addresses if ip is not None]
+        results = queue.Queue()
+        worker = thr.Thread(
+            target=asyncio.run, name="Probe-Sweep", daemon=True,
+            args=(Probe._sweep(addresses, msg, concurrency, timeout, results.put),)
+        )
+        worker.start()
+        for _ in addresses:
+            yield results.get()
 
-        def warn_in_case_of_unexpected_remote_IP_address():
-            if remote_addr != address:
-                print("INVALID TAG: address invalid:")
-                print("(expected) {} != {} (got)"
-                      .format(address, remote_addr))
+    @staticmethod
+    def discover(myIP=None, address=DISCOVERY_GROUP, timeout=DISCOVERY_TIMEOUT):
+        """
+        Sends a single UDP discovery datagram and collects the replies
+        of the idle emitters for <timeout> seconds.
 
-        def invalid_entity_type():
-            if entity_type != "emitter":
-                pass
+        :param myIP: local address to send from, picks the interface
+        :param address: the multicast group or a broadcast address
+        :return: list of (IP, ID, frameshape, codecs) tuples
+        """
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+        if myIP is not None:
+            sock.bind((myIP, 0))
+            sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_IF, socket.inet_aton(myIP))
+        sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_LOOP, 1)
+        found = {}
+        deadline = time.monotonic() + timeout
+        try:
+            sock.sendto(b"discover", (address, DISCOVERY_PORT))
+            while 1:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                sock.settimeout(remaining)
+                try:
+                    reply, addr = sock.recvfrom(1024)
+                except socket.timeout:
+                    break
+                parsed = Probe._parse_discovery_reply(reply)
+                if parsed is not None:
+                    found[parsed[0]] = parsed
+        except OSError as E:
+            print("PROBE: discovery failed:", E)
+        finally:
+            sock.close()
+        return list(found.values())
 
-        tag = tag.decode("utf-8")
-        if missing_ampersand():
-            return
-        IDs, remote_addr = tag.split(" @ ")
-        if address is not None:
-            warn_in_case_of_unexpected_remote_IP_address()
-        entity_type, ID = IDs.split("-")
-        if invalid_entity_type():
-            return
-        return ID
+    @staticmethod
+    def _parse_discovery_reply(reply):
+        """
+        Reply looks like this:
+        emitter-{ID} @ {IP};{frameshape};codecs={codec1},{codec2},...
+        """
+        try:
+            tag, frameshape, codecs = reply.split(b";")
+            ID = Probe._validate_car_tag(tag)
+        except ValueError:
+            print("PROBE: invalid discovery reply:", reply)
+            return None
+        if ID is None:
+            return None
+        IP = tag.decode("utf-8").split(" @ ")[1]
+        codecs = codecs.decode("utf-8").partition("=")[2]
+        return IP, ID, frameshape.decode("utf-8"), codecs.split(",") if codecs else []
 
     @staticmethod
-    def _probe_all(msg, *ips):
+    def _probe_all(msg, *ips, **kw):
         """
         Send a <probing> message to the specified IP addresses.
         If the target is a emitter, it will return its ID, or None otherwise.
+        The results are returned in the order of the addresses.
         """
         reparsed = []
         for ip in ips:
             reparsed += Probe._reparse_and_validate_ip(ip)
-        responses = [Probe._probe_one(ip, msg) for ip in reparsed]
-        return responses
+        responses = dict(Probe.sweep(*(ip for ip in reparsed if ip is not None), msg=msg, **kw))
+        return [(ip, responses.get(ip)) for ip in reparsed]
+
+    @staticmethod
+    async def _sweep(addresses, msg, concurrency, timeout, callback):
+        """
+        Runs <concurrency> workers, which take the addresses one by one,
+        so the number of pending probes (and open sockets) stays bounded.
+        """
+        addresses = iter(addresses)
+
+        async def worker():
+            for ip in addresses:
+                try:
+                    result = await Probe._probe_one(ip, msg, timeout)
+                except Exception as E:
+                    # Every address has to be reported, sweep() counts on it
+                    print("PROBE: probing {} raised: {}".format(ip, E))
+                    result = ip, None
+                callback(result)
+
+        await asyncio.gather(*(worker() for _ in range(max(1, concurrency))))
 
     @staticmethod
-    def _probe_one(ip, msg):
+    async def _probe_one(ip, msg, timeout):
         """
         Probes an IP address with a given message.
         This causes the remote emitter to send back its
@@ -79,47 +162,64 @@ class Probe(object):
 
         assert msg.decode("utf-8") in ("connect", "probing"), "Invalid message!"
 
-        def create_connection():
-            while 1:
-                try:
-                    sock.connect((ip, EMITTER_PROBE_PORT))
-                except socket.timeout:
-                    print("PROBE: waiting for remote...")
-                except socket.error:
-                    return 0
-                else:
-                    return 1
-
-        def probe_and_receive_tag():
-            sock.send(msg)
-            for i in range(5, 0, -1):
-                try:
-                    network_tag = sock.recv(1024)
-                except socket.timeout:
-                    print("PROBE: no answer {}".format(i))
-                else:
-                    return network_tag
-            else:
-                print("PROBE: timed out on", ip)
-                return None
-
-        sock = socket.socket()
-        sock.settimeout(0.1)
+        async def probe_and_receive_tag():
+            reader, writer = await asyncio.open_connection(ip, EMITTER_PROBE_PORT)
+            try:
+                writer.write(msg)
+                await writer.drain()
+                return await reader.read(1024)
+            finally:
+                writer.close()
 
-        success = create_connection()
-        if not success:
+        try:
+            tag = await asyncio.wait_for(probe_and_receive_tag(), timeout)
+        except asyncio.TimeoutError:
+            return ip, None
+        except OSError:
             return ip, None
-        tag = probe_and_receive_tag()
-        if tag is None:
+        if not tag:
+            return ip, None
+        try:
+            ID = Probe._validate_car_tag(tag, ip)
+        except ValueError:
+            print("PROBE: invalid tag from {}: {}".format(ip, tag))
             return ip, None
-        ID = Probe._validate_car_tag(tag, ip)
         return ip, ID
 
+    @staticmethod
+    def _validate_car_tag(tag, address=None):
+
+        def missing_ampersand():
+            if " @ " not in tag:
+                return 1
+
+        def warn_in_case_of_unexpected_remote_IP_address():
+            if remote_addr != address:
+                print("INVALID TAG: address invalid:")
+                print("(expected) {} != {} (got)"
+                      .format(address, remote_addr))
+
+        def invalid_entity_type():
+            if entity_type != "emitter":
+                pass
+
+        tag = tag.decode("utf-8")
+        if missing_ampersand():
+            return
+        IDs, remote_addr = tag.split(" @ ")
+        if address is not None:
+            warn_in_case_of_unexpected_remote_IP_address()
+        entity_type, ID = IDs.split("-")
+        if invalid_entity_type():
+            return
+        return ID
+
     @staticmethod
     def _reparse_and_validate_ip(ip):
         """
         Overly complicated method, used to parse IP address ranges,
-        e.g. the conversion from 192.168.1.1-100 to actual addresses
+        e.g. the conversion from 192.168.1.1-100 to actual addresses.
+        Networks in CIDR notation (192.168.1.0/24) yield their hosts.
         """
 
         def look_for_hyphen(index, part):
@@ -140,7 +240,8 @@ class Probe(object):
         def calculate_state(iplist):
             for index, part in enumerate(iplist):
                 if part == "*":
-                    part = "0-255"
+                    # The end of a range is exclusive
+                    iplist[index] = part = "0-256"
                 if "-" in part:
                     return look_for_hyphen(index, part)
                 if not part.isdigit():
@@ -149,6 +250,15 @@ class Probe(object):
             return -1
 
         msg = "PROBE: invalid IP!"
+        if "/" in ip:
+            try:
+                network = ipaddress.ip_network(ip, strict=False)
+            except ValueError:
+                print(msg, "Invalid network:", ip)
+                return [None]
+            if network.num_addresses == 1:
+                return [str(network.network_address)]
+            return [str(host) for host in network.hosts()]
         splip = split_ip(ip)
         if splip is None:
             return [None]
@@ -0,0 +1,91 @@
+import time
+import threading as thr
+from collections import deque
+
+# Drop policies of FrameQueue
+BLOCK = "block"
+DROP_OLDEST = "drop-oldest"
+LATEST = "latest"
+POLICIES = (BLOCK, DROP_OLDEST, LATEST)
+
+
+class FrameQueue(object):
+
+    """
+    Bounded, thread-safe queue joining the stages of a frame pipeline.
+    What happens when a producer finds the queue full depends on the policy:
+    - block: the producer waits for free space
+    - drop-oldest: the oldest queued item is discarded
+    - latest: every put discards all queued items, so the consumer
+      always gets the most recent frame
+    Items are stored together with the time they were queued.
+    """
+
+    def __init__(self, maxsize=4, policy=DROP_OLDEST):
+        if policy not in POLICIES:
+            raise ValueError("Invalid drop policy: {}. Expected one of: {}"
+                             .format(policy, ", ".join(POLICIES)))
+        self.maxsize = max(1, maxsize)
+        self.policy = policy
+        self.items = deque()
+        self.dropped = 0
+        self.closed = False
+        self.lock = thr.Lock()
+        self.not_empty = thr.Condition(self.lock)
+        self.not_full = thr.Condition(self.lock)
+
+    def __len__(self):
+        return len(self.items)
+
+    def put(self, item, timeout=None):
+        """
+        :return: False if the item itself couldn't be queued
+         (queue closed or blocking put timed out), True otherwise
+        """
+        with self.lock:
+            if self.closed:
+                return False
+            if self.policy == LATEST:
+                self.dropped += len(self.items)
+                self.items.clear()
+            elif len(self.items) >= self.maxsize:
+                if self.policy == DROP_OLDEST:
+                    self.items.popleft()
+                    self.dropped += 1
+                elif not self.not_full.wait_for(
+                        lambda: len(self.items) < self.maxsize or self.closed, timeout):
+                    self.dropped += 1
+                    return False
+                elif self.closed:
+                    return False
+            self.items.append((time.monotonic(), item))
+            self.not_empty.notify()
+            return True
+
+    def get(self, timeout=None, stamped=False):
+        """
+        :param stamped: return (time.monotonic() of queueing, item) tuples
+        :return: the oldest item, or None on timeout or if the queue is closed and empty
+        """
+        with self.lock:
+            if not self.not_empty.wait_for(lambda: self.items or self.closed, timeout):
+                return None
+            if not self.items:
+                return None
+            stamp, item = self.items.popleft()
+            self.not_full.notify()
+            return (stamp, item) if stamped else item
+
+    def lag(self):
+        """Seconds the oldest queued item has been waiting"""
+        with self.lock:
+            if not self.items:
+                return 0.
+            return time.monotonic() - self.items[0][0]
+
+    def close(self):
+        """Wakes up every waiting producer and consumer. Queued items can still be read."""
+        with self.lock:
+            self.closed = True
+            self.not_empty.notify_all()
+            self.not_full.notify_all()
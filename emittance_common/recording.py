@@ -0,0 +1,366 @@
+"""
+Recording of the streams on the Aggregator, and reading them back.
+
+A recording is a directory of segments. Every segment is a pair of files:
+
+    {ID}_{%Y%m%d-%H%M%S}_{seq}.frames   the frames exactly as received, with
+                                        their headers, back to back
+    {ID}_{%Y%m%d-%H%M%S}_{seq}.index    one INDEX_DTYPE record per frame
+
+named after the capture time and the sequence number of their first
+frame. The frames aren't re-encoded, the index records are appended as
+raw little-endian structs, so both files only grow and an interrupted
+recording stays readable up to its last complete frame.
+
+Every segment starts with a self-contained frame and a new segment is
+only started at a keyframe, so the segments can be decoded on their own.
+When frames are lost (the recorder fell behind), the delta frames are
+skipped until the next keyframe, which is requested from the emitter.
+
+Recording (the reader) maps the files with mmap: seeking to a capture
+timestamp is a binary search in the index, and the frames are returned
+as memoryviews of the mapping, without copying.
+"""
+
+import os
+import mmap
+import time
+import threading as thr
+from datetime import datetime
+
+import numpy as np
+
+from .const import RECORDING_DIR, RECORDING_SEGMENT, RECORDING_QUEUE
+from .codec import codec_by_id
+from .framing import HEADER_SIZE, FLAG_DELTA, SEQ_MASK, unpack_header, DeltaDecoder
+from .hub import Outlet
+from .queues import DROP_OLDEST
+from . import metrics
+
+# Index record of a frame: sequence number, capture timestamp (emitter's clock),
+# offset and length of the frame (header included) in the .frames file, header flags
+INDEX_DTYPE = np.dtype([("seq", "<u4"), ("timestamp", "<f8"), ("offset", "<u8"),
+                        ("length", "<u4"), ("flags", "u1")])
+
+FRAMES_EXT = ".frames"
+INDEX_EXT = ".index"
+
+
+def self_contained(flags):
+    """Frames without FLAG_DELTA can be decoded without their predecessors"""
+    return not flags & FLAG_DELTA
+
+
+class Recorder(Outlet):
+
+    """
+    Writes the encoded frames of an emitter to segmented files in a
+    separate thread. Fed like the other outlets: a FanoutHub queues
+    (FrameHeader, buffer) tuples, the async engine queues
+    (FrameHeader, (head, payload)) tuples. The queue drops the oldest
+    frames when the disk is slower than the stream, so recording never
+    holds up forwarding.
+    """
+
+    def __init__(self, ID, directory=RECORDING_DIR, segment=RECORDING_SEGMENT,
+                 maxsize=RECORDING_QUEUE, request_keyframe=None):
+        """
+        :param ID: the emitter's ID, used in the file names and as the label of the metrics
+        :param directory: the segments go to <directory>/<ID>/
+        :param segment: length of the segments in seconds, a new segment
+         is started at the first keyframe after that
+        :param maxsize: number of frames queued for writing
+        :param request_keyframe: called when the recorder needs a keyframe
+        """
+        super(Recorder, self).__init__("Recorder-{}".format(ID), maxsize, policy=DROP_OLDEST)
+        self.ID = ID
+        self.directory = os.path.join(os.path.expanduser(directory), ID)
+        self.segment = segment
+        self.request_keyframe = request_keyframe
+        self.path = None
+        self.frames_file = None
+        self.index_file = None
+        self.offset = 0
+        self.started = None
+        self.last_seq = None
+        self.synced = False
+        self.keyframe_requested = False
+        self._instrument_recorder({"emitter": ID})
+        self.worker = thr.Thread(target=self.run, name=self.name)
+        self.worker.start()
+
+    def _instrument_recorder(self, labels):
+        self.recorded = metrics.counter("recorded_frames", "Frames written to the recording", **labels)
+        self.recorded_bytes = metrics.counter("recorded_bytes", "Bytes written to the recording",
+                                              **labels)
+        self.skipped = metrics.counter(
+            "recording_skipped", "Delta frames not recorded, because their chain was broken", **labels)
+        self.segments = metrics.counter("recording_segments", "Segments started", **labels)
+        self.write_time = metrics.histogram("recording_write_seconds", "Time spent writing a frame",
+                                            **labels)
+        metrics.gauge("recording_queue_depth", "Frames waiting to be written",
+                      function=lambda: len(self.queue), **labels)
+        metrics.gauge("recording_dropped", "Frames dropped in front of the recorder",
+                      function=lambda: self.dropped, **labels)
+
+    def _ask_for_keyframe(self):
+        if not self.keyframe_requested and self.request_keyframe is not None:
+            self.request_keyframe()
+        self.keyframe_requested = True
+
+    def _open_segment(self, header):
+        self._close_segment()
+        os.makedirs(self.directory, exist_ok=True)
+        stamp = datetime.fromtimestamp(header.timestamp).strftime("%Y%m%d-%H%M%S")
+        self.path = os.path.join(self.directory, "{}_{}_{}".format(self.ID, stamp, header.seq))
+        self.frames_file = open(self.path + FRAMES_EXT, "wb")
+        self.index_file = open(self.path + INDEX_EXT, "wb")
+        self.offset = 0
+        self.started = header.timestamp
+        self.keyframe_requested = False
+        self.segments.inc()
+        print("RECORDER {}: new segment {}".format(self.ID, os.path.basename(self.path)))
+
+    def _close_segment(self):
+        for handle in (self.frames_file, self.index_file):
+            if handle is not None:
+                handle.close()
+        self.frames_file = self.index_file = None
+
+    def _write(self, header, buffer):
+        parts = buffer if isinstance(buffer, tuple) else (buffer,)
+        length = 0
+        for part in parts:
+            self.frames_file.write(part)
+            length += len(part)
+        record = np.array((header.seq, header.timestamp, self.offset, length, header.flags),
+                          dtype=INDEX_DTYPE)
+        self.index_file.write(record.tobytes())
+        self.offset += length
+        self.recorded.inc()
+        self.recorded_bytes.inc(length)
+
+    def _accept(self, header):
+        """
+        Decides whether the frame is recorded and rotates the segments.
+        :return: False if the frame can't be decoded from the recording
+        """
+        contiguous = self.last_seq is not None and header.seq == (self.last_seq + 1) & SEQ_MASK
+        self.last_seq = header.seq
+        if self_contained(header.flags):
+            self.synced = True
+            if self.frames_file is None or header.timestamp - self.started >= self.segment:
+                self._open_segment(header)
+            return True
+        if not (self.synced and contiguous):
+            # Lost frames, or joined in the middle of a delta chain
+            self.synced = False
+            self.skipped.inc()
+            self._ask_for_keyframe()
+            return False
+        if header.timestamp - self.started >= self.segment:
+            # Rotates at the next keyframe, this one speeds it up
+            self._ask_for_keyframe()
+        return True
+
+    def run(self):
+        print("RECORDER {}: recording to {}".format(self.ID, self.directory))
+        while 1:
+            item = self.queue.get()
+            if item is None:
+                break
+            header, buffer = item
+            if not self._accept(header):
+                continue
+            start = time.perf_counter()
+            try:
+                self._write(header, buffer)
+            except OSError as E:
+                print("RECORDER {}: write failed, recording stopped: {}".format(self.ID, E))
+                break
+            self.write_time.observe(time.perf_counter() - start)
+        # The hub removes closed outlets
+        self.queue.close()
+        self._close_segment()
+        print("RECORDER {}: stopped, {} frames recorded".format(self.ID, self.recorded.value))
+
+    def stats(self):
+        return "recorded={} dropped={} skipped={} queued={} segment={}".format(
+            self.recorded.value, self.dropped, self.skipped.value, len(self.queue),
+            os.path.basename(self.path) if self.path else "-"
+        )
+
+    def teardown(self, sleep=0):
+        """The queued frames are still written"""
+        super(Recorder, self).teardown(sleep)
+        self.worker.join(max(sleep, 1))
+
+
+def _map(path):
+    """Read-only mapping of a file, None if it is empty"""
+    with open(path, "rb") as handle:
+        if not os.fstat(handle.fileno()).st_size:
+            return None
+        return mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def _bisect(values, x):
+    """Leftmost position of x in the sorted sequence, works on strided views without copying"""
+    lo, hi = 0, len(values)
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if values[mid] < x:
+            lo = mid + 1
+        else:
+            hi = mid
+    return lo
+
+
+class Segment(object):
+
+    """
+    A memory-mapped segment of a recording.
+    The frames are returned as memoryviews of the mapping, so they are
+    only valid while the segment is open.
+    """
+
+    def __init__(self, path):
+        """:param path: path of the segment with or without extension"""
+        self.path = os.path.splitext(path)[0] if path.endswith((FRAMES_EXT, INDEX_EXT)) else path
+        self.data = _map(self.path + FRAMES_EXT)
+        self.index_map = _map(self.path + INDEX_EXT)
+        size = len(self.data) if self.data is not None else 0
+        count = len(self.index_map) // INDEX_DTYPE.itemsize if self.index_map is not None else 0
+        index = np.frombuffer(self.index_map, INDEX_DTYPE, count) if count else np.empty(0, INDEX_DTYPE)
+        # A segment being written may have index records of frames not yet on disk
+        while count and int(index[count - 1]["offset"]) + int(index[count - 1]["length"]) > size:
+            count -= 1
+        self.index = index[:count]
+
+    def __len__(self):
+        return len(self.index)
+
+    @property
+    def start(self):
+        return float(self.index[0]["timestamp"]) if len(self) else None
+
+    @property
+    def end(self):
+        return float(self.index[-1]["timestamp"]) if len(self) else None
+
+    def position(self, timestamp):
+        """Position of the first frame captured at or after <timestamp>, in O(log n)"""
+        return _bisect(self.index["timestamp"], timestamp)
+
+    def keyframe_before(self, position):
+        """Position of the last self-contained frame at or before <position>"""
+        flags = self.index["flags"]
+        position = min(position, len(self) - 1)
+        while position > 0 and not self_contained(flags[position]):
+            position -= 1
+        return max(position, 0)
+
+    def frame(self, position):
+        """:return: (FrameHeader, payload memoryview) of the frame at <position>"""
+        record = self.index[position]
+        offset = int(record["offset"])
+        view = memoryview(self.data)[offset:offset + int(record["length"])]
+        return unpack_header(view[:HEADER_SIZE]), view[HEADER_SIZE:]
+
+    def frames(self, start=0):
+        for position in range(start, len(self)):
+            yield self.frame(position)
+
+    def close(self):
+        self.index = np.empty(0, INDEX_DTYPE)
+        for mapping in (self.data, self.index_map):
+            if mapping is None:
+                continue
+            try:
+                mapping.close()
+            except BufferError:
+                pass  # Frames are still referenced, the mapping goes with them
+        self.data = self.index_map = None
+
+
+class Recording(object):
+
+    """
+    Reads a recording: the segments of a directory (eg. <RECORDING_DIR>/<ID>)
+    or a single segment, in the order of their capture time.
+    """
+
+    def __init__(self, path):
+        path = os.path.expanduser(path)
+        if os.path.isdir(path):
+            names = sorted(os.path.splitext(name)[0] for name in os.listdir(path)
+                           if name.endswith(INDEX_EXT))
+            paths = [os.path.join(path, name) for name in names]
+        else:
+            paths = [path]
+        segments = [Segment(p) for p in paths]
+        self.segments = [s for s in segments if len(s)]
+        self.segments.sort(key=lambda s: s.start)
+        if not self.segments:
+            raise IOError("No recorded frames in: {}".format(path))
+
+    @staticmethod
+    def detect(path):
+        """Tells whether <path> is a recording or a segment of one"""
+        path = os.path.expanduser(path)
+        if os.path.isdir(path):
+            return any(name.endswith(INDEX_EXT) for name in os.listdir(path))
+        return path.endswith((FRAMES_EXT, INDEX_EXT)) and os.path.exists(
+            os.path.splitext(path)[0] + INDEX_EXT)
+
+    def __len__(self):
+        return sum(len(s) for s in self.segments)
+
+    @property
+    def start(self):
+        return self.segments[0].start
+
+    @property
+    def end(self):
+        return self.segments[-1].end
+
+    def seek(self, timestamp):
+        """
+        :return: (segment number, position) of the keyframe, where decoding
+         has to start to get the frame captured at or after <timestamp>
+        """
+        starts = [s.start for s in self.segments]
+        number = max(0, _bisect(starts, timestamp) - 1)
+        segment = self.segments[number]
+        position = segment.position(timestamp)
+        if position >= len(segment) and number + 1 < len(self.segments):
+            return number + 1, 0
+        return number, segment.keyframe_before(position)
+
+    def frames(self, start=None, end=None):
+        """
+        Generator of the recorded (FrameHeader, payload memoryview) tuples.
+        :param start: capture timestamp to start at, the frames from the
+         keyframe before it are included, so they can be decoded
+        :param end: capture timestamp to stop at
+        """
+        number, position = self.seek(start) if start is not None else (0, 0)
+        for segment in self.segments[number:]:
+            for header, payload in segment.frames(position):
+                if end is not None and header.timestamp > end:
+                    return
+                yield header, payload
+            position = 0
+
+    def decoded(self, start=None, end=None):
+        """Generator of the decoded (FrameHeader, frame) tuples, see frames()"""
+        delta = DeltaDecoder()
+        for header, payload in self.frames(start, end):
+            frame = codec_by_id(header.codec).decode(payload, header.shape, header.dtype)
+            frame = delta.apply(header, frame)
+            if frame is not None and (start is None or header.timestamp >= start):
+                yield header, frame
+
+    def close(self):
+        for segment in self.segments:
+            segment.close()
@@ -5,12 +5,13 @@ import socket
 import numpy as np
 
 from .const import (
-    DTYPE, STREAM_SERVER_PORT, MESSAGE_SERVER_PORT, RC_SERVER_PORT, EMITTER_PROBE_PORT
+    DTYPE, STREAM_SERVER_PORT, MESSAGE_SERVER_PORT, RC_SERVER_PORT, EMITTER_PROBE_PORT,
+    LISTEN_BACKLOG
 )
 
 
 def white_noise(shape):
-    return (np.random.randn(*shape) * 255.).astype(DTYPE)
+    return np.random.randint(0, 256, shape, dtype=DTYPE)
 
 
 def my_ip():
@@ -24,7 +25,7 @@ def my_ip():
     return address
 
 
-def srvsock(ip, channel, timeout=None):
+def srvsock(ip, channel, timeout=None, backlog=LISTEN_BACKLOG):
     assert channel[0] in "dsmrp"
     port = {
         "d": STREAM_SERVER_PORT,
@@ -34,8 +35,10 @@ def srvsock(ip, channel, timeout=None):
         "p": EMITTER_PROBE_PORT
     }[channel[0]]
     s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    # Restarted servers may rebind while old connections are in TIME_WAIT
+    s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
     if timeout is not None:
         s.settimeout(timeout)
     s.bind((ip, port))
-    s.listen(1)
+    s.listen(backlog)
     return s
@@ -1,8 +1,15 @@
+import os
 import time
 import socket
+import select
 import threading as thr
 
-from .const import FPS
+try:
+    import fcntl
+except ImportError:  # Not on Windows, where splice isn't available either
+    fcntl = None
+
+from .const import RELAY_CHUNK, RELAY_MODE
 
 
 class StreamDisplayer(thr.Thread):
@@ -28,17 +35,16 @@ class StreamDisplayer(thr.Thread):
         Displays the remote emitter's stream with cv2.imshow()
         """
         import cv2
-        stream = self.interface.framestream()
+        stream = self.interface.framestream(pooled=True)
         print("STREAM_DISPLAYER: online")
         self.running = True
-        for i, pix in enumerate(stream, start=1):
+        for i, pic in enumerate(stream, start=1):
             # self.interface.out("\rRecieved {:>4} frames of shape {}"
             #                    .format(i, pic.shape), end="")
-            for pic in pix:
-                cv2.imshow("{} Stream".format(self.interface.ID), pic)
-                keypress = cv2.waitKey(int(1000/FPS))
-                if not self.running or keypress == 27:
-                    break
+            cv2.imshow("{} Stream".format(self.interface.ID), pic)
+            keypress = cv2.waitKey(1)
+            if not self.running or keypress == 27:
+                break
 
         cv2.destroyWindow("{} Stream".format(self.interface.ID))
         print("STREAM_DISPLAYER: Exiting...")
@@ -55,36 +61,116 @@ class StreamDisplayer(thr.Thread):
 
 class Forwarder(object):
 
-    def __init__(self, srcsock, trgsock, name=""):
+    """
+    Relays every byte received on one socket to another, in a separate thread.
+    Two relay modes are available:
+    - splice: the data is moved from socket to socket through a pipe by
+      the kernel (os.splice, Linux only), never entering Python
+    - copy: recv_into a preallocated buffer and sendall from it
+    Forwarding stops when the source reaches EOF or on teardown.
+    """
+
+    def __init__(self, srcsock, trgsock, name="", mode=RELAY_MODE, chunk=RELAY_CHUNK):
+        """
+        :param srcsock: socket to read from
+        :param trgsock: socket to write to
+        :param mode: "splice", "copy", or None to use splice where available
+        :param chunk: maximal number of bytes relayed in one step
+        """
+        if mode is None:
+            mode = "splice" if hasattr(os, "splice") else "copy"
+        if mode == "splice" and not hasattr(os, "splice"):
+            raise RuntimeError("os.splice is not available on this platform")
         self.srcsock = srcsock
         self.trgsock = trgsock
+        self.mode = mode
+        self.chunk = chunk
         self.tag = "-".join((name, "Forwarder"))
         self.worker = None
         self.running = False
+        self.relayed = 0
 
     def start(self):
         if self.worker is not None:
-            print("{}: already forwarding from {0[0]}:{0[1]} to {1[0]}:{1[1]}"
+            print("{0}: already forwarding from {1[0]}:{1[1]} to {2[0]}:{2[1]}"
                   .format(self.tag, self.srcsock.getsockname(), self.trgsock.getsockname()))
             return
-        self.worker = thr.Thread(target=self.run, name="SubscriberInterface-rc_job")
+        self.running = True
+        self.worker = thr.Thread(target=self.run, name=self.tag)
         self.worker.start()
 
-    def run(self):
-        print("{} starts working".format(self.tag))
-        self.running = True
+    def _readable(self):
+        """Waits for data on the source, so teardown is noticed within a second"""
         while self.running:
+            if select.select([self.srcsock], [], [], 1)[0]:
+                return True
+        return False
+
+    def _writable(self):
+        while self.running:
+            if select.select([], [self.trgsock], [], 1)[1]:
+                return True
+        return False
+
+    def _splice(self):
+        rpipe, wpipe = os.pipe()
+        try:
             try:
-                data = self.srcsock.recv(1024)
-            except socket.timeout:
+                # Moving more per call than the default 64 kB of the pipe
+                fcntl.fcntl(wpipe, fcntl.F_SETPIPE_SZ, self.chunk)
+            except (AttributeError, OSError):
                 pass
-            else:
-                self.trgsock.send(data)
-        print("{} exiting...".format(self.tag))
+            src, trg = self.srcsock.fileno(), self.trgsock.fileno()
+            while self._readable():
+                try:
+                    n = os.splice(src, wpipe, self.chunk, flags=os.SPLICE_F_MOVE)
+                except BlockingIOError:
+                    continue
+                if not n:
+                    break
+                # The pipe is drained completely before reading again
+                while n:
+                    try:
+                        sent = os.splice(rpipe, trg, n, flags=os.SPLICE_F_MOVE)
+                    except BlockingIOError:
+                        if not self._writable():
+                            return
+                        continue
+                    n -= sent
+                    self.relayed += sent
+        finally:
+            os.close(rpipe)
+            os.close(wpipe)
+
+    def _copy(self):
+        buffer = bytearray(self.chunk)
+        view = memoryview(buffer)
+        while self._readable():
+            try:
+                n = self.srcsock.recv_into(buffer)
+            except (BlockingIOError, socket.timeout):
+                continue
+            if not n:
+                break
+            # sendall() takes care of the partial sends
+            self.trgsock.sendall(view[:n])
+            self.relayed += n
+
+    def run(self):
+        print("{} starts working ({})".format(self.tag, self.mode))
+        try:
+            {"splice": self._splice, "copy": self._copy}[self.mode]()
+        except (OSError, ValueError) as E:
+            # ValueError: select() on a closed socket
+            if self.running:
+                print("{}: relay failed: {}".format(self.tag, E))
+        self.running = False
+        print("{} exiting after {} bytes...".format(self.tag, self.relayed))
 
     def teardown(self, sleep=1):
         self.running = False
-        time.sleep(sleep)
+        if self.worker is not None and self.worker is not thr.current_thread():
+            self.worker.join(max(sleep, 1))
         self.worker = None
 
     def __del__(self):
@@ -0,0 +1,162 @@
+"""
+Synthetic frame sources, which mock the interface of cv2.VideoCapture.
+
+Frames are generated with vectorized uint8 operations from arrays
+precomputed once per scene, so a source delivers hundreds of frames
+per second and the emitters are not CPU-bound by their test input.
+The sources are seeded, the same seed always yields the same frames.
+
+Every source plays scenes: between two scene changes the frames only
+differ by the motion of the source, a scene change replaces the whole
+picture. The scene change rate is the probability of a frame starting
+a new scene, so it sets how much work the delta codecs get:
+- noise: frames of a precomputed noise bank, the worst case of
+  compression. The bank is advanced on every scene change.
+- gradient: a diagonal color gradient shifting every frame, like
+  a camera panning. A new scene has a new direction and palette.
+- pattern: color bars with a small moving box, mostly static like
+  a surveillance camera. A new scene permutes the bars.
+"""
+
+import numpy as np
+
+from .const import DTYPE, DUMMY_FRAMESIZE, NOISE_BANK_SIZE
+
+# RGB color bars of the pattern source
+BARS = np.array([[255, 255, 255], [255, 255, 0], [0, 255, 255], [0, 255, 0],
+                 [255, 0, 255], [255, 0, 0], [0, 0, 255], [0, 0, 0]], dtype=DTYPE)
+
+
+class SyntheticSource(object):
+
+    """
+    Base class of the sources.
+    Subclasses implement _new_scene() and render(index).
+    """
+
+    name = ""
+    scene_change = 0.
+
+    def __init__(self, shape=DUMMY_FRAMESIZE, scene_change=None, seed=0, speed=1):
+        """
+        :param shape: shape of the frames: (height, width, channels)
+        :param scene_change: probability of a frame starting a new scene, 0 to 1
+        :param seed: seed of the random generator
+        :param speed: motion of the source in pixels (or levels) per frame
+        """
+        self.shape = tuple(shape)
+        if scene_change is not None:
+            self.scene_change = float(scene_change)
+        if not 0 <= self.scene_change <= 1:
+            raise ValueError("Scene change rate has to be between 0 and 1, got {}"
+                             .format(self.scene_change))
+        self.speed = speed
+        self.rng = np.random.default_rng(seed)
+        self.index = 0
+        self.scene = 0
+        self._new_scene()
+
+    def _new_scene(self):
+        raise NotImplementedError
+
+    def render(self, index):
+        """:return: the <index>-th frame of the current scene"""
+        raise NotImplementedError
+
+    def read(self):
+        if self.index and self.scene_change and self.rng.random() < self.scene_change:
+            self.scene += 1
+            self._new_scene()
+        frame = self.render(self.index)
+        self.index += 1
+        return True, frame
+
+    def release(self):
+        pass
+
+
+class NoiseSource(SyntheticSource):
+
+    """
+    Cycles a bank of precomputed white noise frames. The frames are
+    read-only views of the bank, since they are handed out repeatedly.
+    """
+
+    name = "noise"
+    scene_change = 1.
+
+    def __init__(self, shape=DUMMY_FRAMESIZE, scene_change=None, seed=0, speed=1,
+                 bank=NOISE_BANK_SIZE):
+        """:param bank: number of distinct noise frames"""
+        self.bank = np.random.default_rng(seed).integers(0, 256, (bank,) + tuple(shape), dtype=DTYPE)
+        self.bank.flags.writeable = False
+        super(NoiseSource, self).__init__(shape, scene_change, seed, speed)
+
+    def _new_scene(self):
+        pass
+
+    def render(self, index):
+        return self.bank[self.scene % len(self.bank)]
+
+
+class GradientSource(SyntheticSource):
+
+    name = "gradient"
+
+    def _new_scene(self):
+        height, width = self.shape[:2]
+        fx, fy = 0, 0
+        while not fx and not fy:
+            fx, fy = self.rng.integers(-2, 3, 2)
+        y, x = np.ogrid[:height, :width]
+        ramp = ((x * fx + y * fy) % 256).astype(DTYPE)
+        phases = self.rng.integers(0, 256, self.shape[2], dtype=DTYPE)
+        # uint8 additions wrap around, so the gradient repeats itself
+        self.base = ramp[..., None] + phases
+
+    def render(self, index):
+        return self.base + DTYPE(index * self.speed % 256)
+
+
+class PatternSource(SyntheticSource):
+
+    name = "pattern"
+
+    def _new_scene(self):
+        height, width = self.shape[:2]
+        colors = BARS[self.rng.permutation(len(BARS))]
+        columns = np.arange(width) * len(BARS) // width
+        bars = colors[columns][:, :self.shape[2]]
+        self.base = np.ascontiguousarray(np.broadcast_to(bars, self.shape))
+        self.box = max(1, height // 8)
+
+    def render(self, index):
+        height, width = self.shape[:2]
+        frame = self.base.copy()
+        travel = max(1, 2 * (width - self.box))
+        x = index * self.speed % travel
+        x = x if x <= width - self.box else travel - x  # bounces off the edges
+        y = (height - self.box) // 2
+        box = frame[y:y + self.box, x:x + self.box]
+        np.subtract(255, box, out=box)
+        return frame
+
+
+SOURCES = {cls.name: cls for cls in (NoiseSource, GradientSource, PatternSource)}
+
+
+def synthetic_source(spec, seed=0):
+    """
+    Instantiates a source from its spec: name[:WIDTHxHEIGHT[:scene change rate]],
+    eg. "noise", "gradient:1280x720" or "pattern:640x480:0.05"
+    """
+    name, _, rest = spec.partition(":")
+    size, _, rate = rest.partition(":")
+    if name not in SOURCES:
+        raise ValueError("Unknown synthetic source: {}, available: {}"
+                         .format(name, ", ".join(sorted(SOURCES))))
+    shape = DUMMY_FRAMESIZE
+    if size:
+        width, height = (int(d) for d in size.lower().split("x"))
+        shape = (height, width, 3)
+    return SOURCES[name](shape, float(rate) if rate else None, seed)
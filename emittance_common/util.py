@@ -1,23 +1,15 @@
-from .routine import white_noise
+from .const import DUMMY_FRAMESIZE
+from .synthetic import NoiseSource
 
 
-DUMMY_FRAMESIZE = (480, 640, 3)  # = 921,600 B in uint8
-
-
-class CaptureDeviceMocker(object):
+class CaptureDeviceMocker(NoiseSource):
 
     """
     Mocks the interface of cv2.VideoCapture,
-    produces a white noise stream.
+    produces a white noise stream from a precomputed bank of frames.
+    See emittance_common.synthetic for the other sources.
     """
 
-    @staticmethod
-    def read():
-        return True, white_noise(DUMMY_FRAMESIZE)
-
-    def release(self):
-        pass
-
 
 class Table(object):
 
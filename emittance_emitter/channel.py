@@ -1,12 +1,23 @@
 import abc
 import time
-import gzip
 import socket
 import threading as thr
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
 
 from .component import CaptureDevice
 from emittance_common.util import CaptureDeviceMocker
-from emittance_common.const import DTYPE, FPS, STREAM_SERVER_PORT, RC_SERVER_PORT, SSEP
+from emittance_common.const import (
+    DTYPE, FPS, STREAM_SERVER_PORT, RC_SERVER_PORT, KEYFRAME_INTERVAL,
+    ENCODER_WORKERS, PIPELINE_QUEUE_SIZE, DROP_POLICY
+)
+from emittance_common.codec import get_codec, available_codecs
+from emittance_common.framing import pack_frame, DeltaEncoder
+from emittance_common.handshake import send_token
+from emittance_common.queues import FrameQueue
+from emittance_common.pacing import Pacer
+from emittance_common import metrics
 
 
 class ChannelBase(object):
@@ -18,8 +29,11 @@ class ChannelBase(object):
         self.running = False
         self.worker = None
 
-    def _connectbase(self, IP, port, timeout):
-        self.sock = socket.create_connection((IP, port), timeout=timeout)
+    def _connectbase(self, IP, port, timeout, token=None, source=None):
+        self.sock = socket.create_connection((IP, port), timeout=timeout,
+                                             source_address=(source, 0) if source else None)
+        if token is not None:
+            send_token(self.sock, token)
 
     def start(self):
         if self.sock is None:
@@ -60,8 +74,9 @@ class RCReceiver(ChannelBase):
         super(RCReceiver, self).__init__()
         self._recvbuffer = []
 
-    def connect(self, IP):
-        super(RCReceiver, self)._connectbase(IP, RC_SERVER_PORT, timeout=1)
+    def connect(self, IP, token=None, source=None):
+        super(RCReceiver, self)._connectbase(IP, RC_SERVER_PORT, timeout=1,
+                                             token=token, source=source)
         print("RCRECEIVER: connected to {}:{}".format(IP, RC_SERVER_PORT))
 
     def run(self):
@@ -94,23 +109,95 @@ class TCPStreamer(ChannelBase):
 
     Runs in a separate thread, started in TCPEmitter._listen()
     on a remote command from the controller.
+
+    Streaming is a pipeline of three stages, joined by bounded queues:
+    - capture (the worker thread) reads and timestamps the frames
+    - encode does the delta coding and hands the compression to
+      a pool of encoder threads (zlib and friends release the GIL)
+    - send awaits the compressed frames in order and sends them
+    When the encoders or the network fall behind, frames are dropped
+    in front of the encode stage according to the drop policy, so the
+    capture rate is unaffected and the delta chain stays intact.
     """
 
-    def __init__(self):
+    def __init__(self, keyframe_interval=KEYFRAME_INTERVAL, workers=ENCODER_WORKERS,
+                 queue_size=PIPELINE_QUEUE_SIZE, drop_policy=DROP_POLICY, ID="", eye=None):
+        """
+        :param keyframe_interval: delta coding keyframe interval, 0 to disable
+        :param workers: number of encoder threads
+        :param queue_size: capacity of the queues between the stages
+        :param drop_policy: policy of the capture queue, see emittance_common.queues
+        :param ID: the emitter's ID, used as the label of the metrics
+        :param eye: the CaptureDevice to stream, defaults to the first camera
+        """
         super(TCPStreamer, self).__init__()
         self._frameshape = None
-        self.eye = CaptureDevice()
+        self._seq = 0
+        self.codec = get_codec("gzip")
+        self.delta = DeltaEncoder(keyframe_interval)
+        self.workers = workers
+        self.queue_size = queue_size
+        self.drop_policy = drop_policy
+        self.captured = None  # type: FrameQueue
+        self.encoded = None  # type: FrameQueue
+        self.pacer = Pacer(FPS)
+        self.eye = CaptureDevice() if eye is None else eye
         self._determine_frame_shape()
+        self._instrument(ID)
         print("TCPSTREAMER: online")
 
-    def connect(self, IP):
-        super(TCPStreamer, self)._connectbase(IP, STREAM_SERVER_PORT, None)
+    def _instrument(self, ID):
+        label = {"emitter": ID}
+        self.capture_time = metrics.histogram(
+            "capture_seconds", "Time spent reading a frame from the capture device", **label)
+        self.encode_time = metrics.histogram(
+            "encode_seconds", "Time spent compressing a frame", **label)
+        self.compression = metrics.histogram(
+            "compression_ratio", "Raw size / compressed size of the frames",
+            buckets=metrics.RATIO_BUCKETS, **label)
+        self.frames_sent = metrics.counter("frames_sent", "Frames sent to the server", **label)
+        self.bytes_sent = metrics.counter("bytes_sent", "Bytes sent to the server", **label)
+        metrics.gauge("capture_queue_depth", "Frames waiting for the encoder",
+                      function=lambda: len(self.captured) if self.captured else 0, **label)
+        metrics.gauge("capture_dropped", "Frames dropped in front of the encoder",
+                      function=lambda: self.captured.dropped if self.captured else 0, **label)
+        metrics.gauge("send_queue_depth", "Frames waiting to be sent",
+                      function=lambda: len(self.encoded) if self.encoded else 0, **label)
+
+    def connect(self, IP, token=None, source=None):
+        super(TCPStreamer, self)._connectbase(IP, STREAM_SERVER_PORT, None, token, source)
         print("TCPSTREAMER: connected to {}:{}".format(IP, STREAM_SERVER_PORT))
 
     @property
     def frameshape(self):
         return str(self._frameshape)[1:-1].replace(", ", "x")
 
+    @property
+    def codecs(self):
+        """Names of the codecs this streamer is able to encode with"""
+        return available_codecs()
+
+    def set_codec(self, spec):
+        """Sets the codec negotiated in the handshake, e.g. zlib:1"""
+        self.codec = get_codec(spec)
+        print("TCPSTREAMER: using codec", self.codec.spec)
+
+    def set_keyframe_interval(self, interval):
+        """Sets the delta coding keyframe interval, 0 turns delta coding off"""
+        self.delta.interval = int(interval)
+        self.delta.request_keyframe()
+        print("TCPSTREAMER: keyframe interval set to", self.delta.interval)
+
+    def request_keyframe(self):
+        self.delta.request_keyframe()
+
+    def set_fps(self, fps=None):
+        """Sets the target frame rate. Without argument, prints the pacing stats."""
+        if fps is not None:
+            self.pacer.fps = fps
+        print("TCPSTREAMER: target {:.1f} FPS, achieved {:.1f} FPS, missed {} deadlines"
+              .format(self.pacer.fps, self.pacer.achieved, self.pacer.missed))
+
     def _determine_frame_shape(self):
         self.eye.open()
         success, frame = self.eye.read()
@@ -124,31 +211,107 @@ class TCPStreamer(ChannelBase):
         self.eye = CaptureDevice(CaptureDeviceMocker)
         return self.eye.read()
 
-    @staticmethod
-    def encode_frames(frames):
-        cmps = map(gzip.compress, [frame.astype(DTYPE).tobytes() for frame in frames])
-        return SSEP.join(cmps)
+    def _pack(self, data, flags, seq, stamp, shape):
+        with self.encode_time.time():
+            payload = self.codec.encode(data)
+        self.compression.observe(data.nbytes / max(1, len(payload)))
+        return pack_frame(payload, seq, stamp, shape, DTYPE, self.codec.ID, flags)
+
+    def encode_frames(self, frames, timestamps=None):
+        """
+        Compresses the frames and prepends the binary frame header to each.
+        :param frames: iterable of numpy arrays
+        :param timestamps: capture times of the frames, defaults to now
+        """
+        if timestamps is None:
+            timestamps = [time.time()] * len(frames)
+        packed = []
+        for frame, stamp in zip(frames, timestamps):
+            frame = np.ascontiguousarray(frame, dtype=DTYPE)
+            data, flags = self.delta.apply(frame, self.codec.lossless)
+            packed.append(self._pack(data, flags, self._seq, stamp, frame.shape))
+            self._seq += 1
+        return b"".join(packed)
+
+    def _encode_stage(self, encoder, encoded):
+        """
+        Assigns sequence numbers, does the delta coding and submits the
+        compression to the encoder pool. The futures are queued in order.
+        """
+        # Delta buffers may only be reused after their frame is compressed.
+        # At most queue_size + 1 compressions are pending at a time.
+        ring = [None] * (self.queue_size + 2)
+        slot = 0
+        while 1:
+            item = self.captured.get()
+            if item is None:
+                break
+            stamp, frame = item
+            if ring[slot] is None or ring[slot].shape != frame.shape:
+                ring[slot] = np.empty_like(frame)
+            data, flags = self.delta.apply(frame, self.codec.lossless, out=ring[slot])
+            encoded.put(encoder.submit(self._pack, data, flags, self._seq, stamp, frame.shape))
+            self._seq += 1
+            slot = (slot + 1) % len(ring)
+        encoded.close()
+
+    def _send_stage(self, encoded):
+        pushed = 0
+        while 1:
+            future = encoded.get()
+            if future is None:
+                break
+            try:
+                frame = future.result()
+                self.sock.sendall(frame)
+            except Exception as E:
+                print("TCPSTREAMER: send failed:", E)
+                self.running = False
+                break
+            pushed += 1
+            self.frames_sent.inc()
+            self.bytes_sent.inc(len(frame))
+            print("\rPushed {:>3} frames @ {:.1f} FPS, missed {} deadlines"
+                  .format(pushed, self.pacer.achieved, self.pacer.missed), end="")
+        encoded.close()
+        self.captured.close()
 
     def run(self):
         """
         Obtain frames from the capture device via OpenCV.
         Send the frames to the UDP subscriber (the main server)
         """
-        pushed = 0
         self.eye.open()
+        self.delta.reset()
+        self.pacer.reset()
         self.running = True
-        buffer = []
+        self.captured = FrameQueue(self.queue_size, self.drop_policy)
+        encoded = self.encoded = FrameQueue(self.queue_size, policy="block")
+        encoder = ThreadPoolExecutor(self.workers, thread_name_prefix="Streamer-Encoder")
+        stages = [thr.Thread(target=self._encode_stage, args=(encoder, encoded),
+                             name="Streamer-Encode"),
+                  thr.Thread(target=self._send_stage, args=(encoded,),
+                             name="Streamer-Send")]
+        for stage in stages:
+            stage.start()
+        ready = time.perf_counter()
         for success, frame in self.eye.stream():
+            stamp = time.time()
+            self.capture_time.observe(time.perf_counter() - ready)
             if not success:
                 print("Unsuccesful frame read!")
                 continue
             if not self.running:
                 break
-            time.sleep(1. / FPS)
-            buffer.append(frame)
-            if len(buffer) >= 4:
-                self.sock.sendall(self.encode_frames(frame))
-                buffer = []
-            print("Pushed {:>3} frames".format(pushed))
+            self.captured.put((stamp, np.ascontiguousarray(frame, dtype=DTYPE)))
+            self.pacer.wait()
+            ready = time.perf_counter()
+        else:
+            print("TCPSTREAMER: end of the capture stream")
+            self.running = False
+        self.captured.close()
+        for stage in stages:
+            stage.join()
+        encoder.shutdown()
         self.eye.close()
         print("TCPStreamer: socket and worker deleted! Exiting...")
@@ -6,7 +6,9 @@ import cv2
 
 # Project imports
 from emittance_common.util import CaptureDeviceMocker
-from emittance_common.abstract import AbstractCommander
+from emittance_common.abstract import RemoteCommander
+from emittance_common.const import REPLAY_MODE, REPLAY_LOOP
+from .replay import ReplaySource
 
 
 class CaptureDevice(object):
@@ -15,14 +17,21 @@ class CaptureDevice(object):
     """
 
     # noinspection PyArgumentList
-    def __init__(self, dev=None, dummyfile=None):
+    def __init__(self, dev=None, dummyfile=None, mode=REPLAY_MODE, loop=REPLAY_LOOP):
+        """
+        :param dev: factory of the device, which mocks cv2.VideoCapture
+        :param dummyfile: video file, image sequence pattern (eg. frames/%04d.png)
+         image directory or recording to replay instead of the camera, see replay.ReplaySource
+        :param mode: timing of the replay, eg. realtime, 4x, 30 or asap
+        :param loop: whether the replay restarts at the end
+        """
         if dev is None:
             if not dummyfile:
                 self.device = lambda: cv2.VideoCapture(0)
-            elif not os.path.exists(dummyfile):
+            elif not os.path.exists(dummyfile) and "%" not in dummyfile:
                 self.device = CaptureDeviceMocker
             else:
-                self.device = lambda: cv2.VideoCapture(dummyfile)
+                self.device = lambda: ReplaySource(dummyfile, mode, loop)
         else:
             self.device = dev
 
@@ -40,26 +49,43 @@ class CaptureDevice(object):
         if self._eye is None:
             self.open()
         while self._eye:
-            yield self._eye.read()
+            success, frame = self._eye.read()
+            if not success and getattr(self._eye, "exhausted", False):
+                # End of a replay
+                return
+            yield success, frame
 
     def close(self):
         self._eye.release()
         self._eye = None
 
 
-class Commander(AbstractCommander):
+class Commander(RemoteCommander):
     """
     Receives commands from the Aggregator
     """
 
-    def __init__(self, messenger, **commands):
-        super().__init__("Emitter", commands_dict=commands)
-        self.messenger = messenger
+    def __init__(self, messenger, on_disconnect=None, **commands):
+        """
+        :param on_disconnect: called instead of the shutdown command,
+         if the loop ends because the server is gone
+        """
+        super().__init__(messenger, "Emitter", commands_dict=commands)
+        self.disconnected = False
+        self.on_disconnect = on_disconnect
         print("COMMANDER: online!")
 
     def read_cmd(self):
-        m = self.messenger.recv(timeout=1)
-        if m is None:
-            return None, ()
-        m = m.split(" ")
-        return m[0], m[1:]
+        cmd, args = super().read_cmd()
+        if cmd is None and not self.messenger.running:
+            # The server is gone, leave the mainloop
+            print("COMMANDER: lost connection to the server!")
+            self.disconnected = True
+            self.running = False
+        return cmd, args
+
+    def finish(self, *args):
+        if self.disconnected and self.on_disconnect is not None:
+            self.on_disconnect()
+            return
+        super().finish(*args)
@@ -3,39 +3,66 @@ from .channel import TCPStreamer, RCReceiver
 from .component import Commander
 from .probeserver import ProbeServer, ProbeHandshake
 from emittance_common.messaging import Messaging
+from emittance_common import metrics
+from emittance_common.clock import clock_reply
+from emittance_common.const import EMITTER_METRICS_PORT
 
 
 class TCPEntity(object):
 
     entity_type = "emitter"
 
-    def __init__(self, myID, myIP):
+    def __init__(self, myID, myIP, metrics_port=EMITTER_METRICS_PORT, eye=None):
+        """
+        :param metrics_port: port of the metrics endpoint (see metrics.MetricsServer),
+         None disables it
+        :param eye: the CaptureDevice to stream, defaults to the first camera
+        """
         self.ID = myID
         self.ip = myIP
 
-        self.streamer = TCPStreamer()
+        self.streamer = TCPStreamer(ID=myID, eye=eye)
         self.receiver = RCReceiver()
         self.messenger = None  # type: Messaging
         self.commander = None  # type: Commander
         self.server_ip = None
         self.online = False
+        metrics.gauge("capture_fps", "Achieved capture rate",
+                      function=lambda: self.streamer.pacer.achieved, emitter=myID)
+        self.metrics_server = None
+        if metrics_port is not None:
+            self.metrics_server = metrics.MetricsServer(metrics_port).start()
 
     def mainloop(self):
         """
-        Loop for the main thread
+        Loop for the main thread.
+        If the connection to the server is lost, the emitter goes idle
+        again, so a restarted server is able to reconnect it.
         """
-        if not self.idle():
-            self.shutdown()
-            return
-        if not self.connect():
-            self.shutdown()
-            return
-        self.commander.mainloop()
+        try:
+            while 1:
+                if not self.idle():
+                    self.shutdown()
+                    return
+                if not self.connect():
+                    self.shutdown()
+                    return
+                self.commander.mainloop()
+                if not self.commander.disconnected:
+                    return
+                self.out("going idle")
+                self.server_ip = None
+        finally:
+            # Serves every connection, so it goes only when the emitter exits
+            if self.metrics_server is not None:
+                self.metrics_server.teardown()
+                self.metrics_server = None
 
     def idle(self):
         try:
             while not self.server_ip:
-                self.server_ip = ProbeServer(self.ip, self.ID).mainloop()
+                self.server_ip = ProbeServer(self.ip, self.ID, self.streamer.frameshape,
+                                             self.streamer.codecs).mainloop()
         except KeyboardInterrupt:
             print("CAR: Cancelled connection! Exiting...")
             return False
@@ -53,16 +80,26 @@ class TCPEntity(object):
         else:
             self.server_ip = ip
         mytag = "{}-{}:".format(self.entity_type, self.ID).encode()
-        self.messenger = Messaging.connect_to(ip, timeout=1, tag=mytag)
-        ProbeHandshake.perform(self.streamer, self.messenger)
+        # Connecting from our own address, so the server sees the probed IP
+        self.messenger = Messaging.connect_to(ip, timeout=1, tag=mytag, source=self.ip)
+        response = ProbeHandshake.perform(self.streamer, self.messenger)
+        if response is None:
+            return False
+        token = response.get("token")
 
-        self.receiver.connect(ip)
+        self.receiver.connect(ip, token, source=self.ip)
         self.receiver.start()
 
-        self.streamer.connect(ip)
+        self.streamer.connect(ip, token, source=self.ip)
 
         self.commander = Commander(
-            self.messenger, stream=self.stream_command, shutdown=self.shutdown
+            self.messenger, on_disconnect=self.disconnect,
+            stream=self.stream_command, shutdown=self.shutdown,
+            keyframe=self.streamer.request_keyframe,
+            delta=self.streamer.set_keyframe_interval,
+            fps=self.streamer.set_fps,
+            stats=lambda: metrics.REGISTRY.report(self.ID),
+            clock=clock_reply
         )
         self.out("connected to", ip)
         return True
@@ -80,14 +117,26 @@ class TCPEntity(object):
         else:
             return
 
-    def shutdown(self, msg=None):
-        if msg is not None:
-            self.out(msg)
+    def _close_channels(self):
         if self.receiver is not None:
             self.receiver.teardown(0)
         if self.streamer is not None:
             self.streamer.teardown(0)
+
+    def disconnect(self):
+        """Called when the server is lost, tears down the connection before going idle"""
+        self._close_channels()
+        if self.messenger is not None:
+            self.messenger.teardown(0)
+        self.online = False
+
+    def shutdown(self, msg=None):
+        if msg is not None:
+            self.out(msg)
+        self._close_channels()
         if self.messenger is not None:
-            self.messenger.send("offline".encode())
+            # Answers the shutdown request, if that's what brought us here
+            request = self.commander.current if self.commander is not None else None
+            self.messenger.reply(request, "offline".encode())
             self.messenger.teardown(2)
         self.online = False
@@ -1,10 +1,61 @@
 from __future__ import print_function, absolute_import, unicode_literals
 
 import socket
+import threading as thr
 
+from emittance_common.const import DISCOVERY_PORT, DISCOVERY_GROUP
 from emittance_common.routine import srvsock
 
 
+class DiscoveryResponder(thr.Thread):
+
+    """
+    Answers the UDP discovery datagrams (see Probe.discover) while
+    the emitter is idle. Listens on DISCOVERY_PORT for datagrams sent
+    to the multicast group or to a broadcast address. Replies go back
+    to the sender as a single datagram:
+    emitter-{ID} @ {IP};{frameshape};codecs={codec1},{codec2},...
+    """
+
+    def __init__(self, myIP, myID, frameshape=None, codecs=()):
+        super(DiscoveryResponder, self).__init__(name="Discovery-Responder")
+        self.IP = myIP
+        self.reply = "emitter-{} @ {};{};codecs={}".format(
+            myID, myIP, frameshape or "", ",".join(codecs)
+        ).encode()
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            # Every emitter on the host listens on the same port
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            self.sock.bind(("", DISCOVERY_PORT))
+            self.sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP,
+                                 socket.inet_aton(DISCOVERY_GROUP) + socket.inet_aton(myIP))
+        except OSError:
+            # Eg. no multicast route, the caller goes on without discovery
+            self.sock.close()
+            raise
+        self.sock.settimeout(1)
+        self.running = False
+
+    def run(self):
+        self.running = True
+        while self.running:
+            try:
+                msg, addr = self.sock.recvfrom(1024)
+            except socket.timeout:
+                continue
+            except OSError:
+                break
+            if msg == b"discover":
+                print("PROBESRV: discovered by", addr[0])
+                self.sock.sendto(self.reply, addr)
+
+    def teardown(self, sleep=0):
+        self.running = False
+        self.join(sleep or None)
+        self.sock.close()
+
+
 class ProbeServer(object):
 
     """
@@ -13,9 +64,15 @@ class ProbeServer(object):
     valid, they send back their CarID and IP address to the probe.
     """
 
-    def __init__(self, myIP, myID):
+    def __init__(self, myIP, myID, frameshape=None, codecs=()):
+        """
+        :param frameshape: advertised in the discovery replies
+        :param codecs: advertised in the discovery replies
+        """
         self.IP = myIP
         self.ID = myID
+        self.frameshape = frameshape
+        self.codecs = codecs
         self.sock = None
         self.conn = None
         self.remote_address = None
@@ -47,17 +104,29 @@ class ProbeServer(object):
 
     def mainloop(self):
         self.sock = srvsock(self.IP, channel="probe", timeout=1)
+        try:
+            responder = DiscoveryResponder(self.IP, self.ID, self.frameshape, self.codecs)
+        except OSError as E:
+            print("PROBESRV: discovery unavailable:", E)
+            responder = None
+        else:
+            responder.start()
         print("PROBESRV: Awaiting connection... Hit Ctrl-C to break!".format(self.ID))
-        while 1:
-            try:
-                self.conn, self.remote_address = self.sock.accept()
-            except socket.timeout:
-                pass
-            else:
-                if self._new_connection_causes_loopbreak():
-                    break
-                self.conn.close()
-                self.conn = None
+        try:
+            while 1:
+                try:
+                    self.conn, self.remote_address = self.sock.accept()
+                except socket.timeout:
+                    pass
+                else:
+                    if self._new_connection_causes_loopbreak():
+                        break
+                    self.conn.close()
+                    self.conn = None
+        finally:
+            if responder is not None:
+                responder.teardown(1)
+            self.sock.close()
         return self.remote_address[0]
 
 
@@ -69,15 +138,26 @@ class ProbeHandshake(object):
 
     @classmethod
     def perform(cls, streamer, messenger):
+        """
+        :return: the fields of the server's response as a dict, or None
+        """
         cls._send_introduction(streamer, messenger)
         hello = cls._read_response(messenger)
         if not cls._validate_response(hello):
             print("PROBESRV: invalid server response:", hello)
             return None
+        response = cls._parse_response(hello)
+        streamer.set_codec(response.get("codec", "gzip"))
+        return response
 
     @staticmethod
     def _send_introduction(streamer, messenger):
-        introduction = ("HELLO;" + streamer.frameshape).encode()
+        """
+        Introduction looks like this:
+        HELLO;{frY}x{frX}x{frC};codecs={codec1},{codec2},...
+        """
+        introduction = ("HELLO;" + streamer.frameshape +
+                        ";codecs=" + ",".join(streamer.codecs)).encode()
         print("PROBESRV: sending introduction:", introduction)
         messenger.send(introduction)
 
@@ -92,4 +172,14 @@ class ProbeHandshake(object):
 
     @staticmethod
     def _validate_response(hello):
-        return hello == "HELLO"
+        return hello is not None and hello.split(";")[0] == "HELLO"
+
+    @staticmethod
+    def _parse_response(hello):
+        """
+        Response looks like this: HELLO;codec={codec spec};token={token}
+        A plain HELLO comes from legacy servers, which only speak gzip
+        and don't identify the streams with a token.
+        """
+        fields = [f.partition("=") for f in hello.split(";")[1:]]
+        return {key: value for key, _, value in fields}
@@ -0,0 +1,237 @@
+"""
+Replay of recorded content, a stand-in for the camera.
+
+ReplaySource mocks the interface of cv2.VideoCapture and plays
+- a video file or an image sequence pattern (eg. frames/%04d.png)
+  readable by OpenCV,
+- a directory of images, in natural order (2.png before 10.png),
+- a recording of the Aggregator or one of its segments, see
+  emittance_common.recording.
+
+The timing is set by the mode:
+- realtime: the frames are due at their original times, a video plays
+  at its own frame rate, a recording by the capture timestamps, an image
+  directory at <rate>
+- <speed>x: realtime, faster or slower, eg. 4x or 0.5x
+- <fps>: a fixed frame rate, eg. 30
+- asap: as fast as the frames are decoded
+read() blocks until the next frame is due, like a camera does. When
+the replay falls behind, it isn't hurrying to catch up. Note that the
+frame rate of the emitter (the fps command) still caps the stream.
+"""
+
+import os
+import re
+import time
+
+import cv2
+
+from emittance_common.const import FPS, REPLAY_MODE
+from emittance_common.pacing import Pacer
+from emittance_common.recording import Recording
+
+IMAGE_EXTENSIONS = {".png", ".jpg", ".jpeg", ".bmp", ".tif", ".tiff", ".webp", ".ppm", ".pgm"}
+
+
+def parse_mode(spec):
+    """
+    :param spec: "realtime", "<speed>x", "<fps>" or "asap", see the module docstring
+    :return: tuple of (mode, value): ("realtime", speed), ("fps", fps) or ("asap", None)
+    """
+    spec = str(spec).strip().lower()
+    try:
+        if spec == "asap":
+            return "asap", None
+        if spec == "realtime":
+            return "realtime", 1.
+        if spec.endswith("x"):
+            mode, value = "realtime", float(spec[:-1])
+        else:
+            mode, value = "fps", float(spec)
+    except ValueError:
+        raise ValueError("Invalid replay mode: {}, expected realtime, <speed>x, <fps> or asap"
+                         .format(spec)) from None
+    if value <= 0:
+        raise ValueError("Replay speed and FPS have to be positive, got {}".format(spec))
+    return mode, value
+
+
+def _natural_key(name):
+    return [int(part) if part.isdigit() else part for part in re.split(r"(\d+)", name)]
+
+
+class VideoReader(object):
+
+    """Frames of a video file or an image sequence pattern, decoded by OpenCV"""
+
+    def __init__(self, path):
+        capture = cv2.VideoCapture(path)
+        if not capture.isOpened():
+            raise IOError("Unable to open video: {}".format(path))
+        rate = capture.get(cv2.CAP_PROP_FPS)
+        capture.release()
+        self.path = path
+        # Image sequences and some containers don't tell their frame rate
+        self.rate = rate if rate and rate > 0 and rate == rate else FPS
+
+    def frames(self):
+        """Yields (timestamp, frame), timestamps in seconds from the first frame"""
+        capture = cv2.VideoCapture(self.path)
+        try:
+            index = 0
+            while 1:
+                success, frame = capture.read()
+                if not success:
+                    return
+                yield index / self.rate, frame
+                index += 1
+        finally:
+            capture.release()
+
+
+class DirectoryReader(object):
+
+    """Images of a directory, in natural order, at <rate> frames per second"""
+
+    def __init__(self, path, rate=FPS):
+        self.path = path
+        self.rate = rate
+        self.files = sorted((name for name in os.listdir(path)
+                             if os.path.splitext(name)[1].lower() in IMAGE_EXTENSIONS),
+                            key=_natural_key)
+        if not self.files:
+            raise IOError("No images in directory: {}".format(path))
+
+    def frames(self):
+        for index, name in enumerate(self.files):
+            frame = cv2.imread(os.path.join(self.path, name), cv2.IMREAD_COLOR)
+            if frame is None:
+                print("REPLAY: skipping unreadable image:", name)
+                continue
+            yield index / self.rate, frame
+
+
+class RecordingReader(object):
+
+    """Decoded frames of a recording, timed by their capture timestamps"""
+
+    def __init__(self, path):
+        recording = Recording(path)
+        self.path = path
+        self.start = recording.start
+        count, span = len(recording), recording.end - recording.start
+        # Sets the pause between the loops
+        self.rate = (count - 1) / span if count > 1 and span > 0 else FPS
+        recording.close()
+
+    def frames(self):
+        # Opened on every pass, so the segments recorded since are included
+        recording = Recording(self.path)
+        try:
+            for header, frame in recording.decoded():
+                yield header.timestamp - self.start, frame
+        finally:
+            recording.close()
+
+
+def open_reader(path, rate=None):
+    """
+    :param rate: frame rate of the sources without timing, defaults to FPS
+    :return: the reader of <path>, see VideoReader, DirectoryReader and RecordingReader
+    """
+    if Recording.detect(path):
+        return RecordingReader(path)
+    if os.path.isdir(path):
+        return DirectoryReader(path, rate or FPS)
+    return VideoReader(path)
+
+
+class ReplaySource(object):
+
+    """
+    Mocks the interface of cv2.VideoCapture, replays a file or a directory.
+    See the module docstring.
+    """
+
+    def __init__(self, path, mode=REPLAY_MODE, loop=False, rate=None, cache=False):
+        """
+        :param path: video file, image sequence pattern, image directory or recording
+        :param mode: timing of the replay, see parse_mode()
+        :param loop: whether to restart at the end, otherwise read() fails from there
+        :param rate: frame rate of an image directory in realtime mode, defaults to FPS
+        :param cache: keep the decoded frames in memory, so the loops after the
+         first don't decode again. The cached frames are read-only.
+        """
+        self.mode, self.value = parse_mode(mode)
+        self.reader = open_reader(path, rate)
+        self.loop = loop
+        self.cache = [] if cache else None
+        self.pacer = Pacer(self.value) if self.mode == "fps" else None
+        self.shape = None
+        self.loops = 0
+        self.exhausted = False
+        self._previous = None
+        self._due = None
+        self._stream = self._frames()
+
+    def _pass(self):
+        if self.cache is not None and self.loops:
+            yield from self.cache
+            return
+        for stamp, frame in self.reader.frames():
+            if self.cache is not None:
+                frame.flags.writeable = False
+                self.cache.append((stamp, frame))
+            yield stamp, frame
+
+    def _frames(self):
+        """Yields (timestamp, frame) of every pass, with timestamps increasing across the loops"""
+        offset = 0.
+        while 1:
+            last = None
+            for stamp, frame in self._pass():
+                last = offset + stamp
+                yield last, frame
+            if last is None or not self.loop:
+                return
+            # The first frame of the next pass follows the last one by a frame period
+            offset = last + 1. / self.reader.rate
+            self.loops += 1
+
+    def _wait(self, stamp):
+        if self.mode == "fps":
+            self.pacer.wait()
+            return
+        if self.mode == "asap":
+            return
+        now = time.monotonic()
+        if self._due is None:
+            self._due = now
+            gap = 0.
+        else:
+            gap = (stamp - self._previous) / self.value
+            self._due += gap
+        self._previous = stamp
+        delay = self._due - now
+        if delay > 0:
+            time.sleep(delay)
+        elif -delay > gap:
+            # Behind by more than a frame: re-anchor instead of bursting
+            self._due = now
+
+    def read(self):
+        item = next(self._stream, None)
+        if item is None:
+            self.exhausted = True
+            return False, None
+        stamp, frame = item
+        self._wait(stamp)
+        if self.shape is None:
+            self.shape = frame.shape
+        elif frame.shape != self.shape:
+            # The stream has a fixed frame shape, eg. images of different sizes are scaled
+            frame = cv2.resize(frame, self.shape[1::-1])
+        return True, frame
+
+    def release(self):
+        self._stream.close()
@@ -118,7 +118,5 @@ class DirectConnection(object):
             self.master = master
 
         def callback(self, msock):
-            self.master.interface = InterfaceFactory(
-                msock, self.dlistener, self.rclistener
-            ).get()
+            self.master.interface = InterfaceFactory(msock, self.matcher).get()
             self.running = False  # Break the mainloop in AbstractListener
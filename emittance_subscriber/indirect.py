@@ -2,8 +2,14 @@ from __future__ import print_function, absolute_import, unicode_literals
 
 import socket
 
-from emittance_common.const import MESSAGE_SERVER_PORT, STREAM_SERVER_PORT, RC_SERVER_PORT
+from emittance_common.const import (
+    MESSAGE_SERVER_PORT, STREAM_SERVER_PORT, RC_SERVER_PORT, HANDSHAKE_TIMEOUT
+)
 from emittance_common.messaging import Messaging
+from emittance_common.handshake import send_token
+from emittance_common.clock import ClockSync, FrameLatency
+from emittance_common.codec import codec_by_id
+from emittance_common.framing import read_frame, DeltaDecoder
 
 
 class ServerConnection(object):
@@ -13,31 +19,101 @@ class ServerConnection(object):
     def __init__(self, serverIP, ID):
         self.ID = ID
         self.serverIP = serverIP
-        self.messaging = Messaging(socket.create_connection((serverIP, MESSAGE_SERVER_PORT))[0],
+        self.messaging = Messaging(socket.create_connection((serverIP, MESSAGE_SERVER_PORT), timeout=1),
                                    tag="{}-{}:".format(self.entity_type, self.ID).encode())
 
         # Validation should be done via the messaging channel:
         # - username/password check
         # - version check?
         # - server validation?
+        token = self._introduce()
 
-        self.dsocket = socket.create_connection((serverIP, STREAM_SERVER_PORT))[0]
-        self.rcsocket = socket.create_connection((serverIP, RC_SERVER_PORT))[0]
+        self.dsocket = socket.create_connection((serverIP, STREAM_SERVER_PORT))
+        send_token(self.dsocket, token)
+        self.rcsocket = socket.create_connection((serverIP, RC_SERVER_PORT))
+        send_token(self.rcsocket, token)
+
+        self.carID = None
+        # Started once a car is connected, the request depends on it
+        self.clock = ClockSync(self.messaging, name="aggregator", labels={"aggregator": serverIP})
+
+    def _introduce(self):
+        """
+        Sends the introduction, the tag makes it subscriber-{ID}:HELLO;
+        :return: the token, which identifies the data and RC connections
+        """
+        self.messaging.send(b"HELLO;")
+        hello = self.messaging.recv(timeout=HANDSHAKE_TIMEOUT)
+        if hello is None or hello.split(";")[0] != "HELLO":
+            raise RuntimeError("Invalid server response: {}".format(hello))
+        fields = dict(f.partition("=")[::2] for f in hello.split(";")[1:])
+        return fields["token"]
 
     def _sendcmd(self, cmd, timeout=3):
-        self.messaging.send(cmd)
-        response = self.messaging.recv(timeout=timeout)
-        return response
+        """Sends a command and blocks only until its reply arrives (None on timeout)"""
+        return self.messaging.request(cmd, timeout=timeout)
 
     def request_car_list(self):
-        cars = self._sendcmd(b"cmd|cars", 3).split(", ")
+        cars = self._sendcmd(b"cars", 3)
         print(cars)
-        return cars.split(", ")
+        return [] if cars is None else cars.split(", ")
 
-    def request_car_connection(self, carID):
-        framestring = self._sendcmd("cmd|connect {}".format(carID), 3).encode()
+    def request_car_connection(self, carID, **options):
+        """
+        :param options: settings of the server-side send queue,
+         eg. policy="latest", lag=2, queue=4 (see emittance_common.hub)
+        """
+        cmd = " ".join(["connect", carID] + ["{}={}".format(*kv) for kv in sorted(options.items())])
+        framestring = self._sendcmd(cmd.encode(), 3)
         print("DIRECT_CONN: frameshape received:", framestring)
+        self.carID = carID
+        # The Aggregator's answer carries the emitter's clock offset as well
+        request = "clock {}".format(carID).encode()
+        if self.clock.ident is None:
+            self.clock.request = request
+            self.clock.start()
+        else:
+            self.clock.resync(request)
+
+    def request_stats(self):
+        """The server-side send queue statistics of this subscriber"""
+        return self._sendcmd(b"stats", 3)
+
+    def framestream(self):
+        """
+        Generator function that yields the decoded frames of the emitter.
+        The age of the frames is recorded on their arrival and after decoding
+        (capture_latency_seconds and glass_to_glass_seconds). The hop from the
+        Aggregator is the difference of the capture latencies recorded here
+        and on the Aggregator.
+        """
+        latency = FrameLatency(self.clock, emitter=self.carID)
+        delta = DeltaDecoder(on_missing_keyframe=lambda: self.messaging.send(b"keyframe"))
+        while 1:
+            try:
+                header, payload = read_frame(self.dsocket)
+            except (ConnectionError, OSError) as E:
+                print("DIRECT_CONN: stream closed:", E)
+                return
+            latency.arrived(header)
+            frame = codec_by_id(header.codec).decode(payload, header.shape, header.dtype)
+            frame = delta.apply(header, frame)
+            if frame is None:
+                continue
+            latency.displayed(header)
+            yield frame
 
     def observe_someone_else(self, ID):
-        status = self._sendcmd("cmd|watch {}".format(ID), 3).encode()
+        status = self._sendcmd("watch {}".format(ID).encode(), 3)
         print("DIRECT_CONN: status received:", status)
+
+    def teardown(self, sleep=0):
+        """Disconnects from the server, framestream() returns"""
+        self.clock.teardown()
+        self.messaging.teardown(sleep)
+        for sock in (self.dsocket, self.rcsocket):
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            sock.close()
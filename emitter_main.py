@@ -6,21 +6,31 @@ Parses arguments (readargs) and waits for server probes (idle).
 import sys
 
 from emittance_emitter.entity import TCPEntity
+from emittance_emitter.component import CaptureDevice
+from emittance_common.const import REPLAY_MODE
 
 
 def readargs():
-    if len(sys.argv) == 3:
-        return sys.argv[1:3]
+    """
+    Usage: emitter_main.py IP ID [SOURCE [MODE]]
+    SOURCE is a video file or an image directory replayed instead of the camera,
+    MODE is the timing of the replay: realtime, <speed>x, <fps> or asap
+    """
+    if 3 <= len(sys.argv) <= 5:
+        return sys.argv[1:] + [None] * (5 - len(sys.argv))
 
     pleading = "Please supply "
     question = ["the local IP address of this Car",
                 "a unique ID for this Car"]
-    return [input(pleading + q + " > ") for q in question]
+    return [input(pleading + q + " > ") for q in question] + [None, None]
 
 
 def main():
-    localIP, carID = readargs()
-    lightning_mcqueen = TCPEntity(myID=carID, myIP=localIP)
+    localIP, carID, source, mode = readargs()
+    eye = None
+    if source is not None:
+        eye = CaptureDevice(dummyfile=source, mode=mode or REPLAY_MODE)
+    lightning_mcqueen = TCPEntity(myID=carID, myIP=localIP, eye=eye)
     lightning_mcqueen.mainloop()
 
 
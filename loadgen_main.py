@@ -0,0 +1,50 @@
+"""
+Simulates a fleet of emitters and subscribers against an Aggregator
+and reports the achieved throughput, latencies and drops.
+See emittance_aggregator/loadgen.py
+"""
+
+import argparse
+
+from emittance_aggregator.loadgen import LoadGenerator
+from emittance_common.const import AGGREGATOR_ENGINE, REPLAY_MODE
+
+
+def readargs():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("-e", "--emitters", type=int, default=4, help="number of emitters")
+    parser.add_argument("-s", "--subscribers", type=int, default=4, help="number of subscribers")
+    parser.add_argument("--engine", choices=("thread", "async"), default=AGGREGATOR_ENGINE)
+    parser.add_argument("-d", "--duration", type=float, default=10., help="measured seconds")
+    parser.add_argument("-w", "--warmup", type=float, default=2., help="seconds before measuring")
+    parser.add_argument("--fps", type=float, help="target frame rate of the emitters")
+    parser.add_argument("--source", help="video file or image sequence to stream "
+                                         "instead of synthetic frames")
+    parser.add_argument("--synthetic", default="noise", metavar="SPEC",
+                        help="synthetic source: noise, gradient or pattern[:WIDTHxHEIGHT"
+                             "[:scene change rate]], default: noise")
+    parser.add_argument("--replay", default=REPLAY_MODE, metavar="MODE",
+                        help="timing of the replayed source: realtime, <speed>x, <fps> or asap, "
+                             "default: %(default)s")
+    parser.add_argument("-o", "--option", action="append", default=[], metavar="KEY=VALUE",
+                        help="subscription setting, eg. policy=latest or fps=5")
+    parser.add_argument("-v", "--verbose", action="store_true",
+                        help="show the output of the emitters and subscribers")
+    return parser.parse_args()
+
+
+def main():
+    args = readargs()
+    generator = LoadGenerator(
+        emitters=args.emitters, subscribers=args.subscribers, engine=args.engine,
+        source=args.source, synthetic=args.synthetic, replay=args.replay, fps=args.fps,
+        quiet=not args.verbose,
+        options=dict(option.partition("=")[::2] for option in args.option)
+    )
+    results = generator.run(duration=args.duration, warmup=args.warmup)
+    print()
+    print(generator.report(results))
+
+
+if __name__ == '__main__':
+    main()
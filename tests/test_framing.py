@@ -0,0 +1,122 @@
+import socket
+import struct
+
+import numpy as np
+import pytest
+
+from emittance_common.codec import RawCodec, get_codec
+from emittance_common.framing import (
+    DeltaDecoder, DeltaEncoder, FLAG_DELTA, FLAG_KEYFRAME, FRAME_MAGIC, HEADER, HEADER_SIZE,
+    FramePool, pack_frame, pack_header, read_frame, read_raw_frame, unpack_header
+)
+from emittance_common.synthetic import PatternSource
+
+
+def scene(count, shape=(16, 20, 3)):
+    """Frames of a mostly static scene, see synthetic.PatternSource"""
+    source = PatternSource(shape)
+    return [source.read()[1] for _ in range(count)]
+
+
+@pytest.mark.parametrize("shape, dtype", [((480, 640, 3), np.uint8), ((120, 160), np.uint16),
+                                          ((8, 8, 1), np.float32)])
+def test_header_roundtrip(shape, dtype):
+    payload = b"\x01\x02\x03" * 7
+    buffer = pack_frame(payload, 42, 1700000000.25, shape, dtype, 3, FLAG_KEYFRAME)
+    assert len(buffer) == HEADER_SIZE + len(payload)
+    header = unpack_header(buffer[:HEADER_SIZE])
+    assert header.length == len(payload)
+    assert header.seq == 42
+    assert header.timestamp == 1700000000.25
+    assert header.shape == shape
+    assert header.dtype == np.dtype(dtype)
+    assert header.codec == 3
+    assert header.flags == FLAG_KEYFRAME
+    assert buffer[HEADER_SIZE:] == payload
+
+
+def test_sequence_number_wraps():
+    header = unpack_header(pack_header(0, 2 ** 32 + 5, 0., (2, 2), np.uint8, RawCodec.ID))
+    assert header.seq == 5
+
+
+def test_invalid_header():
+    head = bytearray(pack_header(0, 0, 0., (2, 2), np.uint8, RawCodec.ID))
+    head[:4] = b"XXXX"
+    with pytest.raises(RuntimeError):
+        unpack_header(head)
+    fields = list(HEADER.unpack(pack_header(0, 0, 0., (2, 2), np.uint8, RawCodec.ID)))
+    assert fields[0] == FRAME_MAGIC
+    fields[1] += 1
+    with pytest.raises(RuntimeError):
+        unpack_header(struct.pack(HEADER.format, *fields))
+
+
+def test_read_from_socket():
+    codec = get_codec("zlib")
+    frames = scene(3)
+    sender, receiver = socket.socketpair()
+    try:
+        for seq, frame in enumerate(frames):
+            sender.sendall(pack_frame(codec.encode(frame), seq, 0., frame.shape, frame.dtype,
+                                      codec.ID))
+        header, payload = read_frame(receiver)
+        np.testing.assert_array_equal(codec.decode(payload, header.shape, header.dtype), frames[0])
+        header, buffer = read_raw_frame(receiver)
+        assert header.seq == 1
+        assert unpack_header(buffer[:HEADER_SIZE]) == header
+        header, frame = FramePool(frames[2].shape, np.uint8, 2).read_frame(receiver)
+        np.testing.assert_array_equal(frame, frames[2])
+        sender.close()
+        with pytest.raises(ConnectionError):
+            read_frame(receiver)
+    finally:
+        sender.close()
+        receiver.close()
+
+
+def test_delta_roundtrip():
+    frames = scene(12)
+    encoder, decoder = DeltaEncoder(interval=4), DeltaDecoder()
+    flags = []
+    for seq, frame in enumerate(frames):
+        coded, flag = encoder.apply(frame)
+        flags.append(flag)
+        header = unpack_header(pack_header(coded.nbytes, seq, 0., frame.shape, frame.dtype,
+                                           RawCodec.ID, flag))
+        np.testing.assert_array_equal(decoder.apply(header, coded.copy()), frame)
+    assert flags == [FLAG_KEYFRAME, FLAG_DELTA, FLAG_DELTA, FLAG_DELTA] * 3
+
+
+def test_delta_off():
+    frame = scene(1)[0]
+    for coded, flags in (DeltaEncoder(interval=0).apply(frame),
+                         DeltaEncoder(interval=4).apply(frame, lossless=False)):
+        assert coded is frame
+        assert flags == 0
+
+
+def test_broken_chain():
+    frames = scene(12)
+    requests = []
+    encoder = DeltaEncoder(interval=8)
+
+    def request_keyframe():
+        requests.append(True)
+        encoder.request_keyframe()
+
+    decoder = DeltaDecoder(on_missing_keyframe=request_keyframe)
+    decoded = {}
+    for seq, frame in enumerate(frames):
+        coded, flag = encoder.apply(frame)
+        if seq == 2:
+            continue  # Lost on the way
+        header = unpack_header(pack_header(coded.nbytes, seq, 0., frame.shape, frame.dtype,
+                                           RawCodec.ID, flag))
+        result = decoder.apply(header, coded.copy())
+        if result is not None:
+            decoded[seq] = result
+    assert sorted(decoded) == [0, 1, 4, 5, 6, 7, 8, 9, 10, 11]
+    assert len(requests) == 1
+    for seq, frame in decoded.items():
+        np.testing.assert_array_equal(frame, frames[seq])
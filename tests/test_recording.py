@@ -0,0 +1,135 @@
+import os
+
+import numpy as np
+import pytest
+
+from emittance_common.codec import get_codec
+from emittance_common.framing import DeltaEncoder, FLAG_DELTA, HEADER_SIZE, pack_frame, unpack_header
+from emittance_common.recording import FRAMES_EXT, INDEX_DTYPE, INDEX_EXT, Recorder, Recording, Segment
+from emittance_common.synthetic import PatternSource
+
+START = 1700000000.
+PERIOD = .1
+SHAPE = (24, 32, 3)
+
+
+def synthetic_stream(count, keyframe_interval=5):
+    """
+    Frames of a PatternSource, delta-coded and compressed like the emitters do.
+    :return: list of (FrameHeader, encoded frame with its header, source frame)
+    """
+    source = PatternSource(SHAPE)
+    codec = get_codec("zlib")
+    delta = DeltaEncoder(keyframe_interval)
+    stream = []
+    for seq in range(count):
+        _, frame = source.read()
+        coded, flags = delta.apply(frame)
+        buffer = pack_frame(codec.encode(coded), seq, START + seq * PERIOD, SHAPE, np.uint8,
+                            codec.ID, flags)
+        stream.append((unpack_header(buffer[:HEADER_SIZE]), buffer, frame))
+    return stream
+
+
+def record(directory, ID, stream, drop=(), segment=1.):
+    """Records the stream except the sequence numbers in <drop>"""
+    requests = []
+    recorder = Recorder(ID, directory=str(directory), segment=segment, maxsize=len(stream),
+                        request_keyframe=lambda: requests.append(True))
+    for header, buffer, _ in stream:
+        if header.seq not in drop:
+            assert recorder.put((header, buffer))
+    recorder.teardown()
+    return recorder, requests
+
+
+@pytest.fixture(scope="module")
+def recorded(tmp_path_factory):
+    """30 frames with keyframes every 5 frames and segments of 1 s, the 13th frame lost"""
+    directory = tmp_path_factory.mktemp("recordings")
+    stream = synthetic_stream(30)
+    recorder, requests = record(directory, "R0", stream, drop={13})
+    recording = Recording(str(directory / "R0"))
+    yield stream, recorder, requests, recording
+    recording.close()
+
+
+def test_index_layout():
+    assert INDEX_DTYPE.itemsize == 25
+    assert INDEX_DTYPE.names == ("seq", "timestamp", "offset", "length", "flags")
+
+
+def test_lost_frame_skips_until_keyframe(recorded):
+    stream, recorder, requests, recording = recorded
+    # The delta chain is broken from the lost frame up to the keyframe at 15
+    expected = [seq for seq in range(30) if seq not in (13, 14)]
+    assert [int(seq) for segment in recording.segments for seq in segment.index["seq"]] == expected
+    assert recorder.skipped.value == 1
+    assert len(requests) == 1
+
+
+def test_segments_start_with_keyframes(recorded):
+    stream, recorder, requests, recording = recorded
+    assert [int(s.index[0]["seq"]) for s in recording.segments] == [0, 10, 20]
+    for segment in recording.segments:
+        assert not segment.index[0]["flags"] & FLAG_DELTA
+    assert recording.start == START
+    assert recording.end == pytest.approx(START + 29 * PERIOD)
+
+
+def test_recorded_frames_are_unchanged(recorded):
+    stream, recorder, requests, recording = recorded
+    buffers = {header.seq: buffer for header, buffer, _ in stream}
+    for header, payload in recording.frames():
+        assert bytes(buffers[header.seq][HEADER_SIZE:]) == bytes(payload)
+        assert header.timestamp == START + header.seq * PERIOD
+
+
+def test_decoded_matches_sources(recorded):
+    stream, recorder, requests, recording = recorded
+    decoded = list(recording.decoded())
+    assert [header.seq for header, _ in decoded] == [seq for seq in range(30) if seq not in (13, 14)]
+    for header, frame in decoded:
+        np.testing.assert_array_equal(frame, stream[header.seq][2])
+
+
+def test_seek(recorded):
+    stream, recorder, requests, recording = recorded
+    # Decoding starts at the keyframe before the frame
+    assert recording.seek(START + 12 * PERIOD) == (1, 0)
+    assert recording.seek(START + 17 * PERIOD) == (1, 3)
+    # Segment boundaries and the ends of the recording
+    assert recording.seek(START + 20 * PERIOD) == (2, 0)
+    assert recording.seek(START - 1) == (0, 0)
+    assert recording.seek(START + 100) == (2, 5)
+
+
+def test_decoded_range(recorded):
+    stream, recorder, requests, recording = recorded
+    decoded = list(recording.decoded(START + 17 * PERIOD, START + 22.5 * PERIOD))
+    assert [header.seq for header, _ in decoded] == [17, 18, 19, 20, 21, 22]
+    for header, frame in decoded:
+        np.testing.assert_array_equal(frame, stream[header.seq][2])
+
+
+def test_partially_written_segment(tmp_path):
+    stream = synthetic_stream(8)
+    record(tmp_path, "R1", stream)
+    path = os.path.join(str(tmp_path / "R1"), os.listdir(str(tmp_path / "R1"))[0])
+    path = os.path.splitext(path)[0]
+    # The last frame is only partially on disk, followed by a partial index record
+    with open(path + FRAMES_EXT, "r+b") as handle:
+        handle.truncate(os.path.getsize(path + FRAMES_EXT) - 1)
+    with open(path + INDEX_EXT, "ab") as handle:
+        handle.write(b"\0" * (INDEX_DTYPE.itemsize // 2))
+    segment = Segment(path + INDEX_EXT)
+    try:
+        assert len(segment) == 7
+        assert [header.seq for header, _ in segment.frames()] == list(range(7))
+    finally:
+        segment.close()
+
+
+def test_no_frames(tmp_path):
+    with pytest.raises(IOError):
+        Recording(str(tmp_path))